@@ -0,0 +1,560 @@
+# coding: utf-8
+'''
+micro-benchmarks for hot paths of textgen
+
+run: python -m textgen.benchmarks
+'''
+import os
+import gc
+import sys
+import json
+import time
+import timeit
+import tempfile
+import threading
+
+from textgen.templates import Dictionary, Template, Vocabulary
+from textgen.words import WordBase, Noun, Adjective, Verb, Participle, ShortParticiple, NounGroup, Pronoun
+from textgen.logic import Args
+from textgen import vectorized
+from textgen import codegen
+from textgen.snapshots import SnapshotHolder
+
+
+def create_word(word_class, forms_number):
+    return word_class(normalized=u'слово', forms=[u'слово_%d' % i for i in xrange(forms_number)], properties=(u'ср',))
+
+
+def get_benchmark_words():
+    return [create_word(Noun, 12),
+            create_word(NounGroup, 12),
+            create_word(Adjective, 24),
+            create_word(Pronoun, 24),
+            create_word(Verb, 16),
+            create_word(Participle, 48),
+            create_word(ShortParticiple, 8)]
+
+
+def _get_form_by_scan(self, args):
+    if not self.forms:
+        return self.normalized
+    return self.forms[self._form_index(args)]
+
+
+def benchmark_get_form(number=20000):
+    '''
+    compare form lookup by precomputed table with computing form index on every call
+    '''
+    states = list(Args.all())
+
+    results = []
+
+    for word in get_benchmark_words():
+
+        scan_class = type('Scan%s' % word.__class__.__name__, (word.__class__,), {'_get_form': _get_form_by_scan})
+        scan_word = scan_class(normalized=word.normalized, forms=word.forms, properties=word.properties)
+
+        def by_table():
+            for args in states:
+                word.get_form(args)
+
+        def by_scan():
+            for args in states:
+                scan_word.get_form(args)
+
+        repeats = max(1, number / len(states))
+
+        table_time = min(timeit.repeat(by_table, number=repeats, repeat=3))
+        scan_time = min(timeit.repeat(by_scan, number=repeats, repeat=3))
+
+        calls = repeats * len(states)
+
+        results.append((word.__class__.__name__, scan_time / calls, table_time / calls))
+
+    return results
+
+
+def print_get_form_results(results):
+    print 'get_form (usec per call)'
+    print '%-20s %10s %10s %8s' % ('word', 'scan', 'table', 'speedup')
+    for name, scan_time, table_time in results:
+        print '%-20s %10.3f %10.3f %7.1fx' % (name, scan_time * 1e6, table_time * 1e6, scan_time / table_time)
+
+
+def create_benchmark_dictionary(words_number):
+    dictionary = Dictionary()
+    for i in xrange(words_number):
+        dictionary.add_word(Noun(normalized=u'слово_%d' % i,
+                                 forms=[u'слово_%d_%d' % (i, j) for j in xrange(Noun.FORMS_NUMBER)],
+                                 properties=(u'ср',)))
+    return dictionary
+
+
+def benchmark_dictionary_load(words_number=20000):
+    '''
+    compare time to load dictionary and render first word for json and binary storages
+    '''
+    dictionary = create_benchmark_dictionary(words_number)
+
+    json_storage = tempfile.NamedTemporaryFile(delete=False).name
+    binary_storage = tempfile.NamedTemporaryFile(delete=False).name
+
+    dictionary.save(json_storage)
+    dictionary.save_binary(binary_storage)
+
+    def load_json():
+        Dictionary().load(json_storage)
+
+    def load_binary():
+        loaded = Dictionary()
+        loaded.load_binary(binary_storage)
+        loaded.get_word(u'слово_1').get_form(Args(u'рд'))
+
+    results = [('json', os.path.getsize(json_storage), min(timeit.repeat(load_json, number=1, repeat=3))),
+               ('binary', os.path.getsize(binary_storage), min(timeit.repeat(load_binary, number=1, repeat=3)))]
+
+    os.remove(json_storage)
+    os.remove(binary_storage)
+
+    return words_number, results
+
+
+def print_dictionary_load_results(results):
+    words_number, storages = results
+    print 'dictionary load, %d words' % words_number
+    print '%-20s %10s %10s' % ('storage', 'size, Kb', 'time, ms')
+    for name, size, load_time in storages:
+        print '%-20s %10d %10.2f' % (name, size / 1024, load_time * 1000)
+
+
+NAME_ENDINGS = ((u'а', u'ы', u'е', u'у', u'ой', u'е', u'ы', u'', u'ам', u'', u'ами', u'ах'),
+                (u'', u'а', u'у', u'а', u'ом', u'е', u'ы', u'ов', u'ам', u'ов', u'ами', u'ах'))
+
+
+def create_names_dictionary(words_number):
+    dictionary = Dictionary()
+    for i in xrange(words_number):
+        stem = u'гоблин%d' % i
+        dictionary.add_word(Noun(normalized=stem,
+                                 forms=[stem + ending for ending in NAME_ENDINGS[i % len(NAME_ENDINGS)]],
+                                 properties=(u'мр',)))
+    return dictionary
+
+
+def get_forms_size(dictionary):
+    '''
+    approximate size in bytes of objects, storing forms of dictionary words
+    '''
+    seen = set()
+    size = 0
+
+    def add(obj):
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        return sys.getsizeof(obj)
+
+    for word in dictionary.data.values():
+        forms = word.forms
+        size += add(forms)
+        if isinstance(forms, tuple):
+            for form in forms:
+                size += add(form)
+        else:
+            size += add(forms.stem) + add(forms.endings)
+            for ending in forms.endings:
+                size += add(ending)
+
+    return size
+
+
+def benchmark_compact(words_number=20000):
+    '''
+    compare memory of forms and get_form speed for plain and compacted dictionaries
+    '''
+    dictionary = create_names_dictionary(words_number)
+    words = dictionary.data.values()[:1000]
+    args = Args(u'рд', u'мн')
+
+    def render():
+        for word in words:
+            word.get_form(args)
+
+    results = [('tuple', get_forms_size(dictionary), min(timeit.repeat(render, number=10, repeat=3)) / (10 * len(words)))]
+
+    dictionary.compact()
+
+    results.append(('paradigm', get_forms_size(dictionary), min(timeit.repeat(render, number=10, repeat=3)) / (10 * len(words))))
+
+    return words_number, results
+
+
+def print_compact_results(results):
+    words_number, storages = results
+    print 'forms storage, %d words' % words_number
+    print '%-20s %10s %10s' % ('storage', 'size, Kb', 'usec/form')
+    for name, size, form_time in storages:
+        print '%-20s %10d %10.3f' % (name, size / 1024, form_time * 1e6)
+
+
+class _PlainObject(object):
+    '''
+    object with __dict__, used to reproduce layout of words and templates without slots and interning
+    '''
+
+
+def get_deep_size(objects):
+    '''
+    approximate size in bytes of objects and everything they reference, shared objects are counted once
+    '''
+    seen = set()
+    size = 0
+    stack = list(objects)
+
+    while stack:
+        obj = stack.pop()
+
+        if id(obj) in seen or isinstance(obj, type):
+            continue
+        seen.add(id(obj))
+
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+        elif not isinstance(obj, (basestring, int, long, float, Args)):
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for class_ in obj.__class__.__mro__:
+                for slot in class_.__dict__.get('__slots__', ()):
+                    if hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+
+    return size
+
+
+def create_plain_copy(attributes):
+    plain = _PlainObject()
+    plain.__dict__.update(attributes)
+    return plain
+
+
+TEMPLATES_SOURCES = (u'[[hero|загл]] ударил [[enemy|вн]]',
+                     u'[[enemy|загл]] получает [[damage]] [{урон|damage|вн}] от [[hero|рд]]',
+                     u'[[hero|загл]] [{нашёл|hero|}] [[coins]] [{монета|coins|вн}]',
+                     u'[{тень|hero|загл,им}] [[hero|рд]] исчезает')
+
+
+def load_plain_objects(words_data, templates_data):
+    words = [create_plain_copy({'normalized': data['normalized'],
+                                      'forms': tuple(data['forms']),
+                                      'properties': tuple(data['properties'])})
+             for data in words_data]
+
+    templates = []
+    for data in templates_data:
+        template = Template.deserialize(data)
+        templates.append(create_plain_copy({'template': data['template'],
+                                                  'externals': data['externals'],
+                                                  'internals': data['internals'],
+                                                  '_external_ids': template._external_ids,
+                                                  '_parts': template._parts,
+                                                  '_slots': template._slots}))
+    return words, templates
+
+
+def load_slotted_objects(words_data, templates_data):
+    return ([WordBase.deserialize(data) for data in words_data],
+            [Template.deserialize(data) for data in templates_data])
+
+
+def benchmark_objects_memory(objects_number=5000):
+    '''
+    compare memory per word and per template loaded from json, number of objects tracked by gc
+    and full gc time for plain objects and for slotted interned objects
+
+    loaded json is dropped before measurements, so only objects, which are kept by words and templates, are counted
+    '''
+    words_json = json.dumps([word.serialize() for word in create_names_dictionary(objects_number).data.values()])
+    templates_json = json.dumps([Template.create(None, TEMPLATES_SOURCES[i % len(TEMPLATES_SOURCES)]).serialize() for i in xrange(objects_number)])
+
+    results = []
+
+    for name, load in (('plain', load_plain_objects), ('slotted', load_slotted_objects)):
+        gc.collect()
+        tracked_number = len(gc.get_objects())
+
+        # new strings for every object, as after loading from storage
+        words, templates = load(json.loads(words_json), json.loads(templates_json))
+
+        gc.collect()
+        tracked_number = len(gc.get_objects()) - tracked_number
+
+        gc_time = min(timeit.repeat(gc.collect, number=1, repeat=5))
+        results.append((name,
+                        get_deep_size(words) / float(objects_number),
+                        get_deep_size(templates) / float(objects_number),
+                        tracked_number / float(objects_number),
+                        gc_time))
+        del words, templates
+
+    return objects_number, results
+
+
+def print_objects_memory_results(results):
+    objects_number, layouts = results
+    print 'memory per object, %d words and %d templates' % (objects_number, objects_number)
+    print '%-20s %10s %10s %10s %10s' % ('layout', 'word, b', 'template, b', 'gc objects', 'gc, ms')
+    for name, word_size, template_size, tracked_number, gc_time in layouts:
+        print '%-20s %10d %10d %10.2f %10.2f' % (name, word_size, template_size, tracked_number, gc_time * 1000)
+
+
+def create_heroes_dictionary(heroes_number):
+    dictionary = create_names_dictionary(heroes_number)
+    dictionary.add_word(Verb(normalized=u'ударил', forms=[u'ударил', u'ударила', u'ударило', u'ударили'] + [u'ударяет'] * 12))
+    dictionary.add_word(Adjective(normalized=u'глупый', forms=[u'глупый'] * 24))
+    dictionary.add_word(Noun(normalized=u'монета', forms=[stem + ending for stem, ending in zip([u'монет'] * 12, NAME_ENDINGS[0])], properties=(u'жр',)))
+    return dictionary
+
+
+def benchmark_batch_render(externals_number=20000, heroes_number=100):
+    '''
+    compare rendering of one template for many externals by substitute in loop and by substitute_many
+    '''
+    dictionary = create_heroes_dictionary(heroes_number)
+    heroes = [u'гоблин%d' % i for i in xrange(heroes_number)]
+    template = Template.create(None, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый||вн}] [[enemy|вн]] и нашёл [[coins]] [{монета|coins|вн}]')
+
+    externals = [{'hero': heroes[i % len(heroes)], 'enemy': heroes[(i * 7) % len(heroes)], 'coins': i % 50}
+                 for i in xrange(externals_number)]
+
+    def by_loop():
+        for item in externals:
+            template.substitute(dictionary, item)
+
+    def by_batch():
+        template.substitute_many(dictionary, externals)
+
+    return externals_number, [('loop', min(timeit.repeat(by_loop, number=1, repeat=3)) / externals_number),
+                              ('substitute_many', min(timeit.repeat(by_batch, number=1, repeat=3)) / externals_number)]
+
+
+def print_batch_render_results(results):
+    externals_number, methods = results
+    print 'render of one template, %d externals' % externals_number
+    print '%-20s %10s' % ('method', 'usec/item')
+    for name, render_time in methods:
+        print '%-20s %10.3f' % (name, render_time * 1e6)
+
+
+def benchmark_concurrent_render(renders_number=20000, threads_number=4, heroes_number=100):
+    '''
+    render from snapshot in one and many threads, with and without writer, which publishes new dictionary every millisecond
+    '''
+    dictionary = create_heroes_dictionary(heroes_number)
+    heroes = [u'гоблин%d' % i for i in xrange(heroes_number)]
+
+    vocabulary = Vocabulary()
+    vocabulary.register_type('hit')
+    vocabulary.add_phrase('hit', Template.create(None, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый||вн}] [[enemy|вн]]'))
+    vocabulary.prerender(dictionary)
+
+    holder = SnapshotHolder(vocabulary, dictionary)
+
+    externals = [{'hero': heroes[i % len(heroes)], 'enemy': heroes[(i * 7) % len(heroes)]}
+                 for i in xrange(renders_number)]
+
+    def render(items):
+        for item in items:
+            holder.snapshot.render('hit', item)
+
+    def run(threads_number, with_writer):
+        chunk_size = len(externals) // threads_number
+        threads = [threading.Thread(target=render, args=(externals[i*chunk_size:(i+1)*chunk_size],)) for i in xrange(threads_number)]
+
+        rendered = threading.Event()
+        publications = []
+
+        def change():
+            while not rendered.is_set():
+                started_at = time.time()
+                holder.change_dictionary(lambda dictionary: None)
+                publications.append(time.time() - started_at)
+                time.sleep(0.001)
+
+        writer = threading.Thread(target=change) if with_writer else None
+
+        started_at = time.time()
+
+        if writer is not None:
+            writer.start()
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        render_time = time.time() - started_at
+
+        rendered.set()
+
+        if writer is not None:
+            writer.join()
+
+        return render_time / (chunk_size * threads_number), publications
+
+    results = []
+
+    for name, threads, with_writer in (('1 thread', 1, False),
+                                       ('%d threads' % threads_number, threads_number, False),
+                                       ('%d threads + writer' % threads_number, threads_number, True)):
+        render_time, publications = run(threads, with_writer)
+        results.append((name, render_time, len(publications), sum(publications) / len(publications) if publications else 0))
+
+    return renders_number, results
+
+
+def print_concurrent_render_results(results):
+    renders_number, methods = results
+    print 'render from snapshot, %d renders' % renders_number
+    print '%-20s %10s %14s %14s' % ('method', 'usec/item', 'publications', 'publish usec')
+    for name, render_time, publications_number, publish_time in methods:
+        print '%-20s %10.3f %14d %14.1f' % (name, render_time * 1e6, publications_number, publish_time * 1e6)
+
+
+def benchmark_numerals(numbers_number=100000):
+    '''
+    compare rendering of template with numeral for array of numbers by substitute_many and by vectorized render_numerals
+    '''
+    dictionary = create_heroes_dictionary(1)
+    template = Template.create(None, u'[[hero|загл]] нашёл [[coins]] [{монета|coins|вн}]')
+
+    numbers = vectorized.numpy.arange(numbers_number)
+    externals = [{'hero': u'гоблин0', 'coins': number} for number in numbers.tolist()]
+
+    def by_batch():
+        template.substitute_many(dictionary, externals)
+
+    def by_vectors():
+        vectorized.render_numerals(template, dictionary, numbers, 'coins', {'hero': u'гоблин0'})
+
+    return numbers_number, [('substitute_many', min(timeit.repeat(by_batch, number=1, repeat=3)) / numbers_number),
+                            ('render_numerals', min(timeit.repeat(by_vectors, number=1, repeat=3)) / numbers_number)]
+
+
+def benchmark_packed_dictionary(words_number=20000):
+    '''
+    compare number of objects, created by loading dictionary and rendering every word, and time of get_word + get_form
+    for json storage and packed binary storage (Dictionary.load_packed)
+    '''
+    dictionary = create_names_dictionary(words_number)
+
+    json_storage = tempfile.NamedTemporaryFile(delete=False).name
+    binary_storage = tempfile.NamedTemporaryFile(delete=False).name
+
+    dictionary.save(json_storage)
+    dictionary.save_binary(binary_storage)
+
+    keys = dictionary.data.keys()
+    args = Args(u'рд', u'мн')
+
+    results = []
+
+    for name, load in (('json', lambda loaded: loaded.load(json_storage)),
+                       ('packed', lambda loaded: loaded.load_packed(binary_storage))):
+        gc.collect()
+        objects_number = len(gc.get_objects())
+
+        loaded = Dictionary()
+        load(loaded)
+
+        def render():
+            for key in keys:
+                loaded.get_word(key).get_form(args)
+
+        render()
+        gc.collect()
+        objects_number = len(gc.get_objects()) - objects_number
+
+        results.append((name, objects_number, min(timeit.repeat(render, number=1, repeat=3)) / words_number))
+
+        loaded = None
+
+    os.remove(json_storage)
+    os.remove(binary_storage)
+
+    return words_number, results
+
+
+def print_packed_dictionary_results(results):
+    words_number, storages = results
+    print 'persistent objects, %d words' % words_number
+    print '%-20s %10s %10s' % ('storage', 'objects', 'usec/form')
+    for name, objects_number, form_time in storages:
+        print '%-20s %10d %10.3f' % (name, objects_number, form_time * 1e6)
+
+
+def benchmark_vocabulary_load(templates_number=20000):
+    '''
+    compare time to load vocabulary from json and to import module, generated from it (from .pyc)
+    '''
+    vocabulary = Vocabulary()
+    vocabulary.register_type('test')
+    for i in xrange(templates_number):
+        vocabulary.add_phrase('test', Template.create(None, TEMPLATES_SOURCES[i % len(TEMPLATES_SOURCES)] + u' %d' % i))
+
+    directory = tempfile.mkdtemp()
+    storage = os.path.join(directory, 'voc.json')
+    module_path = os.path.join(directory, 'compiled_voc.py')
+
+    vocabulary.save(storage)
+    codegen.generate_module(storage, module_path)
+
+    def load_json():
+        Vocabulary().load(storage)
+
+    def load_module():
+        codegen.load_module(module_path, storage)
+
+    results = [('json', min(timeit.repeat(load_json, number=1, repeat=3))),
+               ('compiled module', min(timeit.repeat(load_module, number=1, repeat=3)))]
+
+    for filename in os.listdir(directory):
+        os.remove(os.path.join(directory, filename))
+    os.rmdir(directory)
+
+    return templates_number, results
+
+
+def print_vocabulary_load_results(results):
+    templates_number, storages = results
+    print 'vocabulary load, %d templates' % templates_number
+    print '%-20s %10s' % ('storage', 'time, ms')
+    for name, load_time in storages:
+        print '%-20s %10.2f' % (name, load_time * 1000)
+
+
+if __name__ == '__main__':
+    print_get_form_results(benchmark_get_form())
+    print
+    print_dictionary_load_results(benchmark_dictionary_load())
+    print
+    print_compact_results(benchmark_compact())
+    print
+    print_packed_dictionary_results(benchmark_packed_dictionary())
+    print
+    print_objects_memory_results(benchmark_objects_memory())
+    print
+    print_batch_render_results(benchmark_batch_render())
+    print
+    print_concurrent_render_results(benchmark_concurrent_render())
+    print
+    print_vocabulary_load_results(benchmark_vocabulary_load())
+
+    if vectorized.numpy is not None:
+        print
+        print_batch_render_results(benchmark_numerals())
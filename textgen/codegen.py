@@ -0,0 +1,175 @@
+# coding: utf-8
+'''
+compile vocabulary into python module with render function for every template
+
+generated module is imported as usual python code (and cached in .pyc), so templates are not parsed on process start
+
+module contains:
+- FORMAT_VERSION - version of code generator
+- VOCABULARY_HASH - sha1 of vocabulary storage, from which module was generated
+- DICTIONARY_HASH - sha1 of dictionary storage, which forms are folded into module, or None
+- TEMPLATES - dict of phrase type -> tuple of render functions render(dictionary, externals)
+
+if dictionary storage is passed to generate_module, forms of internal words without dependences
+are written into module as text (like Template.prerender does), so module must be used only with that dictionary;
+forms of externals and of internal words, which depend on externals, are taken from dictionary on every render
+'''
+import os
+import imp
+import random
+import itertools
+import py_compile
+
+from textgen.exceptions import TextgenException
+from textgen.logic import Args, get_file_hash
+from textgen.templates import Dictionary, Vocabulary
+
+
+FORMAT_VERSION = 2
+
+
+def _generate_render_function(name, template, dictionary=None):
+    constants = {}
+
+    lines = [u'def %s(dictionary, externals):' % name]
+
+    if template._external_ids:
+        lines.append(u'    resolve = dictionary.resolve_external')
+        lines.append(u'    e = [%s]' % u', '.join(u'resolve(externals[%r])' % external_id for external_id in template._external_ids))
+
+    if dictionary is not None:
+        parts, slots = template._fold_constants(dictionary)[2:4]
+    else:
+        parts, slots = template._parts, template._slots
+
+    slots = dict((slot[0], slot) for slot in slots)
+
+    expressions = []
+    literal = u''
+
+    for position, part in enumerate(parts):
+        if part is not None:
+            literal += part
+            continue
+
+        if literal:
+            expressions.append(repr(literal))
+            literal = u''
+
+        position, external_index, internal_word, dependences, args = slots[position]
+
+        if external_index is None and not dependences:
+            # form of internal word without dependences is always the same
+            state = Args().update(*args).state
+            constants[u'A_%d' % state] = u'Args.from_state(%d)' % state
+            expressions.append(u'dictionary.get_word(%r).get_form(A_%d)' % (internal_word, state))
+        elif external_index is None:
+            expressions.append(u'substitute(dictionary.get_word(%r), EMPTY_ARGS, %r, e, %r)' % (internal_word, dependences, args))
+        else:
+            expressions.append(u'substitute(e[%d][0], e[%d][1], %r, e, %r)' % (external_index, external_index, dependences, args))
+
+    if literal:
+        expressions.append(repr(literal))
+
+    lines.append(u'    return %s' % (u' + '.join(expressions) if expressions else u"u''"))
+
+    return lines, constants
+
+
+def generate_module(storage, module_path, dict_storage=None):
+    '''
+    generate python module from vocabulary storage (see Vocabulary.save),
+    if dict_storage is passed, forms of constant internal words are taken from it
+    '''
+    vocabulary = Vocabulary()
+    vocabulary.load(storage)
+
+    dictionary = None
+    if dict_storage is not None:
+        dictionary = Dictionary()
+        dictionary.load(dict_storage)
+
+    lines = []
+    constants = {}
+    templates = []
+
+    for type_ in sorted(vocabulary.data.keys()):
+        functions = []
+
+        for template in vocabulary.data[type_]:
+            name = u'render_%d' % len(lines)
+            function_lines, function_constants = _generate_render_function(name, template, dictionary)
+            # comment must be single line, splitlines knows all line separators (\r, \x0c, \u2028, ...)
+            lines.append([u'',
+                          u'# %s' % u' '.join(template.template.splitlines())] + function_lines)
+            constants.update(function_constants)
+            functions.append(name)
+
+        templates.append((type_, functions))
+
+    header = [u'# coding: utf-8',
+              u'# generated by textgen.codegen, do not edit',
+              u'from textgen.logic import Args',
+              u'from textgen.templates import Template',
+              u'',
+              u'FORMAT_VERSION = %d' % FORMAT_VERSION,
+              u'VOCABULARY_HASH = %r' % get_file_hash(storage),
+              u'DICTIONARY_HASH = %r' % (get_file_hash(dict_storage) if dict_storage is not None else None),
+              u'',
+              u'substitute = Template._create_substitution',
+              u'EMPTY_ARGS = Args()']
+
+    header.extend(u'%s = %s' % (name, value) for name, value in sorted(constants.items()))
+
+    footer = [u'',
+              u'TEMPLATES = {']
+    footer.extend(u'    %r: (%s),' % (type_, u''.join(u'%s, ' % name for name in functions)) for type_, functions in templates)
+    footer.append(u'}')
+
+    with open(module_path, 'w') as f:
+        f.write(u'\n'.join(itertools.chain(header, itertools.chain.from_iterable(lines), footer, [u''])).encode('utf-8'))
+
+    # compile right now: .pyc stores modification time of source with precision of seconds,
+    # so old .pyc could be used after fast regeneration, and it is not written, if bytecode writing is disabled
+    py_compile.compile(module_path, doraise=True)
+
+
+def load_module(module_path, storage=None, dict_storage=None):
+    '''
+    import generated module, if storage (dict_storage) is passed, check that module was generated from it
+    '''
+    name = 'textgen_compiled_%s' % os.path.splitext(os.path.basename(module_path))[0]
+
+    module = imp.load_source(name, module_path)
+
+    if module.FORMAT_VERSION != FORMAT_VERSION:
+        raise TextgenException(u'compiled vocabulary %s has format version %s, expected %s' % (module_path, module.FORMAT_VERSION, FORMAT_VERSION))
+
+    if storage is not None and module.VOCABULARY_HASH != get_file_hash(storage):
+        raise TextgenException(u'compiled vocabulary %s is outdated, regenerate it from %s' % (module_path, storage))
+
+    if dict_storage is not None and module.DICTIONARY_HASH is not None and module.DICTIONARY_HASH != get_file_hash(dict_storage):
+        raise TextgenException(u'compiled vocabulary %s is generated for another dictionary, regenerate it with %s' % (module_path, dict_storage))
+
+    return CompiledVocabulary(module)
+
+
+class CompiledVocabulary(object):
+
+    def __init__(self, module):
+        self.module = module
+        self.data = module.TEMPLATES
+
+    def __contains__(self, type_):
+        return type_ in self.data
+
+    def get_random_renderer(self, type_, default=None):
+        if type_ in self.data and self.data[type_]:
+            return random.choice(self.data[type_])
+        return default
+
+    def render(self, dictionary, type_, externals, default=None):
+        renderer = self.get_random_renderer(type_)
+        if renderer is None:
+            return default
+        return renderer(dictionary, externals)
@@ -0,0 +1,76 @@
+# coding: utf-8
+import array
+
+from textgen.logic import efication
+
+
+def normalize_form(form):
+    return efication(form.lower()).encode('utf-8')
+
+
+class FormsIndex(object):
+    '''
+    reverse index: word form -> (dictionary key, form slot)
+
+    forms are stored sorted in single utf-8 blob with array of offsets, so index does not create object per form
+    '''
+
+    def __init__(self, dictionary_data):
+        keys = []
+        items = []
+
+        for key, word in dictionary_data.items():
+            if not word.has_forms:
+                continue
+
+            key_id = len(keys)
+            keys.append(key)
+
+            for slot, form in enumerate(word.forms):
+                items.append((normalize_form(form), key_id, slot))
+
+        items.sort()
+
+        self._keys = keys
+        self._blob = ''.join(form for form, key_id, slot in items)
+
+        self._offsets = array.array('I', [0])
+        for form, key_id, slot in items:
+            self._offsets.append(self._offsets[-1] + len(form))
+
+        self._keys_ids = array.array('I', [key_id for form, key_id, slot in items])
+        self._slots = array.array('B', [slot for form, key_id, slot in items])
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _get_form(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i+1]]
+
+    def _lower_bound(self, form):
+        low, high = 0, len(self._slots)
+
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_form(middle) < form:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def find(self, form):
+        '''
+        returns list of (dictionary key, form slot) for all words having that form
+        '''
+        form = normalize_form(form)
+
+        result = []
+
+        i = self._lower_bound(form)
+
+        while i < len(self._slots) and self._get_form(i) == form:
+            result.append((self._keys[self._keys_ids[i]], self._slots[i]))
+            i += 1
+
+        return result
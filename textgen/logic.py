@@ -3,6 +3,8 @@ import os
 import json
 import copy
 import numbers
+import hashlib
+import itertools
 
 from textgen.exceptions import NoGrammarFound, TextgenException
 
@@ -28,47 +30,117 @@ class PROPERTIES(object):
 
 
 class Args(object):
+    '''
+    immutable grammatical state, packed into integer:
 
-    __slots__ = ('case', 'number', 'gender', 'time', 'person', 'word_case')
-
-    def __init__(self, *args):
-        self.case = u'им'
-        self.number = u'ед'
-        self.gender = u'мр'
-        self.time = u'нст'
-        self.person = u'1л'
-        self.word_case = u'строч'
-        # self.case = u''
-        # self.number = u''
-        # self.gender = u''
-        # self.time = u''
-        # self.person = u''
-        self.update(*args)
+    bits 0-2 - case, bit 3 - number, bits 4-5 - gender, bits 6-7 - time, bits 8-9 - person, bit 10 - word case
+
+    instances are interned, so Args(...) with equal state always returns the same object
+    '''
+
+    __slots__ = ('state', 'case', 'number', 'gender', 'time', 'person', 'word_case')
+
+    CASES = PROPERTIES.CASES
+    NUMBERS = PROPERTIES.NUMBERS
+    GENDERS = PROPERTIES.GENDERS + (u'мн',) # gender of words existed only in multiple number
+    TIMES = PROPERTIES.TIMES
+    PERSONS = PROPERTIES.PERSONS
+    WORD_CASES = PROPERTIES.WORD_CASE
+
+    CASE = 0b111
+    NUMBER = 0b1 << 3
+    GENDER = 0b11 << 4
+    TIME = 0b11 << 6
+    PERSON = 0b11 << 8
+    WORD_CASE = 0b1 << 10
+
+    STATES_NUMBER = 1 << 11
+
+    UPDATES_CACHE_SIZE = 65536
+
+    _ARGUMENTS = {}
+    _INSTANCES = {}
+    _UPDATES = {}
+    _ORDER_POINTS = {}
+
+    def __new__(cls, *args):
+        return cls.from_state(0).update(*args)
+
+    @classmethod
+    def all(cls):
+        for indexes in itertools.product(*[xrange(len(values)) for values in (cls.CASES,
+                                                                            cls.NUMBERS,
+                                                                            cls.GENDERS,
+                                                                            cls.TIMES,
+                                                                            cls.PERSONS,
+                                                                            cls.WORD_CASES)]):
+            case, number, gender, time, person, word_case = indexes
+            yield cls.from_state(case | (number << 3) | (gender << 4) | (time << 6) | (person << 8) | (word_case << 10))
+
+    @classmethod
+    def from_state(cls, state):
+        instance = cls._INSTANCES.get(state)
+
+        if instance is None:
+            instance = object.__new__(cls)
+            set_attribute = super(Args, instance).__setattr__
+            set_attribute('state', state)
+            set_attribute('case', cls.CASES[state & cls.CASE])
+            set_attribute('number', cls.NUMBERS[(state & cls.NUMBER) >> 3])
+            set_attribute('gender', cls.GENDERS[(state & cls.GENDER) >> 4])
+            set_attribute('time', cls.TIMES[(state & cls.TIME) >> 6])
+            set_attribute('person', cls.PERSONS[(state & cls.PERSON) >> 8])
+            set_attribute('word_case', cls.WORD_CASES[(state & cls.WORD_CASE) >> 10])
+            instance = cls._INSTANCES.setdefault(state, instance)
+
+        return instance
+
+    def __setattr__(self, name, value):
+        raise TextgenException(u'Args is immutable, use update or inherit methods')
+
+    def __reduce__(self):
+        return (_args_from_state, (self.state,))
 
     def get_copy(self):
-        return self.__class__(self.case, self.number, self.gender, self.time, self.person, self.word_case)
+        return self
 
     def update(self, *args):
-        for arg in args:
-            if arg in PROPERTIES.CASES:
-                self.case = arg
-            elif arg in PROPERTIES.NUMBERS:
-                self.number = arg
-            elif arg in PROPERTIES.GENDERS:
-                self.gender = arg
-            elif arg in PROPERTIES.TIMES:
-                self.time = arg
-            elif arg in PROPERTIES.PERSONS:
-                self.person = arg
-            elif arg in PROPERTIES.WORD_CASE:
-                self.word_case = arg
-
-        # if world exists only in multiple number (ножницы) there will be 2 u'мн' values - one for gender and one for number
-        if args.count(u'мн') > 1:
-            self.gender = u'мн'
+        key = (self.state, args)
+
+        state = self._UPDATES.get(key)
+
+        if state is None:
+            state = self.state
+
+            for arg in args:
+                mask, bits = self._ARGUMENTS.get(arg, (0, 0))
+                state = (state & ~mask) | bits
+
+            # if world exists only in multiple number (ножницы) there will be 2 u'мн' values - one for gender and one for number
+            if args.count(u'мн') > 1:
+                state = (state & ~self.GENDER) | (self.GENDERS.index(u'мн') << 4)
+
+            if len(self._UPDATES) < self.UPDATES_CACHE_SIZE:
+                self._UPDATES[key] = state
+
+        return self.from_state(state)
+
+    def inherit(self, other, mask):
+        return self.from_state((self.state & ~mask) | (other.state & mask))
 
     # order: time, case, time, gender
     def order_points(self, class_):
+        key = (class_, self.state)
+
+        distance = self._ORDER_POINTS.get(key)
+
+        if distance is None:
+            distance = self._order_points(class_)
+            self._ORDER_POINTS[key] = distance
+
+        return distance
+
+    def _order_points(self, class_):
         distance = 0
 
         if class_ in (u'С',):
@@ -100,6 +172,14 @@ class Args(object):
 
         return distance
 
+    def __eq__(self, other):
+        return isinstance(other, Args) and self.state == other.state
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return self.state
 
     def __unicode__(self):
         return (u'<%s, %s, %s, %s, %s, %s>' % (self.case, self.number, self.gender, self.time, self.person, self.word_case))
@@ -107,6 +187,29 @@ class Args(object):
     def __str__(self): return self.__unicode__().encode('utf-8')
 
 
+def _args_from_state(state):
+    return Args.from_state(state)
+
+
+for _mask, _shift, _values in ((Args.CASE, 0, PROPERTIES.CASES),
+                               (Args.NUMBER, 3, PROPERTIES.NUMBERS),
+                               (Args.GENDER, 4, PROPERTIES.GENDERS),
+                               (Args.TIME, 6, PROPERTIES.TIMES),
+                               (Args.PERSON, 8, PROPERTIES.PERSONS),
+                               (Args.WORD_CASE, 10, PROPERTIES.WORD_CASE)):
+    for _i, _value in enumerate(_values):
+        Args._ARGUMENTS[_value] = (_mask, _i << _shift)
+
+
+# builtin intern does not accept unicode, so strings shared by words and templates (arguments, properties, ids) are interned here
+_INTERNED = {}
+
+def intern_unicode(string):
+    return _INTERNED.setdefault(string, string)
+
+def intern_tuple(strings):
+    return intern_unicode(tuple(intern_unicode(string) for string in strings))
+
 
 def efication(word):
     return word.replace(u'Ё', u'Е').replace(u'ё', u'е')
@@ -150,7 +253,7 @@ def get_gram_info(morph, word, tech_vocabulary={}):
         properties = Args()
 
     if normalized in tech_vocabulary:
-        properties.update(*tech_vocabulary[normalized])
+        properties = properties.update(*tech_vocabulary[normalized])
 
     # if x:
     #     print result_class, properties
@@ -160,6 +263,9 @@ def get_gram_info(morph, word, tech_vocabulary={}):
     return result_class, properties
 
 
+MANIFEST_VERSION = 1
+
+
 def get_tech_vocabulary(tech_vocabulary_path):
     tech_vocabulary = {}
     if os.path.exists(tech_vocabulary_path):
@@ -200,9 +306,234 @@ def get_user_data_for_module(module):
 
     return data
 
-def import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_storage, tmp_dir='/tmp', check=False):
-    from textgen.templates import Dictionary, Vocabulary, Template
-    from textgen.words import WordBase
+def import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_storage, tmp_dir='/tmp', check=False, morph_cache=None, jobs=1, dicts_directory=None, incremental=False, voc_shards=None, voc_module=None):
+    '''
+    morph_cache - path to persistent cache of pymorphy answers, it speeds up repeated imports
+    jobs - number of worker processes, every worker uses its own morph object, created from dicts_directory,
+           workers only read morph_cache, their new answers are saved by parent process
+    incremental - import only modules changed since previous build (see build manifest, stored next to voc_storage)
+    voc_shards - directory to save vocabulary, splitted by modules (see Vocabulary.load_shards)
+    voc_module - path to python module, generated from vocabulary and dictionary (see textgen.codegen)
+    '''
+    from textgen.morph_cache import MorphCache
+
+    if dicts_directory is None:
+        from textgen.conf import textgen_settings
+        dicts_directory = textgen_settings.PYMORPHY_DICTS_DIRECTORY
+
+    if morph_cache is None:
+        return _import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_storage, tmp_dir, check, morph_cache, jobs, dicts_directory, incremental, voc_shards, voc_module)
+
+    morph = MorphCache(morph, morph_cache, dicts_directory=dicts_directory)
+
+    try:
+        return _import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_storage, tmp_dir, check, morph_cache, jobs, dicts_directory, incremental, voc_shards, voc_module)
+    finally:
+        morph.close()
+        print 'morph cache: %d hits, %d misses' % (morph.hits, morph.misses)
+
+
+class WordsBuilder(object):
+    '''
+    creates words for import, strings already presented in dictionary are not analyzed again
+    '''
+
+    def __init__(self, morph, dictionary, tech_vocabulary):
+        from textgen.words import WordBase
+
+        self.morph = morph
+        self.dictionary = dictionary
+        self.tech_vocabulary = tech_vocabulary
+        self.create_from_string = WordBase.create_from_string
+        self.analyzed = 0
+        self.skipped = 0
+
+    def get_word(self, string):
+        key = efication(string)
+
+        if key in self.dictionary:
+            self.skipped += 1
+            return self.dictionary.data[key]
+
+        word = self.create_from_string(self.morph, string, self.tech_vocabulary)
+        self.analyzed += 1
+
+        self.dictionary.add_word(word)
+
+        return word
+
+    def rebuild_word(self, string):
+        '''
+        analyze string again and replace word in dictionary (used when its tech vocabulary entry changed)
+        '''
+        word = self.create_from_string(self.morph, string, self.tech_vocabulary)
+        self.analyzed += 1
+
+        self.dictionary.add_word(word, overwrite=True)
+
+        return word
+
+
+def _import_module(morph, texts_path, group, dictionary, tech_vocabulary):
+    '''
+    process one source module
+
+    created words are added to dictionary and returned too, so they can be merged into another dictionary
+    returns (user data, [(phrase_key, templates), ...], words, (words analyzed, analyses skipped))
+    '''
+    from textgen.templates import Template
+
+    words_builder = WordsBuilder(morph, dictionary, tech_vocabulary)
+
+    with open(texts_path) as f:
+        data = json.loads(f.read())
+
+    if group != data['prefix']:
+        raise Exception('filename MUST be equal to prefix')
+
+    for suffix in data['types']:
+        if suffix == '':
+            raise Exception('type MUST be not equal to empty string')
+
+    module_user_data = get_user_data_for_module(data)
+
+    variables_verbose = data['variables_verbose']
+
+    global_variables = data.get('variables', {})
+
+    for variable_name in global_variables.keys():
+        if not variables_verbose.get(variable_name):
+            raise Exception('no verbose name for variable "%s"' % variable_name)
+
+    types = []
+    words = []
+    used_words = set()
+
+    for suffix, type_ in sorted(data['types'].items()):
+        phrase_key = '%s_%s' % (group , suffix)
+
+        if isinstance(type_, list):
+            phrases = type_
+            local_variables = {}
+        else:
+            phrases = type_['phrases']
+            local_variables = type_.get('variables', {})
+
+        for variable_name in local_variables.keys():
+            if not variables_verbose.get(variable_name):
+                raise Exception('no verbose name for variable "%s"' % variable_name)
+
+        variables = copy.copy(global_variables)
+        variables.update(local_variables)
+
+        templates = []
+
+        for phrase in phrases:
+            template_phrase, test_phrase = phrase
+
+            template = Template.create(morph, template_phrase, available_externals=variables.keys(), tech_vocabulary=tech_vocabulary)
+
+            templates.append(template)
+
+            strings = [value for value in variables.values() if not isinstance(value, numbers.Number)]
+            strings.extend(template.get_internal_words())
+
+            for string in strings:
+                word = words_builder.get_word(string)
+                if id(word) not in used_words:
+                    used_words.add(id(word))
+                    words.append(word)
+
+            test_result = template.substitute(dictionary, variables)
+
+            test_result_normalized = efication(test_result)
+            test_phrase_normalized = efication(test_phrase)
+
+            if test_result_normalized != test_phrase_normalized:
+                msg = None
+                for i in xrange(min(len(test_result_normalized), len(test_phrase_normalized))):
+                    if test_result_normalized[i] != test_phrase_normalized[i]:
+                        msg = '''
+wrong test_render for phrase "%s"
+
+prefix: "%s"
+
+diff: %s|%s''' % (template_phrase, test_result_normalized[:i], test_result_normalized[i], test_phrase_normalized[i])
+                        break
+
+                if msg is None:
+                    msg = 'different len: "%s"|"%s"' % (test_result_normalized[i:], test_phrase_normalized[i:])
+
+                raise TextgenException(msg)
+
+        types.append((phrase_key, templates))
+
+    return module_user_data, types, words, (words_builder.analyzed, words_builder.skipped)
+
+
+_import_worker = {}
+
+def _init_import_worker(dictionary, tech_vocabulary, dicts_directory, morph_cache):
+    import pymorphy
+    from textgen.morph_cache import MorphCache
+
+    morph = pymorphy.get_morph(dicts_directory)
+
+    # only parent process writes to cache, workers return their new answers with results
+    if morph_cache is not None:
+        morph = MorphCache(morph, morph_cache, dicts_directory=dicts_directory, read_only=True)
+
+    _import_worker['morph'] = morph
+    _import_worker['dictionary'] = dictionary
+    _import_worker['tech_vocabulary'] = tech_vocabulary
+
+
+def _import_module_in_worker(arguments):
+    texts_path, group = arguments
+
+    morph = _import_worker['morph']
+
+    result = _import_module(morph, texts_path, group, _import_worker['dictionary'], _import_worker['tech_vocabulary'])
+
+    return result, morph.pop_new_answers() if hasattr(morph, 'pop_new_answers') else {}
+
+
+def get_manifest_path(voc_storage):
+    return '%s.manifest' % voc_storage
+
+
+def get_file_hash(path):
+    with open(path) as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_tech_vocabulary_hashes(tech_vocabulary):
+    return dict((efication(word.lower()), hashlib.sha1(u','.join(entry).encode('utf-8')).hexdigest())
+                for word, entry in tech_vocabulary.items())
+
+
+def get_words_keys(words):
+    return sorted(set(efication(part.lower())
+                      for word in words
+                      for part in word.normalized.split(' ')
+                      if part))
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.loads(f.read())
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    return manifest
+
+
+def _import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_storage, tmp_dir, check, morph_cache, jobs, dicts_directory, incremental, voc_shards, voc_module):
+    from textgen.templates import Dictionary, Vocabulary
 
     vocabulary = Vocabulary()
 
@@ -218,11 +549,17 @@ def import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_stor
 
     tech_vocabulary = get_tech_vocabulary(tech_vocabulary_path)
 
-    for word in tech_vocabulary.keys():
-        word = WordBase.create_from_string(morph, word.strip(), tech_vocabulary)
-        dictionary.add_word(word)
+    words_builder = WordsBuilder(morph, dictionary, tech_vocabulary)
 
-    for filename in os.listdir(source_dir):
+    for word in sorted(tech_vocabulary.keys()):
+        words_builder.get_word(word.strip())
+
+    words_analyzed = words_builder.analyzed
+    analyses_skipped = words_builder.skipped
+
+    modules = []
+
+    for filename in sorted(os.listdir(source_dir)):
 
         if not filename.endswith('.json'):
             continue
@@ -241,92 +578,114 @@ def import_texts(morph, source_dir, tech_vocabulary_path, voc_storage, dict_stor
                 print 'group "%s" has been already processed' % group
                 continue
 
-        print 'load "%s"' % group
-
-        with open(texts_path) as f:
-            data = json.loads(f.read())
-
-            if group != data['prefix']:
-                raise Exception('filename MUST be equal to prefix')
-
-            for suffix in data['types']:
-                if suffix == '':
-                    raise Exception('type MUST be not equal to empty string')
-
-            user_data['modules'][data['prefix']] = get_user_data_for_module(data)
-
-            variables_verbose = data['variables_verbose']
+        modules.append((texts_path, group))
 
-            global_variables = data.get('variables', {})
+    manifest = {'version': MANIFEST_VERSION,
+                'tech_vocabulary': get_tech_vocabulary_hashes(tech_vocabulary),
+                'modules': {}}
 
-            for variable_name in global_variables.keys():
-                if not variables_verbose.get(variable_name):
-                    raise Exception('no verbose name for variable "%s"' % variable_name)
+    modules_hashes = dict((group, get_file_hash(texts_path)) for texts_path, group in modules)
 
-            for suffix, type_ in data['types'].items():
-                phrase_key = '%s_%s' % (group , suffix)
+    if incremental and not check:
+        previous_manifest = None
 
-                vocabulary.register_type(phrase_key)
-
-                if isinstance(type_, list):
-                    phrases = type_
-                    local_variables = {}
-                else:
-                    phrases = type_['phrases']
-                    local_variables = type_.get('variables', {})
-
-                for variable_name in local_variables.keys():
-                    if not variables_verbose.get(variable_name):
-                        raise Exception('no verbose name for variable "%s"' % variable_name)
-
-                variables = copy.copy(global_variables)
-                variables.update(local_variables)
-
-                for phrase in phrases:
-                    template_phrase, test_phrase = phrase
-
-                    template = Template.create(morph, template_phrase, available_externals=variables.keys(), tech_vocabulary=tech_vocabulary)
-
-                    vocabulary.add_phrase(phrase_key, template)
-
-                    for value in variables.values():
-                        if isinstance(value, numbers.Number):
-                            continue
-                        word = WordBase.create_from_string(morph, value, tech_vocabulary)
-                        dictionary.add_word(word)
-
-                    for string in template.get_internal_words():
-                        word = WordBase.create_from_string(morph, string, tech_vocabulary)
-                        dictionary.add_word(word)
+        if os.path.exists(voc_storage):
+            previous_manifest = load_manifest(get_manifest_path(voc_storage))
+
+        if previous_manifest is None:
+            vocabulary.clear()
+            previous_manifest = {'tech_vocabulary': {}, 'modules': {}}
+
+        changed_tech_words = set(word
+                                 for word in set(previous_manifest['tech_vocabulary']) | set(manifest['tech_vocabulary'])
+                                 if previous_manifest['tech_vocabulary'].get(word) != manifest['tech_vocabulary'].get(word))
+
+        # dictionary stores analysis made with previous entries, so all words containing changed words
+        # (in any case, noun groups too) are analyzed again from their original spelling
+        for key in sorted(dictionary.data.keys()):
+            if changed_tech_words & set(efication(part.lower()) for part in key.split(' ') if part):
+                words_builder.rebuild_word(dictionary.data[key].normalized)
+
+        words_analyzed = words_builder.analyzed
+
+        for group, module_info in previous_manifest['modules'].items():
+            if (modules_hashes.get(group) == module_info['hash'] and
+                not changed_tech_words & set(module_info['words'])):
+                manifest['modules'][group] = module_info
+                for type_ in module_info['types']:
+                    vocabulary.shards[type_] = group
+                continue
 
-                    test_result = template.substitute(dictionary, variables)
+            # module changed or deleted
+            for type_ in module_info['types']:
+                vocabulary.remove_type(type_)
+
+        for texts_path, group in modules:
+            if group in manifest['modules']:
+                print 'group "%s" has not been changed' % group
+                with open(texts_path) as f:
+                    user_data['modules'][group] = get_user_data_for_module(json.loads(f.read()))
+
+        modules = [(texts_path, group) for texts_path, group in modules if group not in manifest['modules']]
+
+    if jobs > 1 and len(modules) > 1:
+        import multiprocessing
+
+        pool = multiprocessing.Pool(min(jobs, len(modules)),
+                                    initializer=_init_import_worker,
+                                    initargs=(dictionary, tech_vocabulary, dicts_directory, morph_cache))
+        try:
+            results = []
+            for result, morph_answers in pool.imap(_import_module_in_worker, modules, chunksize=1):
+                if morph_answers:
+                    morph.add_answers(morph_answers)
+                results.append(result)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = (_import_module(morph, texts_path, group, dictionary, tech_vocabulary) for texts_path, group in modules)
+
+    # results are merged in modules order, so output does not depend on number of jobs
+    for (texts_path, group), (module_user_data, types, words, words_statistics) in itertools.izip(modules, results):
 
-                    test_result_normalized = efication(test_result)
-                    test_phrase_normalized = efication(test_phrase)
+        print 'load "%s"' % group
 
-                    if test_result_normalized != test_phrase_normalized:
-                        msg = None
-                        for i in xrange(min(len(test_result_normalized), len(test_phrase_normalized))):
-                            if test_result_normalized[i] != test_phrase_normalized[i]:
-                                msg = '''
-wrong test_render for phrase "%s"
+        user_data['modules'][group] = module_user_data
 
-prefix: "%s"
+        for phrase_key, templates in types:
+            vocabulary.register_type(phrase_key, shard=group)
+            for template in templates:
+                vocabulary.add_phrase(phrase_key, template)
 
-diff: %s|%s''' % (template_phrase, test_result_normalized[:i], test_result_normalized[i], test_phrase_normalized[i])
-                                break
+        for word in words:
+            dictionary.add_word(word)
 
-                        if msg is None:
-                            msg = 'different len: "%s"|"%s"' % (test_result_normalized[i:], test_phrase_normalized[i:])
+        words_analyzed += words_statistics[0]
+        analyses_skipped += words_statistics[1]
 
-                        raise TextgenException(msg)
+        manifest['modules'][group] = {'hash': modules_hashes[group],
+                                      'types': [phrase_key for phrase_key, templates in types],
+                                      'words': get_words_keys(words)}
 
         if check:
-            with open(check_path, 'w') as f:
+            with open(os.path.join(tmp_dir, 'textgen-files-check-'+os.path.basename(texts_path)), 'w') as f:
                 f.write('1')
 
+    print 'words analyzed: %d, analyses skipped: %d' % (words_analyzed, analyses_skipped)
+
     if not check:
         vocabulary.save(storage=voc_storage)
         dictionary.save(storage=dict_storage)
 
+        if voc_shards is not None:
+            vocabulary.save_shards(voc_shards)
+
+        if voc_module is not None:
+            from textgen.codegen import generate_module
+            generate_module(voc_storage, voc_module, dict_storage=dict_storage)
+
+        with open(get_manifest_path(voc_storage), 'w') as f:
+            f.write(json.dumps(manifest, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8'))
+
     return user_data
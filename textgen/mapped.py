@@ -0,0 +1,298 @@
+# coding: utf-8
+'''
+binary dictionary storage, opened with mmap
+
+layout (little-endian):
+
+- header: magic, version, words number, strings number, strings offsets position, strings blob position,
+          hash table position, hash table size
+- index: (key string id, record position) for every word, sorted by utf-8 bytes of key
+- records: type, normalized string id, forms number, properties number, forms and properties string ids
+- strings offsets: positions of strings in blob (strings number + 1 values)
+- strings blob: utf-8 encoded strings, every unique string stored once
+- hash table: open addressing table of index item number + 1 (0 - empty slot), slot is crc32 of utf-8 key
+'''
+import mmap
+import zlib
+import struct
+
+from textgen.exceptions import TextgenException
+from textgen.logic import intern_tuple
+from textgen.words import WordBase, WORD_CONSTRUCTORS
+
+
+MAGIC = 'TGDICT'
+VERSION = 2
+
+HEADER = struct.Struct('<6sHIIIIII')
+INDEX_ITEM = struct.Struct('<II')
+RECORD = struct.Struct('<BIHB')
+STRING_ID = struct.Struct('<I')
+
+
+def get_key_hash(encoded_key):
+    return zlib.crc32(encoded_key) & 0xffffffff
+
+
+def save_dictionary(data, storage):
+    '''
+    data - dict of normalized key -> word (Dictionary.data)
+    '''
+    strings = {}
+    strings_list = []
+
+    def string_id(string):
+        if string not in strings:
+            strings[string] = len(strings_list)
+            strings_list.append(string)
+        return strings[string]
+
+    items = sorted(data.items(), key=lambda item: item[0].encode('utf-8'))
+
+    records = []
+    for key, word in items:
+        records.append((string_id(key),
+                        word.TYPE,
+                        string_id(word.normalized),
+                        [string_id(form) for form in word.forms],
+                        [string_id(property_) for property_ in word.properties]))
+
+    index_position = HEADER.size
+    records_position = index_position + INDEX_ITEM.size * len(records)
+
+    index = []
+    records_data = []
+    position = records_position
+
+    for key_id, type_, normalized_id, forms_ids, properties_ids in records:
+        index.append(INDEX_ITEM.pack(key_id, position))
+        record = RECORD.pack(type_, normalized_id, len(forms_ids), len(properties_ids))
+        record += struct.pack('<%dI' % (len(forms_ids) + len(properties_ids)), *(forms_ids + properties_ids))
+        records_data.append(record)
+        position += len(record)
+
+    strings_offsets_position = position
+
+    encoded_strings = [string.encode('utf-8') for string in strings_list]
+    offsets = [0]
+    for encoded in encoded_strings:
+        offsets.append(offsets[-1] + len(encoded))
+
+    blob_position = strings_offsets_position + STRING_ID.size * len(offsets)
+
+    hash_table_position = blob_position + offsets[-1]
+    hash_table_size = 1
+    while hash_table_size < len(records) * 2:
+        hash_table_size *= 2
+
+    hash_table = [0] * hash_table_size
+    for i, (key_id, type_, normalized_id, forms_ids, properties_ids) in enumerate(records):
+        slot = get_key_hash(encoded_strings[key_id]) & (hash_table_size - 1)
+        while hash_table[slot]:
+            slot = (slot + 1) & (hash_table_size - 1)
+        hash_table[slot] = i + 1
+
+    with open(storage, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(records), len(strings_list), strings_offsets_position, blob_position,
+                            hash_table_position, hash_table_size))
+        f.write(''.join(index))
+        f.write(''.join(records_data))
+        f.write(struct.pack('<%dI' % len(offsets), *offsets))
+        f.write(''.join(encoded_strings))
+        f.write(struct.pack('<%dI' % hash_table_size, *hash_table))
+
+
+class PackedForms(object):
+    '''
+    read-only sequence of forms, decoded from buffer on every access
+    '''
+
+    __slots__ = ('_words', '_position', '_number')
+
+    def __init__(self, words, position, number):
+        self._words = words
+        self._position = position
+        self._number = number
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index < 0:
+            index += self._number
+        if not 0 <= index < self._number:
+            raise IndexError(index)
+        return self._words._get_string(STRING_ID.unpack_from(self._words._buffer, self._position + STRING_ID.size * index)[0])
+
+    def __len__(self):
+        return self._number
+
+    def __iter__(self):
+        for i in xrange(self._number):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (tuple, list, PackedForms)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+
+class MappedWords(object):
+    '''
+    read-only mapping of normalized key -> word over binary storage
+
+    words are created on first access and cached, words added after loading are stored in memory
+
+    if cache_words is False, words are not cached and their forms are decoded from buffer on every access,
+    so after fork all processes share buffer pages and do not create persistent objects for words (see Dictionary.load_packed)
+
+    in_memory - read storage into bytes string instead of mmap
+    '''
+
+    def __init__(self, storage, cache_words=True, in_memory=False):
+        self.cache_words = cache_words
+
+        with open(storage, 'rb') as f:
+            if in_memory:
+                self._buffer = f.read()
+            else:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self._words_number, strings_number, self._strings_offsets_position, self._blob_position,
+         self._hash_table_position, self._hash_table_size) = HEADER.unpack_from(self._buffer, 0)
+
+        if magic != MAGIC or version != VERSION:
+            raise TextgenException(u'wrong binary dictionary format: %s' % storage)
+
+        self._words = {}
+        self._added = {}
+        self._properties = {}
+
+    def _get_string_bytes(self, string_id):
+        start, end = struct.unpack_from('<II', self._buffer, self._strings_offsets_position + STRING_ID.size * string_id)
+        return self._buffer[self._blob_position + start:self._blob_position + end]
+
+    def _get_string(self, string_id):
+        return self._get_string_bytes(string_id).decode('utf-8')
+
+    def _get_index_item(self, i):
+        return INDEX_ITEM.unpack_from(self._buffer, HEADER.size + INDEX_ITEM.size * i)
+
+    def _find(self, key):
+        encoded_key = key.encode('utf-8')
+
+        mask = self._hash_table_size - 1
+        slot = get_key_hash(encoded_key) & mask
+
+        while True:
+            item = STRING_ID.unpack_from(self._buffer, self._hash_table_position + STRING_ID.size * slot)[0]
+
+            if item == 0:
+                return None
+
+            key_id, record_position = self._get_index_item(item - 1)
+
+            if self._get_string_bytes(key_id) == encoded_key:
+                return record_position
+
+            slot = (slot + 1) & mask
+
+    def _create_word(self, record_position):
+        type_, normalized_id, forms_number, properties_number = RECORD.unpack_from(self._buffer, record_position)
+        ids_position = record_position + RECORD.size
+
+        if not self.cache_words:
+            properties_ids = struct.unpack_from('<%dI' % properties_number, self._buffer, ids_position + STRING_ID.size * forms_number)
+
+            # there are few different combinations of properties, so they are decoded once
+            properties = self._properties.get(properties_ids)
+            if properties is None:
+                properties = intern_tuple(self._get_string(string_id) for string_id in properties_ids)
+                self._properties[properties_ids] = properties
+
+            word = object.__new__(WORD_CONSTRUCTORS[type_])
+            word.normalized = self._get_string(normalized_id)
+            word.forms = PackedForms(self, ids_position, forms_number) if forms_number else ()
+            word.properties = properties
+            word._identity = None
+            return word
+
+        ids = struct.unpack_from('<%dI' % (forms_number + properties_number), self._buffer, ids_position)
+        return WordBase.deserialize({'type': type_,
+                                     'normalized': self._get_string(normalized_id),
+                                     'forms': [self._get_string(string_id) for string_id in ids[:forms_number]],
+                                     'properties': [self._get_string(string_id) for string_id in ids[forms_number:]]})
+
+    def get(self, key, default=None):
+        if key in self._added:
+            return self._added[key]
+
+        if key in self._words:
+            return self._words[key]
+
+        record_position = self._find(key)
+
+        if record_position is None:
+            return default
+
+        word = self._create_word(record_position)
+
+        if self.cache_words:
+            self._words[key] = word
+
+        return word
+
+    def copy(self):
+        '''
+        mapping over the same buffer, words added to copy do not affect original
+        '''
+        words = object.__new__(MappedWords)
+        words.__dict__.update(self.__dict__)
+        words._added = dict(self._added)
+        return words
+
+    def __getitem__(self, key):
+        word = self.get(key)
+        if word is None:
+            raise KeyError(key)
+        return word
+
+    def __setitem__(self, key, word):
+        self._added[key] = word
+
+    def __contains__(self, key):
+        return key in self._added or key in self._words or self._find(key) is not None
+
+    def _mapped_keys(self):
+        for i in xrange(self._words_number):
+            key_id, record_position = self._get_index_item(i)
+            yield self._get_string(key_id)
+
+    def keys(self):
+        keys = [key for key in self._mapped_keys() if key not in self._added]
+        keys.extend(self._added.keys())
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    @property
+    def materialized_number(self):
+        return len(self._words)
@@ -0,0 +1,146 @@
+# coding: utf-8
+import os
+import json
+import hashlib
+import sqlite3
+
+from textgen.conf import textgen_settings
+from textgen.cache import LRUCache
+
+
+# marks missed keys, because None can be cached answer
+MISSED = object()
+
+
+def get_dicts_fingerprint(dicts_directory):
+    '''
+    identify pymorphy dictionaries by names, sizes and modification times of their files
+    '''
+    fingerprint = hashlib.sha1()
+
+    for filename in sorted(os.listdir(dicts_directory)):
+        path = os.path.join(dicts_directory, filename)
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        fingerprint.update('%s|%d|%d\n' % (filename, stat.st_size, int(stat.st_mtime)))
+
+    return fingerprint.hexdigest()
+
+
+class MorphCache(object):
+    '''
+    persistent cache of pymorphy answers
+
+    wraps morph object and has the same get_graminfo & inflect_ru interface,
+    answers are stored in sqlite database and are dropped when cache version or pymorphy dictionaries changed
+
+    tech vocabulary is applied to cached answers in get_gram_info, so it is not a part of cache key
+
+    read_only cache does not write to storage, so many processes can use single storage:
+    new answers are taken from them by pop_new_answers and saved by one writer (see add_answers)
+    '''
+
+    VERSION = 1
+
+    # recently used answers are kept in memory, other repeated lookups are served by sqlite
+    ANSWERS_CACHE_SIZE = 10000
+
+    def __init__(self, morph, storage, dicts_directory=None, read_only=False):
+        if dicts_directory is None:
+            dicts_directory = textgen_settings.PYMORPHY_DICTS_DIRECTORY
+
+        self.morph = morph
+        self.storage = storage
+        self.fingerprint = u'%d|%s' % (self.VERSION, get_dicts_fingerprint(dicts_directory))
+
+        self.read_only = read_only
+
+        self.hits = 0
+        self.misses = 0
+
+        self._answers = LRUCache(self.ANSWERS_CACHE_SIZE)
+        self._new_answers = {}
+
+        self._connection = sqlite3.connect(storage)
+
+        if read_only:
+            try:
+                row = self._connection.execute('SELECT value FROM meta WHERE key = ?', ('fingerprint',)).fetchone()
+            except sqlite3.OperationalError: # storage is not created yet
+                row = None
+
+            # answers for other dictionaries must not be used, but read only cache can not drop them
+            self._storage_is_valid = row is not None and row[0] == self.fingerprint
+            return
+
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, value TEXT)')
+
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?', ('fingerprint',)).fetchone()
+
+        if row is None or row[0] != self.fingerprint:
+            self._connection.execute('DELETE FROM answers')
+            self._connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('fingerprint', self.fingerprint))
+            self._connection.commit()
+
+        self._storage_is_valid = True
+
+    def _get(self, key, calculate):
+        answer = self._answers.get(key, MISSED)
+
+        if answer is MISSED:
+            answer = self._new_answers.get(key, MISSED)
+
+        if answer is MISSED and self._storage_is_valid:
+            row = self._connection.execute('SELECT value FROM answers WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                answer = json.loads(row[0])
+
+        if answer is MISSED:
+            self.misses += 1
+            answer = calculate()
+            self._new_answers[key] = answer
+        else:
+            self.hits += 1
+
+        self._answers.set(key, answer)
+
+        return answer
+
+    def get_graminfo(self, word):
+        return self._get(u'graminfo|%s' % word,
+                         lambda: [{'class': info['class'], 'info': info['info'], 'norm': info['norm']}
+                                  for info in self.morph.get_graminfo(word)])
+
+    def inflect_ru(self, word, gram_form, gram_class=None):
+        return self._get(u'inflect|%s|%s|%s' % (word, gram_form, gram_class or u''),
+                         lambda: self.morph.inflect_ru(word, gram_form, gram_class))
+
+    def pop_new_answers(self):
+        '''
+        returns answers, which are not saved yet, and forgets them
+        '''
+        answers = self._new_answers
+        self._new_answers = {}
+        return answers
+
+    def add_answers(self, answers):
+        '''
+        add answers, got from another cache (see pop_new_answers), they are written on save
+        '''
+        self._new_answers.update(answers)
+
+    def save(self):
+        if self.read_only:
+            return
+
+        if self._new_answers:
+            self._connection.executemany('INSERT OR REPLACE INTO answers (key, value) VALUES (?, ?)',
+                                         [(key, json.dumps(answer, ensure_ascii=False)) for key, answer in self._new_answers.items()])
+            self._connection.commit()
+            self._new_answers = {}
+
+    def close(self):
+        self.save()
+        self._connection.close()
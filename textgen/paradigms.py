@@ -0,0 +1,100 @@
+# coding: utf-8
+'''
+compact storage of word forms: common stem + table of endings
+
+endings tables are interned in ParadigmsTable, so words with same inflection share single table
+'''
+
+
+class Paradigm(object):
+    '''
+    read-only sequence of forms, used instead of forms tuple
+    '''
+
+    __slots__ = ('stem', 'endings')
+
+    def __init__(self, stem, endings):
+        self.stem = stem
+        self.endings = endings
+
+    def __getstate__(self):
+        return (self.stem, self.endings)
+
+    def __setstate__(self, state):
+        self.stem, self.endings = state
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self.stem + ending for ending in self.endings[index])
+        return self.stem + self.endings[index]
+
+    def __len__(self):
+        return len(self.endings)
+
+    def __iter__(self):
+        stem = self.stem
+        for ending in self.endings:
+            yield stem + ending
+
+    def __eq__(self, other):
+        if isinstance(other, Paradigm):
+            return self.stem == other.stem and self.endings == other.endings
+        if isinstance(other, (tuple, list)):
+            return tuple(self) == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return 'Paradigm(%r, %r)' % (self.stem, self.endings)
+
+
+def get_stem(forms):
+    stem = forms[0]
+
+    for form in forms[1:]:
+        i = 0
+        length = min(len(stem), len(form))
+        while i < length and stem[i] == form[i]:
+            i += 1
+        stem = stem[:i]
+
+        if not stem:
+            break
+
+    return stem
+
+
+class ParadigmsTable(object):
+
+    def __init__(self):
+        self._endings = {}
+        self._tables = {}
+
+    def _intern_ending(self, ending):
+        return self._endings.setdefault(ending, ending)
+
+    def get_paradigm(self, forms):
+        '''
+        returns Paradigm for forms or forms itself, if there is nothing to compact
+        '''
+        if not forms or isinstance(forms, Paradigm):
+            return forms
+
+        stem = get_stem(forms)
+
+        endings = tuple(self._intern_ending(form[len(stem):]) for form in forms)
+        endings = self._tables.setdefault(endings, endings)
+
+        return Paradigm(stem, endings)
+
+    @property
+    def tables_number(self):
+        return len(self._tables)
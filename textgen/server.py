@@ -0,0 +1,392 @@
+# coding: utf-8
+'''
+render service: vocabulary and dictionary are loaded once and shared by all clients
+
+protocol: every message is 4-byte big-endian length followed by utf-8 json object
+request: {"id": <any>, "method": <name>, ...arguments}
+response: {"id": <request id>, "result": <value>} or {"id": <request id>, "error": <message>}
+
+responses to requests from one connection are sent in order of requests, so client can send many requests before reading responses (pipelining)
+
+methods:
+- render: type, externals, default - random phrase of type
+- render_many: type, externals_list, default - random phrase for every externals, big batches are rendered in process pool
+- render_sequence: types, externals, overrides, default - see Vocabulary.render_sequence
+- stats: latency percentiles of every method
+
+run: python -m textgen.server --vocabulary voc.json --dictionary dict.json --unix /tmp/textgen.sock
+'''
+import os
+import json
+import time
+import socket
+import struct
+import threading
+import collections
+import SocketServer
+
+from textgen.exceptions import TextgenException
+from textgen.templates import Dictionary, Vocabulary
+
+
+HEADER = struct.Struct('>I')
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+def send_message(sock, data):
+    message = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    sock.sendall(HEADER.pack(len(message)) + message)
+
+
+def _receive_exactly(sock_file, size):
+    data = sock_file.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def receive_message(sock_file):
+    '''
+    returns None if connection closed
+    '''
+    header = _receive_exactly(sock_file, HEADER.size)
+    if header is None:
+        return None
+
+    size = HEADER.unpack(header)[0]
+
+    if size > MAX_MESSAGE_SIZE:
+        raise TextgenException(u'message is too big: %d bytes' % size)
+
+    data = _receive_exactly(sock_file, size)
+    if data is None:
+        return None
+
+    return json.loads(data.decode('utf-8'))
+
+
+def format_error(error):
+    '''
+    TextgenException.__str__ returns utf-8 bytes, so unicode(error) fails for not ascii messages
+    '''
+    try:
+        message = unicode(error)
+    except UnicodeError:
+        message = str(error).decode('utf-8', 'replace')
+    return u'%s: %s' % (error.__class__.__name__, message)
+
+
+def prepair_externals(externals):
+    '''
+    json has no tuples, so [word, arguments] pairs are converted back to tuples
+    '''
+    return dict((external_id, tuple(external) if isinstance(external, list) else external)
+                for external_id, external in externals.items())
+
+
+class LatencyStats(object):
+    '''
+    latencies of last requests for every method
+    '''
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._latencies = {}
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, method, latency):
+        with self._lock:
+            if method not in self._latencies:
+                self._latencies[method] = collections.deque(maxlen=self.size)
+            self._latencies[method].append(latency)
+            self._counts[method] += 1
+
+    @staticmethod
+    def get_percentile(sorted_values, percentile):
+        index = int(round(percentile / 100.0 * (len(sorted_values) - 1)))
+        return sorted_values[index]
+
+    def get_stats(self, percentiles=(50, 90, 99)):
+        with self._lock:
+            latencies = dict((method, sorted(values)) for method, values in self._latencies.items())
+            counts = dict(self._counts)
+
+        return dict((method, {'count': counts[method],
+                              'percentiles': dict(('p%d' % percentile, self.get_percentile(values, percentile) * 1000)
+                                                  for percentile in percentiles)})
+                    for method, values in latencies.items())
+
+
+_worker_vocabulary = None
+_worker_dictionary = None
+
+
+def _init_render_worker(voc_storage, dict_storage):
+    global _worker_vocabulary, _worker_dictionary
+
+    _worker_vocabulary = Vocabulary()
+    _worker_vocabulary.load(voc_storage)
+
+    _worker_dictionary = Dictionary()
+    _worker_dictionary.load(dict_storage)
+
+
+def _render_in_worker(arguments):
+    type_, externals_list, default = arguments
+    return _worker_vocabulary.render_many(_worker_dictionary, type_, [prepair_externals(externals) for externals in externals_list], default)
+
+
+class RenderService(object):
+    '''
+    executes requests, independent from transport
+    '''
+
+    POOL_BATCH_SIZE = 1000
+
+    def __init__(self, voc_storage, dict_storage, processes=0):
+        self.voc_storage = voc_storage
+        self.dict_storage = dict_storage
+
+        self.vocabulary = Vocabulary()
+        self.vocabulary.load(voc_storage)
+
+        self.dictionary = Dictionary()
+        self.dictionary.load(dict_storage)
+
+        self.stats = LatencyStats()
+
+        self.pool = None
+
+        if processes:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(voc_storage, dict_storage))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def render(self, type_, externals, default=None):
+        template = self.vocabulary.get_random_phrase(type_)
+        if template is None:
+            return default
+        return template.substitute(self.dictionary, prepair_externals(externals))
+
+    def render_many(self, type_, externals_list, default=None):
+        if self.pool is None or len(externals_list) < self.POOL_BATCH_SIZE:
+            return self.vocabulary.render_many(self.dictionary, type_, [prepair_externals(externals) for externals in externals_list], default)
+
+        chunks = [(type_, externals_list[i:i+self.POOL_BATCH_SIZE], default)
+                  for i in xrange(0, len(externals_list), self.POOL_BATCH_SIZE)]
+
+        result = []
+        for chunk_result in self.pool.map(_render_in_worker, chunks):
+            result.extend(chunk_result)
+        return result
+
+    def render_sequence(self, types, externals, overrides=None, default=None):
+        if overrides is not None:
+            overrides = [prepair_externals(step_overrides) if step_overrides else None for step_overrides in overrides]
+        return self.vocabulary.render_sequence(self.dictionary, types, prepair_externals(externals), overrides, default)
+
+    def get_stats(self):
+        return self.stats.get_stats()
+
+    METHODS = {'render': lambda service, request: service.render(request['type'], request.get('externals', {}), request.get('default')),
+               'render_many': lambda service, request: service.render_many(request['type'], request['externals_list'], request.get('default')),
+               'render_sequence': lambda service, request: service.render_sequence(request['types'],
+                                                                                   request.get('externals', {}),
+                                                                                   request.get('overrides'),
+                                                                                   request.get('default')),
+               'stats': lambda service, request: service.get_stats()}
+
+    def process(self, request):
+        started_at = time.time()
+
+        method = request.get('method')
+
+        try:
+            if method not in self.METHODS:
+                raise TextgenException(u'unknown method: %s' % method)
+            response = {'id': request.get('id'), 'result': self.METHODS[method](self, request)}
+        except Exception, e:
+            response = {'id': request.get('id'), 'error': format_error(e)}
+
+        self.stats.add(method, time.time() - started_at)
+
+        return response
+
+
+class RenderRequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            try:
+                request = receive_message(self.rfile)
+            except (TextgenException, ValueError), e:
+                send_message(self.request, {'id': None, 'error': format_error(e)})
+                return
+
+            if request is None:
+                return
+
+            send_message(self.request, self.server.service.process(request))
+
+
+class TCPRenderServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service):
+        self.service = service
+        SocketServer.TCPServer.__init__(self, address, RenderRequestHandler)
+
+
+class UnixRenderServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, address, service):
+        self.service = service
+        if os.path.exists(address):
+            os.remove(address)
+        SocketServer.UnixStreamServer.__init__(self, address, RenderRequestHandler)
+
+
+def create_server(address, service):
+    '''
+    address - path of unix socket or (host, port) tuple
+    '''
+    if isinstance(address, basestring):
+        return UnixRenderServer(address, service)
+    return TCPRenderServer(address, service)
+
+
+class RenderClient(object):
+    '''
+    client is not thread-safe, use one client per thread
+    '''
+
+    def __init__(self, address, timeout=None):
+        if isinstance(address, basestring):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+        self._file = self._socket.makefile('rb')
+        self._next_id = 0
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def _create_request(self, method, **kwargs):
+        self._next_id += 1
+        kwargs.update({'id': self._next_id, 'method': method})
+        return kwargs
+
+    def _receive(self, request_id):
+        response = receive_message(self._file)
+
+        if response is None:
+            raise TextgenException(u'connection closed by server')
+
+        return self._get_result(response, request_id)
+
+    @staticmethod
+    def _get_result(response, request_id):
+        if response['id'] != request_id:
+            raise TextgenException(u'wrong response id: %r, expected %r' % (response['id'], request_id))
+
+        if 'error' in response:
+            raise TextgenException(response['error'])
+
+        return response['result']
+
+    def call(self, method, **kwargs):
+        request = self._create_request(method, **kwargs)
+        send_message(self._socket, request)
+        return self._receive(request['id'])
+
+    def pipeline(self, calls):
+        '''
+        calls - list of (method, kwargs), requests are sent without waiting for responses
+
+        responses are read by separate thread while requests are sent: server processes requests of connection one by one,
+        so if nobody reads responses, they fill socket buffers, server stops reading requests and both sides block
+        '''
+        requests = [self._create_request(method, **kwargs) for method, kwargs in calls]
+
+        responses = []
+        errors = []
+
+        def receive():
+            try:
+                for request in requests:
+                    response = receive_message(self._file)
+                    if response is None:
+                        break
+                    responses.append(response)
+            except Exception, e:
+                errors.append(e)
+
+        reader = threading.Thread(target=receive)
+        reader.daemon = True
+        reader.start()
+
+        try:
+            for request in requests:
+                send_message(self._socket, request)
+        finally:
+            reader.join()
+
+        if errors:
+            raise errors[0]
+
+        if len(responses) < len(requests):
+            raise TextgenException(u'connection closed by server')
+
+        return [self._get_result(response, request['id']) for response, request in zip(responses, requests)]
+
+    def render(self, type_, externals, default=None):
+        return self.call('render', type=type_, externals=externals, default=default)
+
+    def render_many(self, type_, externals_list, default=None):
+        return self.call('render_many', type=type_, externals_list=externals_list, default=default)
+
+    def render_sequence(self, types, externals, overrides=None, default=None):
+        return self.call('render_sequence', types=types, externals=externals, overrides=overrides, default=default)
+
+    def stats(self):
+        return self.call('stats')
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='textgen render server')
+    parser.add_argument('--vocabulary', required=True, help='vocabulary storage')
+    parser.add_argument('--dictionary', required=True, help='dictionary storage')
+    parser.add_argument('--unix', help='path to unix socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--processes', type=int, default=0, help='size of process pool for big batches')
+
+    arguments = parser.parse_args()
+
+    service = RenderService(arguments.vocabulary, arguments.dictionary, processes=arguments.processes)
+
+    server = create_server(arguments.unix or (arguments.host, arguments.port), service)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# coding: utf-8
+'''
+concurrency model
+
+loaded vocabulary and dictionary are published as immutable snapshot (both are frozen, see Vocabulary.freeze and Dictionary.freeze),
+any number of threads render against snapshot without locks: words and templates are not changed after creation,
+and internal caches (template variants, resolved externals) are replaced by single assignment,
+so concurrent renders can only compute the same value twice
+
+snapshots share templates only while they share dictionary: if vocabulary is prerendered,
+its templates are copied and prerendered for new dictionary, so plans of previous snapshot are not changed
+
+changes are made in copy of current vocabulary or dictionary, which is published as new snapshot by single assignment,
+renders, which have already taken old snapshot, finish on it
+
+    holder = SnapshotHolder(vocabulary, dictionary)
+
+    # in render threads
+    holder.snapshot.render('type', externals)
+
+    # in writer thread
+    holder.change_dictionary(lambda dictionary: dictionary.add_word(word))
+
+    # after deploy of new texts, new snapshot is built in background thread
+    holder.reload(dict_storage=dict_storage, shards=True, background=True)
+'''
+import threading
+
+from textgen.templates import Dictionary, Vocabulary
+from textgen.cache import LRUCache
+
+
+class Snapshot(object):
+    '''
+    frozen vocabulary and dictionary, which are used together
+    '''
+
+    __slots__ = ('vocabulary', 'dictionary', 'version')
+
+    def __init__(self, vocabulary, dictionary, version):
+        self.vocabulary = vocabulary
+        self.dictionary = dictionary
+        self.version = version
+
+    def get_random_phrase(self, type_, default=None):
+        return self.vocabulary.get_random_phrase(type_, default)
+
+    def render(self, type_, externals, default=None):
+        template = self.vocabulary.get_random_phrase(type_)
+        if template is None:
+            return default
+        return template.substitute(self.dictionary, externals)
+
+    def render_many(self, type_, externals_iterable, default=None):
+        return self.vocabulary.render_many(self.dictionary, type_, externals_iterable, default)
+
+    def render_sequence(self, types, externals, overrides=None, default=None):
+        return self.vocabulary.render_sequence(self.dictionary, types, externals, overrides, default)
+
+    def bind(self, externals):
+        return self.vocabulary.bind(self.dictionary, externals)
+
+
+class SnapshotHolder(object):
+    '''
+    reference to current snapshot, readers take it without locks, writers are serialized
+    '''
+
+    def __init__(self, vocabulary, dictionary):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        # exception of last background reload, None if it succeeded
+        self.reload_error = None
+        self.publish(vocabulary, dictionary)
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def _publish(self, vocabulary, dictionary):
+        current = self._snapshot
+
+        if vocabulary is None:
+            vocabulary = current.vocabulary
+
+        if dictionary is None:
+            dictionary = current.dictionary
+
+        # results cached with old words must not be used with new dictionary
+        relink_cache = (current is not None and
+                        vocabulary.render_cache is not None and
+                        vocabulary.render_cache is current.dictionary.render_cache and
+                        vocabulary.render_cache is not dictionary.render_cache)
+
+        prerender_dictionary = vocabulary._prerender_dictionary
+        prerender = prerender_dictionary is not None and prerender_dictionary is not dictionary
+
+        if prerender or (relink_cache and vocabulary.frozen):
+            vocabulary = vocabulary.copy(copy_templates=prerender)
+
+        if relink_cache:
+            vocabulary.render_cache = dictionary.render_cache
+
+        if prerender:
+            vocabulary.prerender(dictionary)
+
+        snapshot = Snapshot(vocabulary.freeze(), dictionary.freeze(), current.version + 1 if current is not None else 1)
+
+        self._snapshot = snapshot
+
+        return snapshot
+
+    def publish(self, vocabulary=None, dictionary=None):
+        '''
+        freeze and publish new vocabulary and (or) dictionary, returns new snapshot
+        if vocabulary is prerendered, it is prerendered for new dictionary before publishing
+        '''
+        with self._lock:
+            return self._publish(vocabulary, dictionary)
+
+    def change_dictionary(self, change):
+        '''
+        call change(dictionary) for copy of current dictionary and publish it, returns new snapshot
+        '''
+        with self._lock:
+            dictionary = self._snapshot.dictionary.copy()
+            change(dictionary)
+            return self._publish(None, dictionary)
+
+    def change_vocabulary(self, change):
+        '''
+        call change(vocabulary) for copy of current vocabulary and publish it, returns new snapshot
+        '''
+        with self._lock:
+            vocabulary = self._snapshot.vocabulary.copy()
+            change(vocabulary)
+            return self._publish(vocabulary, None)
+
+    def _load_dictionary(self, current_dictionary, dict_storage, load_dictionary):
+        dictionary = Dictionary()
+        load_dictionary(dictionary, dict_storage)
+
+        if current_dictionary.paradigms is not None:
+            dictionary.compact()
+
+        if current_dictionary.render_cache is not None:
+            dictionary.render_cache = LRUCache(current_dictionary.render_cache.size)
+
+        return dictionary
+
+    def _reload(self, voc_storage, dict_storage, shards, load_dictionary):
+        with self._lock:
+            current = self._snapshot
+
+            dictionary = None
+            if dict_storage is not None:
+                dictionary = self._load_dictionary(current.dictionary, dict_storage, load_dictionary)
+
+            target_dictionary = dictionary if dictionary is not None else current.dictionary
+
+            vocabulary = None
+
+            if voc_storage is not None:
+                vocabulary = Vocabulary()
+                vocabulary.render_cache = current.vocabulary.render_cache
+                if current.vocabulary._prerender_dictionary is not None:
+                    vocabulary._prerender_dictionary = target_dictionary
+                vocabulary.load(voc_storage)
+
+            elif shards:
+                prerender = dictionary is not None and current.vocabulary._prerender_dictionary is not None
+
+                vocabulary = current.vocabulary.copy(copy_templates=prerender)
+
+                # templates of all shards depend on new dictionary, so they are prerendered before loading changed shards
+                if prerender:
+                    vocabulary.prerender(dictionary)
+
+                if not vocabulary.reload_shards() and dictionary is None:
+                    return current
+
+            if vocabulary is None and dictionary is None:
+                return current
+
+            return self._publish(vocabulary, dictionary)
+
+    def _reload_in_background(self, *argv):
+        try:
+            self._reload(*argv)
+            self.reload_error = None
+        except Exception, e:
+            self.reload_error = e
+
+    def reload(self, voc_storage=None, dict_storage=None, shards=False, load_dictionary=Dictionary.load, background=False):
+        '''
+        load new vocabulary and (or) dictionary and publish them as single snapshot,
+        renders continue on current snapshot during loading
+
+        voc_storage - load vocabulary from file (see Vocabulary.save)
+        dict_storage - load dictionary from file by load_dictionary(dictionary, dict_storage), compaction and render cache size are kept
+        shards - reload changed shards of current vocabulary (see Vocabulary.reload_shards),
+                 templates of other shards keep their render plans and cached results
+
+        returns new snapshot (or current, if nothing changed),
+        if background is True, returns started thread, error of background reload is stored in reload_error
+        '''
+        if not background:
+            return self._reload(voc_storage, dict_storage, shards, load_dictionary)
+
+        thread = threading.Thread(target=self._reload_in_background, args=(voc_storage, dict_storage, shards, load_dictionary))
+        thread.daemon = True
+        thread.start()
+
+        return thread
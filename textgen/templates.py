@@ -1,33 +1,107 @@
 # coding: utf-8
+import os
 import re
 import itertools
 import numbers
 import random
 import json
+import hashlib
 
 from textgen.exceptions import TextgenException
 from textgen.words import WordBase, Fake, Numeral
-from textgen.logic import efication, Args, PROPERTIES
+from textgen.logic import efication, Args, PROPERTIES, intern_unicode, intern_tuple
+from textgen.mapped import MappedWords, save_dictionary
+from textgen.forms_index import FormsIndex
+from textgen.paradigms import ParadigmsTable
+from textgen.cache import LRUCache
 
 class Dictionary(object):
 
+    __slots__ = ('data', 'render_cache', 'version', 'paradigms', 'frozen', '_resolved_externals', '_forms_index')
+
+    RESOLVED_EXTERNALS_CACHE_SIZE = 10000
+
     def __init__(self):
         self.data = {}
+        # LRUCache of Template.substitute results, disabled by default
+        self.render_cache = None
+        # incremented on every change, so objects depending on dictionary content can check if they are outdated
+        self.version = 0
+        self._resolved_externals = {}
+        self._forms_index = None
+        # ParadigmsTable, set by compact
+        self.paradigms = None
+        # frozen dictionary can not be changed, so it can be used from many threads without locks
+        self.frozen = False
+
+    def _check_not_frozen(self):
+        if self.frozen:
+            raise TextgenException(u'dictionary is frozen, change its copy instead')
+
+    def freeze(self):
+        '''
+        forbid changes, returns self
+        '''
+        self.frozen = True
+        return self
+
+    def copy(self):
+        '''
+        not frozen dictionary with the same words, words are shared, so they must not be changed in place
+        '''
+        dictionary = Dictionary()
+        dictionary.data = self.data.copy()
+        dictionary.version = self.version
+        dictionary.paradigms = self.paradigms
+
+        # cached results depend on words, so copy gets its own cache
+        if self.render_cache is not None:
+            dictionary.render_cache = LRUCache(self.render_cache.size)
+
+        return dictionary
+
+    def _changed(self):
+        self.version += 1
+        self._resolved_externals = {}
+        if self.render_cache is not None:
+            self.render_cache.clear()
 
     def add_word(self, word, overwrite=False):
+        self._check_not_frozen()
         if not overwrite and efication(word.normalized) in self.data:
             # TODO: add test
             return
+        if self.paradigms is not None:
+            word.compact(self.paradigms)
         self.data[efication(word.normalized)] = word
+        self._changed()
+
+    def compact(self):
+        '''
+        store forms of words as stem + endings table, tables are shared between words,
+        words added after that are compacted too
+        '''
+        self._check_not_frozen()
+
+        if self.paradigms is None:
+            self.paradigms = ParadigmsTable()
+
+        for word in self.data.values():
+            word.compact(self.paradigms)
 
     def get_word(self, normalized):
         normalized = efication(normalized)
-        if normalized in self.data:
-            return self.data[normalized]
+        word = self.data.get(normalized)
+        if word is not None:
+            return word
         return Fake(u'<word not found: %s>' % normalized)
 
     def clear(self):
+        self._check_not_frozen()
         self.data = {}
+        if self.paradigms is not None:
+            self.paradigms = ParadigmsTable()
+        self._changed()
 
     def save(self, storage):
         data = {}
@@ -35,9 +109,11 @@ class Dictionary(object):
             data[norm] = word.serialize()
 
         with open(storage, 'w') as f:
-            f.write(json.dumps(data, ensure_ascii=False, check_circular=True, allow_nan=False, indent=2).encode('utf-8'))
+            f.write(json.dumps(data, ensure_ascii=False, check_circular=True, allow_nan=False, indent=2, sort_keys=True).encode('utf-8'))
 
     def load(self, storage):
+        self._check_not_frozen()
+
         with open(storage, 'r') as f:
             raw_data = f.read()
             if not raw_data:
@@ -47,6 +123,93 @@ class Dictionary(object):
         for word_data in data.values():
             self.add_word(WordBase.deserialize(word_data))
 
+    def save_binary(self, storage):
+        save_dictionary(self.data, storage)
+
+    def load_binary(self, storage):
+        '''
+        open binary storage with mmap, words are created on first access
+        '''
+        self._check_not_frozen()
+        self.data = MappedWords(storage)
+        self._changed()
+
+    def load_packed(self, storage, in_memory=False):
+        '''
+        open binary storage (see save_binary) without creating persistent objects for words:
+        every get_word returns new thin word, which forms are decoded from storage buffer,
+        so processes, forked after loading, share single copy of dictionary
+
+        in_memory - read storage into bytes string instead of mmap
+        '''
+        self._check_not_frozen()
+        self.data = MappedWords(storage, cache_words=False, in_memory=in_memory)
+        self._changed()
+
+    def _resolve_external(self, external):
+        additional_args = ()
+        if isinstance(external, tuple):
+            normalized, additional_args = external
+            additional_args = additional_args.split(u',') if isinstance(additional_args, basestring) else additional_args
+        else:
+            normalized = external
+
+        if isinstance(normalized, numbers.Number):
+            word = Numeral(normalized)
+            arguments = Args()
+        elif isinstance(normalized, WordBase):
+            word = normalized
+            arguments = Args(*word.properties)
+        else:
+            word = self.get_word(efication(normalized))
+            arguments = Args(*word.properties)
+
+        return word, arguments.update(*additional_args)
+
+    def resolve_external(self, external):
+        '''
+        returns (word, Args) for external value,
+        results for words from dictionary are cached until dictionary changed
+        '''
+        if isinstance(external, basestring) or (isinstance(external, tuple) and isinstance(external[0], basestring)):
+            try:
+                resolved = self._resolved_externals.get(external)
+            except TypeError: # unhashable additional args
+                return self._resolve_external(external)
+
+            if resolved is None:
+                resolved = self._resolve_external(external)
+
+                if len(self._resolved_externals) >= self.RESOLVED_EXTERNALS_CACHE_SIZE:
+                    self._resolved_externals = {}
+
+                self._resolved_externals[external] = resolved
+
+            return resolved
+
+        return self._resolve_external(external)
+
+    def resolve_externals(self, externals):
+        return ResolvedExternals(self, externals)
+
+    def get_forms_index(self):
+        '''
+        reverse index of word forms, built on first use and rebuilt after dictionary changed
+        '''
+        forms_index = self._forms_index
+
+        if forms_index is None or forms_index[0] != self.version:
+            forms_index = (self.version, FormsIndex(self.data))
+            self._forms_index = forms_index
+
+        return forms_index[1]
+
+    def lemmatize(self, form):
+        '''
+        returns list of (dictionary key, form slot) for words, which have such form
+        '''
+        return self.get_forms_index().find(form)
+
     def get_undefined_words(self):
         result = []
         for key, word in self.data.items():
@@ -58,41 +221,273 @@ class Dictionary(object):
         return value in self.data
 
 
+class ResolvedExternals(object):
+    '''
+    externals, resolved to (word, Args) pairs once
+
+    can be passed to Template.substitute instead of externals dict and reused across templates and calls,
+    if dictionary changed, externals are resolved again
+    '''
+
+    __slots__ = ('dictionary', 'version', 'externals', 'resolved')
+
+    def __init__(self, dictionary, externals):
+        self.dictionary = dictionary
+        self.version = dictionary.version
+        self.externals = dict(externals)
+        self.resolved = dict((external_id, dictionary.resolve_external(external))
+                             for external_id, external in self.externals.items())
+
+    def get_resolved(self, dictionary, external_id):
+        if dictionary is self.dictionary and dictionary.version == self.version:
+            return self.resolved[external_id]
+        return dictionary.resolve_external(self.externals[external_id])
+
+    def __getitem__(self, external_id):
+        return self.externals[external_id]
+
+    def __contains__(self, external_id):
+        return external_id in self.externals
+
+
+class BoundExternals(object):
+    '''
+    externals of single call, added to already resolved fixed externals
+    '''
+
+    __slots__ = ('fixed', 'externals')
+
+    def __init__(self, fixed, externals):
+        self.fixed = fixed
+        self.externals = externals
+
+    def get_resolved(self, dictionary, external_id):
+        if external_id in self.externals:
+            return dictionary.resolve_external(self.externals[external_id])
+        return self.fixed.get_resolved(dictionary, external_id)
+
+    def __getitem__(self, external_id):
+        if external_id in self.externals:
+            return self.externals[external_id]
+        return self.fixed[external_id]
+
+    def __contains__(self, external_id):
+        return external_id in self.externals or external_id in self.fixed
+
+
+class BoundTemplate(object):
+    '''
+    template with dictionary and fixed externals, created by Template.bind
+    '''
+
+    __slots__ = ('template', 'dictionary', 'externals')
+
+    def __init__(self, template, dictionary, externals):
+        self.template = template
+        self.dictionary = dictionary
+        self.externals = externals
+
+    def substitute(self, externals=None):
+        if not externals:
+            return self.template.substitute(self.dictionary, self.externals)
+        return self.template.substitute(self.dictionary, BoundExternals(self.externals, externals))
+
+
+class BoundVocabulary(object):
+    '''
+    vocabulary with dictionary and fixed externals, created by Vocabulary.bind
+    '''
+
+    __slots__ = ('vocabulary', 'dictionary', 'externals')
+
+    def __init__(self, vocabulary, dictionary, externals):
+        self.vocabulary = vocabulary
+        self.dictionary = dictionary
+        self.externals = externals
+
+    def get_random_phrase(self, type_, default=None):
+        template = self.vocabulary.get_random_phrase(type_)
+        if template is None:
+            return default
+        return BoundTemplate(template, self.dictionary, self.externals)
+
+    def substitute(self, type_, externals=None, default=None):
+        '''
+        render random phrase of type, returns default if there are no phrases
+        '''
+        template = self.get_random_phrase(type_)
+        if template is None:
+            return default
+        return template.substitute(externals)
+
+
 class Vocabulary(object):
 
+    __slots__ = ('data', 'shards', 'render_cache', 'frozen', '_shards_directory', '_unloaded_types', '_shards_hashes', '_prerender_dictionary')
+
+    DEFAULT_SHARD = u'common'
+    SHARDS_INDEX = 'index.json'
+
     def __init__(self):
         self.data = {}
+        self.shards = {}
+        self._shards_directory = None
+        self._unloaded_types = {}
+        # sha1 of files of loaded shards, used to find shards changed on disk
+        self._shards_hashes = {}
+        # LRUCache of Template.substitute results, usually the same object as Dictionary.render_cache
+        self.render_cache = None
+        # dictionary, for which templates are prerendered
+        self._prerender_dictionary = None
+        # frozen vocabulary can not be changed, so it can be used from many threads without locks
+        self.frozen = False
+
+    def _check_not_frozen(self):
+        if self.frozen:
+            raise TextgenException(u'vocabulary is frozen, change its copy instead')
+
+    def freeze(self):
+        '''
+        load all shards and forbid changes, returns self
+        '''
+        self.load_all_shards()
+        self.frozen = True
+        return self
+
+    def copy(self, copy_templates=False):
+        '''
+        not frozen vocabulary with the same templates
+
+        templates are shared, but their prerendered plans are tied to single dictionary,
+        so copy_templates must be used, if copy will be prerendered for another dictionary, while original is in use
+        '''
+        vocabulary = Vocabulary()
+        if copy_templates:
+            vocabulary.data = dict((type_, [phrase.copy() for phrase in phrases]) for type_, phrases in self.data.items())
+        else:
+            vocabulary.data = dict((type_, list(phrases)) for type_, phrases in self.data.items())
+        vocabulary.shards = dict(self.shards)
+        vocabulary.render_cache = self.render_cache
+        vocabulary._shards_directory = self._shards_directory
+        vocabulary._unloaded_types = dict(self._unloaded_types)
+        vocabulary._shards_hashes = dict(self._shards_hashes)
+        vocabulary._prerender_dictionary = self._prerender_dictionary
+        return vocabulary
+
+    def _changed(self):
+        if self.render_cache is not None:
+            self.render_cache.clear()
+
+    def prerender(self, dictionary):
+        '''
+        prerender all templates for dictionary (see Template.prerender), templates from shards loaded later are prerendered on load
+        '''
+        self._prerender_dictionary = dictionary
+
+        for phrases in self.data.values():
+            for phrase in phrases:
+                phrase.prerender(dictionary)
 
     def add_phrase(self, type_, template):
+        self._check_not_frozen()
+        if type_ in self._unloaded_types:
+            self.load_shard(self._unloaded_types[type_])
         if type_ not in self.data:
             raise TextgenException('type %s has not registered in vocabulary' % type_)
         self.data[type_].append(template)
 
-    def register_type(self, type_):
-        if type_ in self.data:
+    def register_type(self, type_, shard=None):
+        self._check_not_frozen()
+        if type_ in self:
             raise TextgenException('type %s has already registered in vocabulary' % type_)
         self.data[type_] = []
+        self.shards[type_] = shard or self.DEFAULT_SHARD
+
+    def remove_type(self, type_):
+        self._check_not_frozen()
+        self.data.pop(type_, None)
+        self.shards.pop(type_, None)
+        self._unloaded_types.pop(type_, None)
+        self._changed()
 
     def get_random_phrase(self, type_, default=None):
+        if type_ in self._unloaded_types:
+            self.load_shard(self._unloaded_types[type_])
         if type_ in self.data and self.data[type_]:
             return random.choice(self.data[type_])
         return default
 
+    def iter_render(self, dictionary, type_, externals_iterable, default=None):
+        '''
+        generator of random phrases of type for every externals from iterable (default if type has no phrases),
+        render plans and resolved externals are shared between all items
+        '''
+        batches = {}
+        resolved = {}
+
+        for externals in externals_iterable:
+            template = self.get_random_phrase(type_)
+
+            if template is None:
+                yield default
+                continue
+
+            batch = batches.get(template)
+
+            if batch is None:
+                batch = TemplateBatch(template, dictionary, resolved)
+                batches[template] = batch
+
+            yield batch.render(externals)
+
+    def render_many(self, dictionary, type_, externals_iterable, default=None):
+        return list(self.iter_render(dictionary, type_, externals_iterable, default))
+
+    def render_sequence(self, dictionary, types, externals, overrides=None, default=None):
+        '''
+        render random phrase for every type from list, externals are resolved once for all phrases
+        overrides - list of externals (or None) for every step, they replace common externals in that step
+        '''
+        bound = self.bind(dictionary, externals)
+
+        if overrides is None:
+            overrides = [None] * len(types)
+        elif len(overrides) != len(types):
+            raise TextgenException(u'number of overrides (%d) does not equal to number of types (%d)' % (len(overrides), len(types)))
+
+        return [bound.substitute(type_, step_overrides, default) for type_, step_overrides in zip(types, overrides)]
+
+    def bind(self, dictionary, externals):
+        '''
+        returns BoundVocabulary, fixed externals are resolved once for all its phrases
+        '''
+        return BoundVocabulary(self, dictionary, dictionary.resolve_externals(externals))
+
     def __contains__(self, type_):
-        return type_ in self.data
+        return type_ in self.data or type_ in self._unloaded_types
 
     def clear(self):
+        self._check_not_frozen()
         self.data = {}
+        self.shards = {}
+        self._shards_directory = None
+        self._unloaded_types = {}
+        self._shards_hashes = {}
+        self._changed()
 
     def save(self, storage):
+        self.load_all_shards()
+
         data = {}
         for type_, phrases in self.data.items():
             data[type_] = [phrase.serialize() for phrase in phrases]
 
         with open(storage, 'w') as f:
-            f.write(json.dumps(data, ensure_ascii=False, check_circular=True, allow_nan=False, indent=2).encode('utf-8'))
+            f.write(json.dumps(data, ensure_ascii=False, check_circular=True, allow_nan=False, indent=2, sort_keys=True).encode('utf-8'))
 
     def load(self, storage):
+        self._check_not_frozen()
+
         with open(storage, 'r') as f:
             raw_data = f.read()
             if not raw_data:
@@ -101,7 +496,156 @@ class Vocabulary(object):
 
         for type_, phrases in data.items():
             self.data[type_] = [Template.deserialize(phrase_data) for phrase_data in phrases]
+            self.shards.setdefault(type_, self.DEFAULT_SHARD)
+
+        if self._prerender_dictionary is not None:
+            self.prerender(self._prerender_dictionary)
+
+        self._changed()
+
+    @classmethod
+    def get_shard_path(cls, directory, shard):
+        return os.path.join(directory, u'shard_%s.json' % shard)
+
+    def save_shards(self, directory):
+        '''
+        save every shard to its own file, and index of types to directory
+        '''
+        self.load_all_shards()
+
+        shards = {}
+        for type_, phrases in self.data.items():
+            shards.setdefault(self.shards.get(type_, self.DEFAULT_SHARD), {})[type_] = [phrase.serialize() for phrase in phrases]
+
+        for shard, data in shards.items():
+            with open(self.get_shard_path(directory, shard), 'w') as f:
+                f.write(json.dumps(data, ensure_ascii=False, check_circular=True, allow_nan=False, indent=2, sort_keys=True).encode('utf-8'))
+
+        index = dict((shard, sorted(data.keys())) for shard, data in shards.items())
+
+        with open(os.path.join(directory, self.SHARDS_INDEX), 'w') as f:
+            f.write(json.dumps(index, ensure_ascii=False, indent=2, sort_keys=True).encode('utf-8'))
+
+    def load_shards(self, directory, preload=()):
+        '''
+        read only index of shards, shard is loaded on first request of one of its types
+        preload - types, which shards must be loaded right now
+        '''
+        self._check_not_frozen()
+
+        index = self._load_shards_index(directory)
+
+        self._shards_directory = directory
+        self._shards_hashes = {}
+        self._changed()
+
+        for shard, types in index.items():
+            for type_ in types:
+                self._unloaded_types[type_] = shard
+                self.shards[type_] = shard
+
+        for type_ in preload:
+            if type_ in self._unloaded_types:
+                self.load_shard(self._unloaded_types[type_])
+
+    @classmethod
+    def _load_shards_index(cls, directory):
+        with open(os.path.join(directory, cls.SHARDS_INDEX), 'r') as f:
+            return json.loads(f.read())
+
+    def _get_shard_hash(self, shard):
+        with open(self.get_shard_path(self._shards_directory, shard), 'r') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def load_shard(self, shard):
+        self._check_not_frozen()
+
+        with open(self.get_shard_path(self._shards_directory, shard), 'r') as f:
+            raw_data = f.read()
+
+        self._shards_hashes[shard] = hashlib.sha1(raw_data).hexdigest()
+
+        data = json.loads(raw_data)
+
+        for type_, phrases in data.items():
+            if self._unloaded_types.get(type_) != shard:
+                continue
+            self.data[type_] = [Template.deserialize(phrase_data) for phrase_data in phrases]
+            del self._unloaded_types[type_]
+
+            if self._prerender_dictionary is not None:
+                for phrase in self.data[type_]:
+                    phrase.prerender(self._prerender_dictionary)
+
+    def load_all_shards(self):
+        for shard in set(self._unloaded_types.values()):
+            self.load_shard(shard)
+
+    def _check_sharded(self):
+        if self._shards_directory is None:
+            raise TextgenException(u'vocabulary is not loaded from shards')
+
+    def get_changed_shards(self, index=None):
+        '''
+        shards, which were added, removed or changed on disk since loading (not loaded shards are not checked)
+        '''
+        self._check_sharded()
+
+        if index is None:
+            index = self._load_shards_index(self._shards_directory)
+
+        known_shards = set(self.shards.values())
+
+        changed = set(index) ^ known_shards
+
+        for shard in known_shards & set(index):
+            if shard in self._shards_hashes and self._get_shard_hash(shard) != self._shards_hashes[shard]:
+                changed.add(shard)
+
+        return changed
+
+    def reload_shards(self, shards=None):
+        '''
+        read shards from directory again (by default - changed ones, see get_changed_shards),
+        templates of other shards, their render plans and cached results are kept
+
+        returns set of reloaded shards
+        '''
+        self._check_not_frozen()
+        self._check_sharded()
+
+        index = self._load_shards_index(self._shards_directory)
+
+        shards = self.get_changed_shards(index) if shards is None else set(shards)
+
+        removed_templates = set()
+
+        for type_, shard in self.shards.items():
+            if shard in shards:
+                removed_templates.update(self.data.pop(type_, ()))
+                del self.shards[type_]
+                self._unloaded_types.pop(type_, None)
+
+        for shard in shards:
+            self._shards_hashes.pop(shard, None)
+
+            if shard not in index:
+                continue
 
+            for type_ in index[shard]:
+                self._unloaded_types[type_] = shard
+                self.shards[type_] = shard
+
+            self.load_shard(shard)
+
+        if removed_templates and self.render_cache is not None:
+            self.render_cache.remove_if(lambda key: key[0] in removed_templates)
+
+        return shards
+
+    @property
+    def loaded_shards(self):
+        return set(self.shards[type_] for type_ in self.data)
 
 
 class Template(object):
@@ -112,10 +656,129 @@ class Template(object):
     # [{internal_id|dependece|dependece|arguments}]
     INTERNAL_REGEX = re.compile(u'\[\{[^\]]+\}\]', re.UNICODE)
 
+    # %(e_0)s, %(i_0)s and escaped %%
+    SLOT_REGEX = re.compile(u'%\(([ei]_\d+)\)s|%%', re.UNICODE)
+
+    VARIANTS_CACHE_SIZE = 1000
+
+    __slots__ = ('template', 'externals', 'internals', '_external_ids', '_parts', '_slots', '_internal_dependences',
+                 '_prerendered', '_variants')
+
     def __init__(self, template, externals, internals):
         self.template = template
-        self.externals = externals
-        self.internals = internals
+        self.externals = self._intern_words(externals)
+        self.internals = self._intern_words(internals)
+        self._prerendered = None
+        self._variants = None
+        self._compile()
+
+    def __getstate__(self):
+        return (self.template, self.externals, self.internals)
+
+    def copy(self):
+        '''
+        template with the same render plan, but without prerendered plan and cached variants
+        '''
+        template = object.__new__(self.__class__)
+        for name in self.__slots__:
+            setattr(template, name, getattr(self, name))
+        template._prerendered = None
+        template._variants = None
+        return template
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @staticmethod
+    def _intern_words(words):
+        '''
+        convert words descriptions (deserialized json lists) to tuples of interned strings
+        '''
+        return tuple((intern_unicode(id_), intern_tuple(dependences), intern_unicode(str_id), intern_tuple(arguments), intern_unicode(word_src))
+                     for id_, dependences, str_id, arguments, word_src in words)
+
+    def _compile(self):
+        '''
+        build render plan:
+        - _external_ids - ids of externals used by template (including dependences) in topological order
+        - _parts - literal fragments of template, None on slot positions
+        - _slots - (position, external_index, internal_word, dependences_indexes, arguments) in dependency order
+        '''
+        words = {}
+        dependences_graph = {}
+
+        for is_internal, words_list in ((False, self.externals), (True, self.internals)):
+            for id_, dependences, str_id, arguments, word_src in words_list:
+                words[str_id] = (is_internal, id_, tuple(dependences), tuple(arguments))
+                if not is_internal:
+                    dependences_graph.setdefault(id_, []).extend(dependences)
+
+        external_ids = []
+        visited = {}
+
+        def visit(external_id, path):
+            if visited.get(external_id) == 'done':
+                return
+            if external_id in path:
+                # cycles are rejected by create, but templates stored before that check must be loaded:
+                # forms depend only on resolved externals, not on rendered slots, so order of cycle does not matter
+                return
+            for dependence in dependences_graph.get(external_id, ()):
+                visit(dependence, path + [external_id])
+            visited[external_id] = 'done'
+            external_ids.append(external_id)
+
+        for words_list in (self.externals, self.internals):
+            for id_, dependences, str_id, arguments, word_src in words_list:
+                if words[str_id][0]:
+                    for dependence in dependences:
+                        visit(dependence, [])
+                else:
+                    visit(id_, [])
+
+        external_indexes = dict((external_id, i) for i, external_id in enumerate(external_ids))
+
+        parts = []
+        slots = []
+        position = 0
+
+        for match in self.SLOT_REGEX.finditer(self.template):
+            parts.append(self.template[position:match.start()])
+            position = match.end()
+
+            str_id = match.group(1)
+            if str_id is None:
+                parts.append(u'%')
+                continue
+
+            if str_id not in words:
+                raise TextgenException(u'unknown substitution %s in template %s' % (str_id, self.template))
+
+            is_internal, id_, dependences, arguments = words[str_id]
+            dependences_indexes = tuple(external_indexes[dependence] for dependence in dependences)
+
+            if is_internal:
+                slot = (len(parts), None, id_, dependences_indexes, arguments)
+            else:
+                slot = (len(parts), external_indexes[id_], None, dependences_indexes, arguments)
+
+            parts.append(None)
+            slots.append(slot)
+
+        parts.append(self.template[position:])
+
+        # externals first, in order of their dependences, then internals
+        slots.sort(key=lambda slot: (slot[1] is None, slot[1], slot[0]))
+
+        self._external_ids = tuple(external_ids)
+        self._parts = tuple(parts)
+        self._slots = tuple(slots)
+
+        # indexes of externals, which forms of internal words depend on
+        self._internal_dependences = tuple(sorted(set(dependence
+                                                      for position, external_index, internal_word, dependences, args in slots
+                                                      if external_index is None
+                                                      for dependence in dependences)))
 
     @classmethod
     def prepair_words(cls, morph, regex, src, subsitute_pattern, is_internal, tech_vocabulary={}):
@@ -172,39 +835,58 @@ class Template(object):
             if set(used_externals) - set(available_externals):
                 raise TextgenException(u'wrong externals in template %s: [%s]' % (src, ', '.join(set(used_externals) - set(available_externals))))
 
+        cls._check_dependences(src, externals, internals, available_externals)
+
         return cls(src, externals, internals)
 
-    def get_internal_words(self):
-        return [word_src for normalized, dependences, str_id, arguments, word_src in self.internals]
+    @classmethod
+    def _check_dependences(cls, src, externals, internals, available_externals):
+        '''
+        dependences must be not empty names of available externals (if they are passed) without cycles,
+        checked only on creation, so vocabularies saved before these checks can be loaded
+        '''
+        for id_, dependences, str_id, arguments, word_src in itertools.chain(externals, internals):
+            for dependence in dependences:
+                if not dependence or (available_externals and dependence not in available_externals):
+                    raise TextgenException(u'unknown dependence "%s" in template %s' % (dependence, src))
 
-    def _preprocess_externals(self, dictionary, externals):
-        processed_externals = {}
+        dependences_graph = {}
+        for id_, dependences, str_id, arguments, word_src in externals:
+            dependences_graph.setdefault(id_, []).extend(dependences)
 
-        for external_id, external in externals.items():
-            additional_args = ()
-            if isinstance(external, tuple):
-                normalized, additional_args = external
-                additional_args = additional_args.split(u',') if isinstance(additional_args, basestring) else additional_args
-            else:
-                normalized = external
-
-            if isinstance(normalized, numbers.Number):
-                word = Numeral(normalized)
-                arguments = Args()
-            elif isinstance(normalized, WordBase):
-                word = normalized
-                arguments = Args(*word.properties)
-            else:
-                word = dictionary.get_word(efication(normalized))
-                arguments = Args(*word.properties)
+        visited = set()
 
-            arguments.update(*additional_args)
+        def visit(external_id, path):
+            if external_id in path:
+                raise TextgenException(u'cyclic dependences in template %s: [%s]' % (src, u', '.join(path + [external_id])))
+            if external_id in visited:
+                return
+            for dependence in dependences_graph.get(external_id, ()):
+                visit(dependence, path + [external_id])
+            visited.add(external_id)
 
-            processed_externals[external_id] = (word, arguments)
+        for external_id in dependences_graph:
+            visit(external_id, [])
 
-        return processed_externals
+    def get_internal_words(self):
+        return [word_src for normalized, dependences, str_id, arguments, word_src in self.internals]
+
+    def bind(self, dictionary, externals):
+        '''
+        returns BoundTemplate, fixed externals are resolved once, other externals are passed to its substitute
+        '''
+        return BoundTemplate(self, dictionary, dictionary.resolve_externals(externals))
 
-    def _create_substitution(self, word, arguments, dependences, externals, args):
+    def _preprocess_externals(self, dictionary, externals):
+        try:
+            if isinstance(externals, (ResolvedExternals, BoundExternals)):
+                return [externals.get_resolved(dictionary, external_id) for external_id in self._external_ids]
+            return [dictionary.resolve_external(externals[external_id]) for external_id in self._external_ids]
+        except KeyError, e:
+            raise TextgenException(u'external %s is not passed to template %s' % (e.args[0], self.template))
+
+    @staticmethod
+    def _create_substitution(word, arguments, dependences, externals, args):
         number = None
 
         for dependence in dependences:
@@ -212,31 +894,201 @@ class Template(object):
             if isinstance(dependence_word, Numeral):
                 number = dependence_word
             else:
-                word.update_args(arguments, dependence_word, dependence_args)
+                arguments = word.update_args(arguments, dependence_word, dependence_args)
 
-        arguments.update(*args)
+        arguments = arguments.update(*args)
 
         if number is not None:
-            word.update_args(arguments, number, arguments.get_copy())
+            arguments = word.update_args(arguments, number, arguments)
 
         return word.get_form(arguments)
 
 
+    @classmethod
+    def _get_external_key(cls, external):
+        '''
+        part of external, which affects rendering
+        '''
+        if isinstance(external, tuple):
+            normalized, additional_args = external
+            if isinstance(additional_args, basestring):
+                additional_args = additional_args.split(u',')
+            return (cls._get_external_key(normalized), tuple(additional_args))
+
+        if isinstance(external, basestring):
+            return efication(external)
+
+        if isinstance(external, numbers.Number):
+            return (external.__class__, external)
+
+        return external.identity
+
     def substitute(self, dictionary, externals):
+        cache = dictionary.render_cache
+
+        if cache is None:
+            return self._render(dictionary, externals)
+
+        key = (self, tuple(self._get_external_key(externals[external_id]) for external_id in self._external_ids))
+
+        result = cache.get(key)
 
-        substitutions = {}
-        processed_externals = self._preprocess_externals(dictionary, externals)
+        if result is None:
+            result = self._render(dictionary, externals)
+            cache.set(key, result)
 
-        for external_id, dependences, str_id, args, word_src in self.externals:
-            word, arguments = processed_externals[external_id]
-            substitutions[str_id] = self._create_substitution(word, arguments.get_copy(), dependences, processed_externals, args)
+        return result
+
+    @staticmethod
+    def _merge_parts(parts, slots):
+        '''
+        merge neighbour literals and move slots to new positions
+        '''
+        merged_parts = []
+        positions = {}
+
+        for position, part in enumerate(parts):
+            if part is None:
+                positions[position] = len(merged_parts)
+                merged_parts.append(None)
+            elif merged_parts and merged_parts[-1] is not None:
+                merged_parts[-1] += part
+            else:
+                merged_parts.append(part)
+
+        slots = tuple((positions[position], external_index, internal_word, dependences, args)
+                      for position, external_index, internal_word, dependences, args in slots)
+
+        return tuple(merged_parts), slots
+
+    def prerender(self, dictionary):
+        '''
+        fold internal words without dependences into literal text for that dictionary,
+        plan is used only with the same dictionary and is rebuilt on first render after dictionary changed
 
-        for internal_str, dependences, str_id, args, word_src in self.internals:
-            word = dictionary.get_word(internal_str)
-            substitutions[str_id] = self._create_substitution(word, Args(), dependences, processed_externals, args)
+        returns (dictionary, version, parts, slots, text), text is not None if template does not depend on externals
+        '''
+        self._prerendered = self._fold_constants(dictionary)
+        return self._prerendered
 
+    def _fold_constants(self, dictionary):
+        parts = list(self._parts)
+        slots = []
 
-        return self.template % substitutions
+        for slot in self._slots:
+            position, external_index, internal_word, dependences, args = slot
+            if external_index is None and not dependences:
+                parts[position] = self._create_substitution(dictionary.get_word(internal_word), Args(), (), (), args)
+            else:
+                slots.append(slot)
+
+        parts, slots = self._merge_parts(parts, slots)
+
+        text = u''.join(parts) if not slots else None
+
+        return (dictionary, dictionary.version, parts, slots, text)
+
+    def _get_signature(self, processed_externals):
+        '''
+        forms of internal words depend only on grammatical state of externals (or plural class of numerals)
+        '''
+        signature = []
+
+        for external_index in self._internal_dependences:
+            word, arguments = processed_externals[external_index]
+            if isinstance(word, Numeral):
+                signature.append(-1 - word.get_plural_class(word.normalized))
+            else:
+                signature.append(arguments.state)
+
+        return tuple(signature)
+
+    def _get_variant(self, dictionary, processed_externals):
+        '''
+        returns (parts, slots) with all internal words rendered for signature of externals,
+        variants are built on first use and dropped after dictionary changed
+        '''
+        variants = self._variants
+
+        if variants is None or variants[0] is not dictionary or variants[1] != dictionary.version:
+            variants = (dictionary, dictionary.version, {})
+            self._variants = variants
+
+        signature = self._get_signature(processed_externals)
+
+        variant = variants[2].get(signature)
+
+        if variant is None:
+            parts = list(self._parts)
+            slots = []
+
+            for slot in self._slots:
+                position, external_index, internal_word, dependences, args = slot
+                if external_index is None:
+                    parts[position] = self._create_substitution(dictionary.get_word(internal_word), Args(), dependences, processed_externals, args)
+                else:
+                    slots.append(slot)
+
+            variant = self._merge_parts(parts, slots)
+
+            if len(variants[2]) >= self.VARIANTS_CACHE_SIZE:
+                variants[2].clear()
+
+            variants[2][signature] = variant
+
+        return variant
+
+    def _get_prerendered(self, dictionary):
+        prerendered = self._prerendered
+
+        if prerendered is None or prerendered[0] is not dictionary:
+            return None
+
+        if prerendered[1] != dictionary.version:
+            prerendered = self.prerender(dictionary)
+
+        return prerendered
+
+    def _render(self, dictionary, externals):
+        prerendered = self._get_prerendered(dictionary)
+
+        if prerendered is not None:
+            if prerendered[4] is not None:
+                return prerendered[4]
+
+            template_parts, slots = prerendered[2], prerendered[3]
+        else:
+            template_parts, slots = self._parts, self._slots
+
+        return self._render_plan(dictionary, template_parts, slots, self._preprocess_externals(dictionary, externals))
+
+    def _render_plan(self, dictionary, template_parts, slots, processed_externals):
+        if self._internal_dependences:
+            template_parts, slots = self._get_variant(dictionary, processed_externals)
+
+        parts = list(template_parts)
+
+        for position, external_index, internal_word, dependences, args in slots:
+            if external_index is None:
+                word, arguments = dictionary.get_word(internal_word), Args()
+            else:
+                word, arguments = processed_externals[external_index]
+            parts[position] = self._create_substitution(word, arguments, dependences, processed_externals, args)
+
+        return u''.join(parts)
+
+    def iter_substitute(self, dictionary, externals_iterable):
+        '''
+        generator of substitutions for every externals from iterable,
+        render plan and resolved externals are shared between all items
+        '''
+        batch = TemplateBatch(self, dictionary, {})
+
+        for externals in externals_iterable:
+            yield batch.render(externals)
+
+    def substitute_many(self, dictionary, externals_iterable):
+        return list(self.iter_substitute(dictionary, externals_iterable))
 
 
     def serialize(self):
@@ -247,3 +1099,69 @@ class Template(object):
     @classmethod
     def deserialize(cls, data):
         return cls(data['template'], data['externals'], data['internals'])
+
+
+class TemplateBatch(object):
+    '''
+    renders one template for many externals:
+    plan with constant internal words folded is built once,
+    externals are resolved once per batch (resolved dict can be shared between batches)
+    '''
+
+    RESOLVED_CACHE_SIZE = 10000
+
+    __slots__ = ('template', 'dictionary', 'resolved', 'version', 'parts', 'slots', 'text')
+
+    def __init__(self, template, dictionary, resolved):
+        self.template = template
+        self.dictionary = dictionary
+        self.resolved = resolved
+        self._update_plan()
+
+    def _update_plan(self):
+        prerendered = self.template._get_prerendered(self.dictionary)
+
+        if prerendered is None:
+            prerendered = self.template._fold_constants(self.dictionary)
+
+        dictionary, self.version, self.parts, self.slots, self.text = prerendered
+
+    def _resolve(self, external):
+        try:
+            key = (external.__class__, external)
+            resolved = self.resolved.get(key)
+        except TypeError: # unhashable additional args
+            return self.dictionary.resolve_external(external)
+
+        if resolved is None:
+            resolved = self.dictionary.resolve_external(external)
+
+            if len(self.resolved) >= self.RESOLVED_CACHE_SIZE:
+                self.resolved.clear()
+
+            self.resolved[key] = resolved
+
+        return resolved
+
+    def render(self, externals):
+        dictionary = self.dictionary
+
+        if dictionary.render_cache is not None:
+            return self.template.substitute(dictionary, externals)
+
+        if dictionary.version != self.version:
+            self.resolved.clear()
+            self._update_plan()
+
+        if self.text is not None:
+            return self.text
+
+        if isinstance(externals, (ResolvedExternals, BoundExternals)):
+            processed_externals = self.template._preprocess_externals(dictionary, externals)
+        else:
+            try:
+                processed_externals = [self._resolve(externals[external_id]) for external_id in self.template._external_ids]
+            except KeyError, e:
+                raise TextgenException(u'external %s is not passed to template %s' % (e.args[0], self.template.template))
+
+        return self.template._render_plan(dictionary, self.parts, self.slots, processed_externals)
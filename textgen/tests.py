@@ -1,19 +1,123 @@
 # coding: utf-8
 import os
+import json
+import time
+import pickle
 import tempfile
+import threading
+import multiprocessing
 
 import pymorphy
 
-from unittest import TestCase
+from unittest import TestCase, skipIf
 
-from textgen.words import Noun, Adjective, Verb, NounGroup, Fake, Participle, ShortParticiple, Pronoun
+from textgen.words import WordBase, Numeral, Noun, Adjective, Verb, NounGroup, Fake, Participle, ShortParticiple, Pronoun
 from textgen.templates import Args, Template, Dictionary, Vocabulary
 from textgen.conf import APP_DIR, textgen_settings
-from textgen.logic import import_texts
-from textgen.exceptions import NormalFormNeeded
+from textgen.logic import import_texts, get_gram_info, WordsBuilder
+from textgen.morph_cache import MorphCache
+from textgen.cache import LRUCache
+from textgen.paradigms import Paradigm
+from textgen import vectorized
+from textgen.codegen import generate_module, load_module
+from textgen import server as server_module
+from textgen.server import RenderService, RenderClient, create_server
+from textgen.snapshots import SnapshotHolder
+from textgen.exceptions import NormalFormNeeded, TextgenException
 
 morph = pymorphy.get_morph(textgen_settings.PYMORPHY_DICTS_DIRECTORY)
 
+
+def create_test_dictionary():
+    '''
+    dictionary with predefined forms, does not depend on pymorphy data
+    '''
+    dictionary = Dictionary()
+    dictionary.add_word(Noun(normalized=u'обезьянка',
+                             forms=(u'обезьянка', u'обезьянки', u'обезьянке', u'обезьянку', u'обезьянкой', u'обезьянке',
+                                    u'обезьянки', u'обезьянок', u'обезьянкам', u'обезьянок', u'обезьянками', u'обезьянках'),
+                             properties=(u'жр',)))
+    dictionary.add_word(Noun(normalized=u'тень',
+                             forms=(u'тень', u'тени', u'тени', u'тень', u'тенью', u'тени',
+                                    u'тени', u'теней', u'теням', u'тени', u'тенями', u'тенях'),
+                             properties=(u'жр',)))
+    dictionary.add_word(Noun(normalized=u'крыса',
+                             forms=(u'крыса', u'крысы', u'крысе', u'крысу', u'крысой', u'крысе',
+                                    u'крысы', u'крыс', u'крысам', u'крыс', u'крысами', u'крысах'),
+                             properties=(u'жр',)))
+    dictionary.add_word(Adjective(normalized=u'глупый',
+                                  forms=(u'глупый', u'глупого', u'глупому', u'глупого', u'глупым', u'глупом',
+                                         u'глупая', u'глупой', u'глупой', u'глупую', u'глупой', u'глупой',
+                                         u'глупое', u'глупого', u'глупому', u'глупое', u'глупым', u'глупом',
+                                         u'глупые', u'глупых', u'глупым', u'глупых', u'глупыми', u'глупых')))
+    dictionary.add_word(Adjective(normalized=u'целый',
+                                  forms=(u'целый', u'целого', u'целому', u'целого', u'целым', u'целом',
+                                         u'целая', u'целой', u'целой', u'целую', u'целой', u'целой',
+                                         u'целое', u'целого', u'целому', u'целое', u'целым', u'целом',
+                                         u'целые', u'целых', u'целым', u'целых', u'целыми', u'целых')))
+    dictionary.add_word(Verb(normalized=u'ударил',
+                             forms=(u'ударил', u'ударила', u'ударило', u'ударили',
+                                    u'ударяю', u'ударяем', u'ударяешь', u'ударяете', u'ударяет', u'ударяют',
+                                    u'ударю', u'ударим', u'ударишь', u'ударите', u'ударит', u'ударят')))
+    return dictionary
+
+
+class ArgsTest(TestCase):
+
+    def test_defaults(self):
+        args = Args()
+        self.assertEqual((args.case, args.number, args.gender, args.time, args.person, args.word_case),
+                         (u'им', u'ед', u'мр', u'нст', u'1л', u'строч'))
+
+    def test_update(self):
+        args = Args(u'рд', u'жр')
+        updated = args.update(u'мн', u'тв', u'загл', u'неизвестный')
+        self.assertEqual((args.case, args.number, args.gender), (u'рд', u'ед', u'жр'))
+        self.assertEqual((updated.case, updated.number, updated.gender, updated.word_case), (u'тв', u'мн', u'жр', u'загл'))
+
+    def test_multiple_gender(self):
+        args = Args(u'мн', u'им', u'мн')
+        self.assertEqual((args.number, args.gender), (u'мн', u'мн'))
+
+    def test_interned(self):
+        self.assertTrue(Args(u'рд', u'мн') is Args(u'мн').update(u'рд'))
+        self.assertTrue(Args(u'рд').get_copy() is Args(u'рд'))
+
+    def test_immutable(self):
+        args = Args()
+        self.assertRaises(TextgenException, setattr, args, 'case', u'рд')
+
+    def test_inherit(self):
+        args = Args(u'дт').inherit(Args(u'жр', u'мн', u'вн', u'буд'), Args.NUMBER | Args.GENDER)
+        self.assertEqual((args.case, args.number, args.gender, args.time), (u'дт', u'мн', u'жр', u'нст'))
+
+    def test_order_points(self):
+        self.assertEqual(Args(u'рд', u'мн').order_points(u'С'), 2)
+        self.assertEqual(Args(u'прш').order_points(u'Г'), 0)
+        self.assertRaises(TextgenException, Args().order_points, u'unknown')
+
+    def test_pickle(self):
+        args = Args(u'рд', u'жр')
+        self.assertTrue(pickle.loads(pickle.dumps(args, 2)) is args)
+
+
+class FormsIndexesTest(TestCase):
+
+    def test_tables(self):
+        for word_class, forms_number in ((Noun, 12), (NounGroup, 12), (Adjective, 24), (Pronoun, 24),
+                                         (Verb, 16), (Participle, 48), (ShortParticiple, 8)):
+            word = word_class(normalized=u'слово', forms=[u'%d' % i for i in xrange(forms_number)])
+            for args in Args.all():
+                self.assertEqual(word.get_form(args), word.forms[word_class._form_index(args)])
+
+    def test_multiple_gender(self):
+        adjective = create_test_dictionary().get_word(u'глупый')
+        self.assertEqual(adjective.get_form(Args(u'рд', u'мн', u'мн')), u'глупых')
+
+    def test_no_forms(self):
+        self.assertEqual(Verb(normalized=u'ударил').get_form(Args(u'буд')), u'ударил')
+
+
 class NounTest(TestCase):
 
     def test_create_from_baseword(self):
@@ -628,6 +732,826 @@ class DictionaryTest(TestCase):
             self.assertEqual(dictionary.get_word(u'ударил').normalized, u'ударил')
 
 
+class BinaryDictionaryTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.dictionary.add_word(Noun(normalized=u'ёж', forms=[u'ёж'] * 12, properties=(u'мр',)))
+        self.dictionary.add_word(Verb(normalized=u'бежал'))
+        self.storage = tempfile.NamedTemporaryFile(delete=False).name
+        self.dictionary.save_binary(self.storage)
+
+    def test_load(self):
+        dictionary = Dictionary()
+        dictionary.load_binary(self.storage)
+
+        self.assertEqual(dictionary.data.materialized_number, 0)
+
+        for key, word in self.dictionary.data.items():
+            self.assertTrue(key in dictionary)
+            self.assertEqual(dictionary.get_word(key), word)
+            self.assertEqual(dictionary.get_word(key).__class__, word.__class__)
+
+        self.assertEqual(dictionary.get_word(u'ёж').forms[0], u'ёж')
+        self.assertEqual(sorted(dictionary.data.keys()), sorted(self.dictionary.data.keys()))
+        self.assertEqual(dictionary.get_undefined_words(), [u'бежал'])
+
+    def test_lazy(self):
+        dictionary = Dictionary()
+        dictionary.load_binary(self.storage)
+
+        self.assertTrue(dictionary.get_word(u'тень') is dictionary.get_word(u'тень'))
+        self.assertEqual(dictionary.data.materialized_number, 1)
+
+        self.assertFalse(u'кот' in dictionary)
+        self.assertEqual(dictionary.get_word(u'кот').__class__, Fake)
+
+    def test_add_word(self):
+        dictionary = Dictionary()
+        dictionary.load_binary(self.storage)
+
+        dictionary.add_word(Noun(normalized=u'тень', forms=[u'x'] * 12))
+        self.assertEqual(dictionary.get_word(u'тень').forms[0], u'тень')
+
+        dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот'] * 12))
+        self.assertEqual(dictionary.get_word(u'кот').forms[0], u'кот')
+
+        template = Template.create(morph, u'[{глупый|hero|рд}] [[hero|рд]]')
+        self.assertEqual(template.substitute(dictionary, {'hero': u'обезьянка'}), u'глупой обезьянки')
+
+    def test_wrong_format(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write('x' * 64)
+        self.assertRaises(TextgenException, Dictionary().load_binary, f.name)
+
+
+class FormsIndexTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.dictionary.add_word(Noun(normalized=u'ёж', forms=[u'ёж', u'ежа'] + [u'ёж'] * 10, properties=(u'мр',)))
+        self.dictionary.add_word(Verb(normalized=u'бежал'))
+
+    def test_lemmatize(self):
+        self.assertEqual(self.dictionary.lemmatize(u'Обезьянок'), [(u'обезьянка', 7), (u'обезьянка', 9)])
+        self.assertEqual(self.dictionary.lemmatize(u'ударит'), [(u'ударил', 14)])
+        self.assertEqual(self.dictionary.lemmatize(u'ёжа'), [(u'еж', 1)])
+        self.assertEqual(self.dictionary.lemmatize(u'глупыми'), [(u'глупый', 22)])
+        self.assertEqual(self.dictionary.lemmatize(u'бежал'), [])
+        self.assertEqual(self.dictionary.lemmatize(u'кот'), [])
+
+    def test_rebuild(self):
+        forms_index = self.dictionary.get_forms_index()
+        self.assertTrue(self.dictionary.get_forms_index() is forms_index)
+
+        self.dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот', u'кота'] + [u'кот'] * 10, properties=(u'мр',)))
+        self.assertEqual(self.dictionary.lemmatize(u'кота'), [(u'кот', 1)])
+
+    def test_binary_dictionary(self):
+        storage = tempfile.NamedTemporaryFile(delete=False).name
+        self.dictionary.save_binary(storage)
+
+        dictionary = Dictionary()
+        dictionary.load_binary(storage)
+        self.assertEqual(dictionary.lemmatize(u'теням'), [(u'тень', 8)])
+
+
+class PrerenderTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.template = Template.create(morph, u'[{глупый||загл,жр,тв}] [{обезьянка||тв}] и [[hero|загл]] [{ударил|hero|прш}] [{крыса||вн}]')
+        self.externals = {'hero': u'тень'}
+        self.text = u'Глупой обезьянкой и Тень ударила крысу'
+
+    def test_partial(self):
+        dictionary, version, parts, slots, text = self.template.prerender(self.dictionary)
+        self.assertEqual(parts, (u'Глупой обезьянкой и ', None, u' ', None, u' крысу'))
+        self.assertEqual(len(slots), 2)
+        self.assertEqual(text, None)
+        self.assertEqual(self.template.substitute(self.dictionary, self.externals), self.text)
+
+    def test_constant(self):
+        template = Template.create(morph, u'[{глупый||загл,жр,тв}] %% [{обезьянка||тв}]')
+        dictionary, version, parts, slots, text = template.prerender(self.dictionary)
+        self.assertEqual(text, u'Глупой % обезьянкой')
+        self.assertTrue(template.substitute(self.dictionary, {}) is text)
+
+    def test_dictionary_changed(self):
+        self.template.prerender(self.dictionary)
+        self.dictionary.add_word(Noun(normalized=u'крыса', forms=[u'мышь'] * 12, properties=(u'жр',)), overwrite=True)
+        self.assertEqual(self.template.substitute(self.dictionary, self.externals), u'Глупой обезьянкой и Тень ударила мышь')
+
+    def test_other_dictionary(self):
+        self.template.prerender(self.dictionary)
+        dictionary = create_test_dictionary()
+        dictionary.add_word(Noun(normalized=u'крыса', forms=[u'мышь'] * 12, properties=(u'жр',)), overwrite=True)
+        self.assertEqual(self.template.substitute(dictionary, self.externals), u'Глупой обезьянкой и Тень ударила мышь')
+        self.assertEqual(self.template.substitute(self.dictionary, self.externals), self.text)
+
+    def test_vocabulary(self):
+        vocabulary = Vocabulary()
+        vocabulary.register_type('test')
+        vocabulary.add_phrase('test', self.template)
+
+        storage = tempfile.mkdtemp()
+        vocabulary.save_shards(storage)
+
+        vocabulary = Vocabulary()
+        vocabulary.prerender(self.dictionary)
+        vocabulary.load_shards(storage)
+
+        template = vocabulary.get_random_phrase('test')
+        self.assertTrue(template._prerendered[0] is self.dictionary)
+        self.assertEqual(template.substitute(self.dictionary, self.externals), self.text)
+
+
+class CodegenTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.storage_dir = tempfile.mkdtemp()
+        self.voc_storage = os.path.join(self.storage_dir, 'voc.json')
+        self.module_path = os.path.join(self.storage_dir, 'compiled_voc.py')
+
+        self.vocabulary = Vocabulary()
+        self.vocabulary.register_type('hit')
+        self.vocabulary.add_phrase('hit', Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый||вн,жр}] [[enemy|вн]] на 100%%'))
+        self.vocabulary.add_phrase('hit', Template.create(morph, u'[[number]] [{целый|number|жр,вн}] [{крыса|number|вн}] и [[enemy|hero|тв]]'))
+        self.vocabulary.register_type('constant')
+        self.vocabulary.add_phrase('constant', Template.create(morph, u'[{тень||загл,мн}]'))
+        self.vocabulary.register_type('empty')
+        self.vocabulary.save(self.voc_storage)
+
+        generate_module(self.voc_storage, self.module_path)
+
+    def test_render(self):
+        compiled = load_module(self.module_path, self.voc_storage)
+
+        self.assertEqual(sorted(compiled.data.keys()), ['constant', 'empty', 'hit'])
+        self.assertEqual(compiled.render(self.dictionary, 'empty', {}, default=u'default'), u'default')
+
+        for externals in ({'hero': u'тень', 'enemy': u'обезьянка', 'number': 1},
+                          {'hero': (u'крыса', u'мн'), 'enemy': u'тень', 'number': 5},
+                          {'hero': u'обезьянка', 'enemy': (u'крыса', u'мн'), 'number': 22}):
+            for type_ in ('hit', 'constant'):
+                self.assertEqual([render(self.dictionary, externals) for render in compiled.data[type_]],
+                                 [template.substitute(self.dictionary, externals) for template in self.vocabulary.data[type_]])
+
+        self.assertEqual(compiled.render(self.dictionary, 'constant', {}), u'Тени')
+
+    def test_dictionary(self):
+        dict_storage = os.path.join(self.storage_dir, 'dict.json')
+        self.dictionary.save(dict_storage)
+
+        generate_module(self.voc_storage, self.module_path, dict_storage)
+        compiled = load_module(self.module_path, self.voc_storage, dict_storage)
+
+        externals = {'hero': (u'крыса', u'мн'), 'enemy': u'тень', 'number': 5}
+        self.assertEqual([render(self.dictionary, externals) for render in compiled.data['hit']],
+                         [template.substitute(self.dictionary, externals) for template in self.vocabulary.data['hit']])
+
+        # forms of constant words are written into module
+        self.assertEqual(compiled.data['constant'][0](None, {}), u'Тени')
+
+        self.dictionary.add_word(Noun(normalized=u'тень', forms=(u'тенёк',) * 12, properties=(u'мр',)), overwrite=True)
+        self.dictionary.save(dict_storage)
+        self.assertRaises(TextgenException, load_module, self.module_path, self.voc_storage, dict_storage)
+
+    def test_outdated(self):
+        self.vocabulary.add_phrase('empty', Template.create(morph, u'[[hero]]'))
+        self.vocabulary.save(self.voc_storage)
+        self.assertRaises(TextgenException, load_module, self.module_path, self.voc_storage)
+
+        generate_module(self.voc_storage, self.module_path)
+        compiled = load_module(self.module_path, self.voc_storage)
+        self.assertEqual(compiled.render(self.dictionary, 'empty', {'hero': u'тень'}), u'тень')
+
+    def test_line_breaks_in_template(self):
+        separators = u'\n\r\x0b\x0c\x1c\x85\u2028\u2029'
+        self.vocabulary.add_phrase('empty', Template.create(morph, u'[[hero]]%s[[hero|рд]]' % separators))
+        self.vocabulary.save(self.voc_storage)
+
+        generate_module(self.voc_storage, self.module_path)
+        compiled = load_module(self.module_path, self.voc_storage)
+        self.assertEqual(compiled.render(self.dictionary, 'empty', {'hero': u'тень'}), u'тень%sтени' % separators)
+
+
+class RenderSequenceTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.vocabulary = Vocabulary()
+        for type_, template in (('start', u'[[hero|загл]] и [[enemy]]'),
+                                ('hit', u'[[hero|загл]] [{ударил|hero|прш}] [[enemy|вн]] на [[damage]]'),
+                                ('finish', u'[[enemy|загл]] [{ударил|enemy|прш,мн}]')):
+            self.vocabulary.register_type(type_)
+            self.vocabulary.add_phrase(type_, Template.create(morph, template))
+        self.vocabulary.register_type('empty')
+
+    def test_render(self):
+        self.assertEqual(self.vocabulary.render_sequence(self.dictionary,
+                                                         ['start', 'hit', 'hit', 'empty', 'finish'],
+                                                         {'hero': u'тень', 'enemy': u'обезьянка', 'damage': 1},
+                                                         overrides=[None, None, {'damage': 5, 'hero': u'крыса'}, None, {}],
+                                                         default=u'-'),
+                         [u'Тень и обезьянка',
+                          u'Тень ударила обезьянку на 1',
+                          u'Крыса ударила обезьянку на 5',
+                          u'-',
+                          u'Обезьянка ударили'])
+
+    def test_wrong_overrides(self):
+        self.assertRaises(TextgenException, self.vocabulary.render_sequence, self.dictionary, ['start', 'hit'], {}, [None])
+
+
+class RenderServerTest(TestCase):
+
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        voc_storage = os.path.join(self.storage_dir, 'voc.json')
+        dict_storage = os.path.join(self.storage_dir, 'dict.json')
+
+        vocabulary = Vocabulary()
+        vocabulary.register_type('hit')
+        vocabulary.add_phrase('hit', Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [[enemy|вн]] на [[damage]]'))
+        vocabulary.save(voc_storage)
+
+        create_test_dictionary().save(dict_storage)
+
+        self.service = RenderService(voc_storage, dict_storage)
+        self.address = os.path.join(self.storage_dir, 'textgen.sock')
+        self.server = create_server(self.address, self.service)
+
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.client = RenderClient(self.address, timeout=10)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+    def test_render(self):
+        self.assertEqual(self.client.render('hit', {'hero': u'тень', 'enemy': [u'крыса', u'мн'], 'damage': 5}), u'Тень ударила крыс на 5')
+        self.assertEqual(self.client.render('unknown', {}, default=u'-'), u'-')
+        self.assertEqual(self.client.render_sequence(['hit', 'hit'], {'hero': u'тень', 'enemy': u'крыса', 'damage': 1}, [None, {'damage': 2}]),
+                         [u'Тень ударила крысу на 1', u'Тень ударила крысу на 2'])
+
+    def test_errors(self):
+        self.assertRaises(TextgenException, self.client.call, 'unknown_method')
+        self.assertRaises(TextgenException, self.client.render, 'hit', {'hero': u'тень'})
+        # connection is alive after errors
+        self.assertEqual(self.client.render('hit', {'hero': u'тень', 'enemy': u'крыса', 'damage': 1}), u'Тень ударила крысу на 1')
+
+    def test_pipeline_and_stats(self):
+        results = self.client.pipeline([('render', {'type': 'hit', 'externals': {'hero': u'тень', 'enemy': u'крыса', 'damage': i}})
+                                        for i in xrange(10)])
+        self.assertEqual(results, [u'Тень ударила крысу на %d' % i for i in xrange(10)])
+
+        stats = self.client.stats()
+        self.assertEqual(stats['render']['count'], 10)
+        self.assertEqual(sorted(stats['render']['percentiles'].keys()), ['p50', 'p90', 'p99'])
+
+    def test_big_pipeline(self):
+        # requests and responses are much bigger than socket buffers
+        externals_list = [{'hero': u'тень', 'enemy': u'крыса', 'damage': i} for i in xrange(300)]
+        expected = [u'Тень ударила крысу на %d' % i for i in xrange(300)]
+
+        results = self.client.pipeline([('render_many', {'type': 'hit', 'externals_list': externals_list})] * 100)
+
+        self.assertEqual(results, [expected] * 100)
+        self.assertEqual(self.client.render('hit', {'hero': u'тень', 'enemy': u'крыса', 'damage': 1}), u'Тень ударила крысу на 1')
+
+    def test_render_many_in_pool(self):
+        self.service.pool = multiprocessing.Pool(2, initializer=server_module._init_render_worker,
+                                                 initargs=(self.service.voc_storage, self.service.dict_storage))
+        self.service.POOL_BATCH_SIZE = 3
+
+        externals_list = [{'hero': u'тень', 'enemy': u'крыса', 'damage': i} for i in xrange(10)]
+        self.assertEqual(self.client.render_many('hit', externals_list), [u'Тень ударила крысу на %d' % i for i in xrange(10)])
+
+
+class SnapshotsTest(TestCase):
+
+    THREADS_NUMBER = 8
+    RENDERS_NUMBER = 200
+    CHANGES_NUMBER = 50
+
+    def setUp(self):
+        self.vocabulary = Vocabulary()
+        self.vocabulary.register_type('hit')
+        self.vocabulary.add_phrase('hit', Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый|enemy|вн}] [[enemy|вн]]'))
+
+        self.dictionary = create_test_dictionary()
+        self.set_words_version(self.dictionary, 0)
+        self.dictionary.render_cache = LRUCache(size=100)
+
+        self.externals = {'hero': u'тень', 'enemy': u'крыса'}
+
+    @staticmethod
+    def set_words_version(dictionary, version):
+        '''
+        all forms of words in phrase get version suffix, so phrase rendered from mixed dictionaries can be detected
+        '''
+        dictionary.add_word(Noun(normalized=u'крыса', forms=[u'крыса_%d' % version] * 12, properties=(u'жр',)), overwrite=True)
+        dictionary.add_word(Adjective(normalized=u'глупый', forms=[u'глупый_%d' % version] * 24), overwrite=True)
+
+    def test_freeze(self):
+        self.dictionary.freeze()
+        self.vocabulary.freeze()
+
+        self.assertRaises(TextgenException, self.dictionary.add_word, Noun(normalized=u'кот', forms=[u'кот'] * 12, properties=(u'мр',)))
+        self.assertRaises(TextgenException, self.dictionary.clear)
+        self.assertRaises(TextgenException, self.dictionary.compact)
+        self.assertRaises(TextgenException, self.vocabulary.register_type, 'miss')
+        self.assertRaises(TextgenException, self.vocabulary.add_phrase, 'hit', Template.create(morph, u'[[hero]]'))
+
+        dictionary = self.dictionary.copy()
+        self.set_words_version(dictionary, 1)
+        self.assertFalse(dictionary.frozen)
+        self.assertEqual(self.dictionary.get_word(u'крыса').forms[0], u'крыса_0')
+        self.assertEqual(dictionary.get_word(u'крыса').forms[0], u'крыса_1')
+        self.assertTrue(dictionary.render_cache is not self.dictionary.render_cache)
+
+        vocabulary = self.vocabulary.copy()
+        vocabulary.register_type('miss')
+        self.assertFalse('miss' in self.vocabulary)
+
+    def test_publish(self):
+        self.vocabulary.prerender(self.dictionary)
+
+        holder = SnapshotHolder(self.vocabulary, self.dictionary)
+        old_snapshot = holder.snapshot
+
+        self.assertEqual(old_snapshot.render('hit', self.externals), u'Тень ударила глупый_0 крыса_0')
+
+        new_snapshot = holder.change_dictionary(lambda dictionary: self.set_words_version(dictionary, 1))
+
+        self.assertTrue(holder.snapshot is new_snapshot)
+        self.assertEqual(new_snapshot.version, old_snapshot.version + 1)
+        self.assertTrue(new_snapshot.vocabulary._prerender_dictionary is new_snapshot.dictionary)
+        self.assertEqual(new_snapshot.render('hit', self.externals), u'Тень ударила глупый_1 крыса_1')
+        # render, which has already taken old snapshot, uses old words
+        self.assertEqual(old_snapshot.render('hit', self.externals), u'Тень ударила глупый_0 крыса_0')
+
+        holder.change_vocabulary(lambda vocabulary: vocabulary.register_type('miss'))
+        self.assertEqual(holder.snapshot.render('miss', self.externals, default=u'-'), u'-')
+        self.assertFalse('miss' in new_snapshot.vocabulary)
+
+    def test_render_cache_follows_dictionary(self):
+        self.vocabulary.render_cache = self.dictionary.render_cache
+
+        holder = SnapshotHolder(self.vocabulary, self.dictionary)
+        self.assertEqual(holder.snapshot.render('hit', self.externals), u'Тень ударила глупый_0 крыса_0')
+
+        snapshot = holder.change_dictionary(lambda dictionary: self.set_words_version(dictionary, 1))
+
+        self.assertTrue(snapshot.vocabulary.render_cache is snapshot.dictionary.render_cache)
+        self.assertEqual(snapshot.render('hit', self.externals), u'Тень ударила глупый_1 крыса_1')
+
+        dictionary = snapshot.dictionary.copy()
+        self.set_words_version(dictionary, 2)
+        snapshot = holder.publish(dictionary=dictionary)
+
+        self.assertTrue(snapshot.vocabulary.render_cache is dictionary.render_cache)
+        self.assertEqual(snapshot.render('hit', self.externals), u'Тень ударила глупый_2 крыса_2')
+
+    def test_prerendered_plans_are_not_shared(self):
+        self.vocabulary.prerender(self.dictionary)
+
+        holder = SnapshotHolder(self.vocabulary, self.dictionary)
+        old_snapshot = holder.snapshot
+        old_template = old_snapshot.get_random_phrase('hit')
+
+        new_snapshot = holder.change_dictionary(lambda dictionary: self.set_words_version(dictionary, 1))
+        new_template = new_snapshot.get_random_phrase('hit')
+
+        self.assertTrue(new_template is not old_template)
+        self.assertTrue(old_template._prerendered[0] is old_snapshot.dictionary)
+        self.assertTrue(new_template._prerendered[0] is new_snapshot.dictionary)
+
+        # vocabulary change with the same dictionary keeps templates and their plans
+        snapshot = holder.change_vocabulary(lambda vocabulary: vocabulary.register_type('miss'))
+        self.assertTrue(snapshot.get_random_phrase('hit') is new_template)
+
+    def test_concurrent_rendering(self):
+        self.vocabulary.prerender(self.dictionary)
+
+        holder = SnapshotHolder(self.vocabulary, self.dictionary)
+
+        errors = []
+        results_versions = set()
+        changed = threading.Event()
+
+        def render():
+            try:
+                renders_number = 0
+                # render until all changes are published, so renders and changes overlap
+                while not changed.is_set() or renders_number < self.RENDERS_NUMBER:
+                    renders_number += 1
+                    snapshot = holder.snapshot
+                    results = [snapshot.render('hit', self.externals)] + snapshot.render_many('hit', [self.externals] * 3)
+                    for result in results:
+                        version = result.rsplit(u'_', 1)[1]
+                        if result != u'Тень ударила глупый_%s крыса_%s' % (version, version):
+                            errors.append(result)
+                        results_versions.add(int(version))
+            except Exception, e:
+                errors.append(e)
+
+        def change():
+            for version in xrange(1, self.CHANGES_NUMBER + 1):
+                holder.change_dictionary(lambda dictionary: self.set_words_version(dictionary, version))
+                time.sleep(0.001)
+            changed.set()
+
+        threads = [threading.Thread(target=render) for i in xrange(self.THREADS_NUMBER)]
+        threads.append(threading.Thread(target=change))
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(holder.snapshot.version, self.CHANGES_NUMBER + 1)
+        self.assertTrue(results_versions <= set(xrange(self.CHANGES_NUMBER + 1)))
+        self.assertTrue(len(results_versions) > 2)
+        self.assertEqual(holder.snapshot.render('hit', self.externals), u'Тень ударила глупый_%d крыса_%d' % (self.CHANGES_NUMBER, self.CHANGES_NUMBER))
+
+
+class HotReloadTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dict_storage = os.path.join(self.directory, 'dict.json')
+
+        self.vocabulary = Vocabulary()
+        self.vocabulary.register_type('battle_hit', shard='battle')
+        self.vocabulary.register_type('quest_start', shard='quest')
+        self.vocabulary.add_phrase('battle_hit', Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [[enemy|вн]]'))
+        self.vocabulary.add_phrase('quest_start', Template.create(morph, u'[[hero|загл]] начала задание'))
+        self.vocabulary.save_shards(self.directory)
+
+        self.dictionary = create_test_dictionary()
+        self.dictionary.save(self.dict_storage)
+
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory)
+
+        dictionary = Dictionary()
+        dictionary.load(self.dict_storage)
+        dictionary.render_cache = LRUCache(size=100)
+        vocabulary.render_cache = dictionary.render_cache
+        vocabulary.prerender(dictionary)
+
+        self.holder = SnapshotHolder(vocabulary, dictionary)
+
+        self.externals = {'hero': u'тень', 'enemy': u'крыса'}
+
+    def change_quest_shard(self):
+        self.vocabulary.remove_type('quest_start')
+        self.vocabulary.register_type('quest_start', shard='quest')
+        self.vocabulary.add_phrase('quest_start', Template.create(morph, u'[[hero|загл]] взяла задание'))
+        self.vocabulary.register_type('quest_finish', shard='quest')
+        self.vocabulary.add_phrase('quest_finish', Template.create(morph, u'[[hero|загл]] выполнила задание'))
+        # all shards are rewritten, but content of battle shard is the same
+        self.vocabulary.save_shards(self.directory)
+
+    def test_reload_changed_shards(self):
+        old_snapshot = self.holder.snapshot
+        battle_template = old_snapshot.get_random_phrase('battle_hit')
+        quest_template = old_snapshot.get_random_phrase('quest_start')
+
+        self.assertEqual(old_snapshot.render('battle_hit', self.externals), u'Тень ударила крысу')
+        self.assertEqual(old_snapshot.render('quest_start', self.externals), u'Тень начала задание')
+        self.assertEqual(len(old_snapshot.dictionary.render_cache), 2)
+
+        self.assertTrue(self.holder.reload(shards=True) is old_snapshot)
+
+        self.change_quest_shard()
+
+        self.assertEqual(old_snapshot.vocabulary.get_changed_shards(), set(['quest']))
+
+        snapshot = self.holder.reload(shards=True)
+
+        self.assertEqual(snapshot.version, old_snapshot.version + 1)
+        self.assertTrue(snapshot.dictionary is old_snapshot.dictionary)
+        self.assertEqual(snapshot.render('quest_start', self.externals), u'Тень взяла задание')
+        self.assertEqual(snapshot.render('quest_finish', self.externals), u'Тень выполнила задание')
+
+        # unchanged shard keeps its templates with their render plans and cached results
+        self.assertTrue(snapshot.get_random_phrase('battle_hit') is battle_template)
+        self.assertTrue(battle_template._prerendered[0] is snapshot.dictionary)
+        self.assertTrue(any(key[0] is battle_template for key in snapshot.dictionary.render_cache._data))
+        self.assertFalse(any(key[0] is quest_template for key in snapshot.dictionary.render_cache._data))
+
+        self.assertEqual(snapshot.vocabulary.get_changed_shards(), set())
+
+        self.assertEqual(old_snapshot.render('quest_start', self.externals), u'Тень начала задание')
+
+    def test_reload_in_background(self):
+        old_snapshot = self.holder.snapshot
+
+        self.change_quest_shard()
+
+        dictionary = create_test_dictionary()
+        dictionary.add_word(Noun(normalized=u'крыса', forms=[u'мышь'] * 12, properties=(u'жр',)), overwrite=True)
+        dictionary.save(self.dict_storage)
+
+        thread = self.holder.reload(dict_storage=self.dict_storage, shards=True, background=True)
+        thread.join()
+
+        self.assertEqual(self.holder.reload_error, None)
+
+        snapshot = self.holder.snapshot
+
+        self.assertEqual(snapshot.version, old_snapshot.version + 1)
+        self.assertTrue(snapshot.vocabulary.frozen and snapshot.dictionary.frozen)
+        self.assertTrue(snapshot.vocabulary._prerender_dictionary is snapshot.dictionary)
+        self.assertTrue(snapshot.vocabulary.render_cache is snapshot.dictionary.render_cache)
+        self.assertEqual(snapshot.dictionary.render_cache.size, 100)
+
+        self.assertEqual(snapshot.render('battle_hit', self.externals), u'Тень ударила мышь')
+        self.assertEqual(snapshot.render('quest_finish', self.externals), u'Тень выполнила задание')
+        self.assertEqual(old_snapshot.render('battle_hit', self.externals), u'Тень ударила крысу')
+
+    def test_reload_error(self):
+        old_snapshot = self.holder.snapshot
+
+        thread = self.holder.reload(dict_storage=os.path.join(self.directory, 'unknown.json'), background=True)
+        thread.join()
+
+        self.assertTrue(isinstance(self.holder.reload_error, IOError))
+        self.assertTrue(self.holder.snapshot is old_snapshot)
+
+    def test_reload_vocabulary(self):
+        voc_storage = os.path.join(self.directory, 'voc.json')
+        self.change_quest_shard()
+        self.vocabulary.save(voc_storage)
+
+        snapshot = self.holder.reload(voc_storage=voc_storage)
+
+        self.assertEqual(snapshot.render('quest_start', self.externals), u'Тень взяла задание')
+        self.assertTrue(snapshot.vocabulary._prerender_dictionary is snapshot.dictionary)
+        self.assertRaises(TextgenException, snapshot.vocabulary.get_changed_shards)
+
+
+class BatchRenderTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.template = Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый||вн,жр}] [{крыса||вн}] и [[number]] [{крыса|number|}]')
+        self.externals = [{'hero': u'тень', 'number': 1},
+                          {'hero': u'обезьянка', 'number': 5},
+                          {'hero': u'тень', 'number': 1.5},
+                          {'hero': (u'крыса', u'мн'), 'number': 3}]
+
+    def test_substitute_many(self):
+        expected = [self.template.substitute(self.dictionary, externals) for externals in self.externals]
+        self.assertEqual(self.template.substitute_many(self.dictionary, self.externals), expected)
+        self.assertEqual(expected[0], u'Тень ударила глупую крысу и 1 крыса')
+        self.assertEqual(expected[2], u'Тень ударила глупую крысу и 1.5 крыс')
+
+    def test_iter_substitute(self):
+        results = self.template.iter_substitute(self.dictionary, iter(self.externals))
+        self.assertEqual(next(results), u'Тень ударила глупую крысу и 1 крыса')
+
+        self.dictionary.add_word(Noun(normalized=u'тень', forms=[u'мышь'] * 12, properties=(u'жр',)), overwrite=True)
+        self.dictionary.add_word(Adjective(normalized=u'глупый', forms=[u'смелую'] * 24), overwrite=True)
+        self.assertEqual(next(results), u'Обезьянка ударила смелую крысу и 5 крыс')
+        self.assertEqual(next(results), u'Мышь ударила смелую крысу и 1.5 крыс')
+
+    def test_constant(self):
+        template = Template.create(morph, u'[{глупый||загл,вн,жр}] [{крыса||вн}]')
+        self.assertEqual(template.substitute_many(self.dictionary, [{}, {}]), [u'Глупую крысу', u'Глупую крысу'])
+
+    def test_vocabulary(self):
+        vocabulary = Vocabulary()
+        vocabulary.register_type('test')
+        vocabulary.add_phrase('test', self.template)
+        vocabulary.add_phrase('test', Template.create(morph, u'[[hero]]: [[number]]'))
+
+        results = vocabulary.render_many(self.dictionary, 'test', self.externals)
+        self.assertEqual(len(results), len(self.externals))
+        for externals, result in zip(self.externals, results):
+            self.assertTrue(result in [template.substitute(self.dictionary, externals) for template in vocabulary.data['test']])
+
+        self.assertEqual(vocabulary.render_many(self.dictionary, 'unknown', self.externals[:2], default=u''), [u'', u''])
+
+
+@skipIf(vectorized.numpy is None, 'numpy is not installed')
+class VectorizedTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.numbers = vectorized.numpy.array([0, 1, 2, 4, 5, 11, 12, 14, 21, 22, 25, 101, 111, -1])
+
+    def test_plural_classes(self):
+        for numbers in (self.numbers, vectorized.numpy.array([1.0, 1.5, 21.0, 3.0])):
+            self.assertEqual(vectorized.get_plural_classes(numbers).tolist(),
+                             [WordBase.get_plural_class(number) for number in numbers.tolist()])
+
+    def test_pluralize_forms(self):
+        word = self.dictionary.get_word(u'крыса')
+        for args in [(), (u'тв',), (u'вн', u'загл')]:
+            self.assertEqual(vectorized.pluralize_forms(word, self.numbers, args).tolist(),
+                             [word.get_form(word.update_args(Args(*args), Numeral(number), None)) for number in self.numbers.tolist()])
+
+    def test_agreement_with_states(self):
+        word = self.dictionary.get_word(u'глупый')
+        states = vectorized.get_states(genders=[0, 1, 2, 1], numbers=[0, 0, 0, 1], cases=[0, 3, 4, 1])
+        forms = vectorized.FormsTable(word).get_forms(vectorized.get_agreement_states(word, 4, dependences_states=states))
+        self.assertEqual(forms.tolist(), [u'глупый', u'глупую', u'глупым', u'глупых'])
+
+    def test_render_numerals(self):
+        template = Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [[number]] [{целый|number|жр,вн}] [{крыса|number|вн}] (всего [[number]])')
+        externals = {'hero': u'тень'}
+
+        result = vectorized.render_numerals(template, self.dictionary, self.numbers, 'number', externals)
+
+        expected = []
+        for number in self.numbers.tolist():
+            externals['number'] = number
+            expected.append(template.substitute(self.dictionary, externals))
+
+        self.assertEqual(result.tolist(), expected)
+        self.assertEqual(result[1], u'Тень ударила 1 целую крысу (всего 1)')
+
+    def test_multidimensional(self):
+        numbers = self.numbers[:12].reshape((3, 4))
+
+        word = self.dictionary.get_word(u'крыса')
+        forms = vectorized.pluralize_forms(word, numbers, (u'вн',))
+        self.assertEqual(forms.shape, (3, 4))
+        self.assertEqual(forms.tolist(), [[word.get_form(word.update_args(Args(u'вн'), Numeral(number), None)) for number in row]
+                                          for row in numbers.tolist()])
+
+        word = self.dictionary.get_word(u'глупый')
+        states = vectorized.get_states(genders=[[0, 1], [2, 1]], numbers=[[0, 0], [0, 1]], cases=[[0, 3], [4, 1]])
+        agreement_states = vectorized.get_agreement_states(word, (2, 2), dependences_states=states, numbers=[[1, 2], [5, 21]])
+        self.assertEqual(agreement_states.shape, (2, 2))
+        self.assertEqual(vectorized.FormsTable(word).get_forms(agreement_states).tolist(),
+                         [[word.get_form(word.update_args(word.update_args(Args(), None, Args.from_state(state)), Numeral(number), None))
+                           for state, number in zip(states_row, numbers_row)]
+                          for states_row, numbers_row in zip(states.tolist(), [[1, 2], [5, 21]])])
+
+        template = Template.create(morph, u'[[number]] [{крыса|number|вн}]')
+        self.assertEqual(vectorized.render_numerals(template, self.dictionary, numbers, 'number').tolist(),
+                         [[template.substitute(self.dictionary, {'number': number}) for number in row] for row in numbers.tolist()])
+
+
+class BoundTemplatesTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.template = Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [[enemy|вн]] [[number]] [{целый|number|жр}] [{крыса|number|}]')
+
+    def test_template(self):
+        bound = self.template.bind(self.dictionary, {'hero': u'тень'})
+        self.assertEqual(bound.substitute({'enemy': u'обезьянка', 'number': 5}), u'Тень ударила обезьянку 5 целых крыс')
+        self.assertEqual(bound.substitute({'enemy': u'крыса', 'number': 1}), u'Тень ударила крысу 1 целая крыса')
+        # call externals have priority
+        self.assertEqual(bound.substitute({'hero': u'крыса', 'enemy': u'тень', 'number': 2}), u'Крыса ударила тень 2 целые крысы')
+
+    def test_all_fixed(self):
+        bound = self.template.bind(self.dictionary, {'hero': u'тень', 'enemy': u'крыса', 'number': 3})
+        self.assertEqual(bound.substitute(), u'Тень ударила крысу 3 целые крысы')
+
+    def test_dictionary_changed(self):
+        bound = self.template.bind(self.dictionary, {'hero': u'тень'})
+        self.dictionary.add_word(Noun(normalized=u'тень', forms=[u'мышь'] * 12, properties=(u'жр',)), overwrite=True)
+        self.assertEqual(bound.substitute({'enemy': u'крыса', 'number': 1}), u'Мышь ударила крысу 1 целая крыса')
+
+    def test_vocabulary(self):
+        vocabulary = Vocabulary()
+        vocabulary.register_type('test')
+        vocabulary.add_phrase('test', self.template)
+
+        bound = vocabulary.bind(self.dictionary, {'hero': u'тень'})
+        self.assertEqual(bound.substitute('test', {'enemy': u'крыса', 'number': 21}), u'Тень ударила крысу 21 целая крыса')
+        self.assertEqual(bound.substitute('unknown', {}, default=u'default'), u'default')
+        self.assertEqual(bound.get_random_phrase('unknown'), None)
+
+
+class TemplateVariantsTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот', u'кота', u'коту', u'кота', u'котом', u'коте',
+                                                                u'коты', u'котов', u'котам', u'котов', u'котами', u'котах'], properties=(u'мр',)))
+        self.template = Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый|enemy|вн}] [[enemy|вн]]')
+
+    def test_signatures(self):
+        self.assertEqual(self.template.substitute(self.dictionary, {'hero': u'тень', 'enemy': u'кот'}), u'Тень ударила глупого кота')
+        self.assertEqual(self.template.substitute(self.dictionary, {'hero': u'крыса', 'enemy': u'кот'}), u'Крыса ударила глупого кота')
+        self.assertEqual(len(self.template._variants[2]), 1)
+
+        self.assertEqual(self.template.substitute(self.dictionary, {'hero': u'кот', 'enemy': u'обезьянка'}), u'Кот ударил глупую обезьянку')
+        self.assertEqual(len(self.template._variants[2]), 2)
+
+    def test_numerals(self):
+        template = Template.create(morph, u'[[number]] [{целый|number|жр}] [{крыса|number|}]')
+        self.assertEqual(template.substitute(self.dictionary, {'number': 1}), u'1 целая крыса')
+        self.assertEqual(template.substitute(self.dictionary, {'number': 21}), u'21 целая крыса')
+        self.assertEqual(template.substitute(self.dictionary, {'number': 3}), u'3 целые крысы')
+        self.assertEqual(template.substitute(self.dictionary, {'number': 5}), u'5 целых крыс')
+        self.assertEqual(len(template._variants[2]), 3)
+
+    def test_dictionary_changed(self):
+        externals = {'hero': u'тень', 'enemy': u'кот'}
+        self.template.substitute(self.dictionary, externals)
+        self.dictionary.add_word(Adjective(normalized=u'глупый', forms=[u'смелого'] * 24), overwrite=True)
+        self.assertEqual(self.template.substitute(self.dictionary, externals), u'Тень ударила смелого кота')
+
+
+class SlotsTest(TestCase):
+
+    def test_no_dict(self):
+        dictionary = create_test_dictionary()
+        template = Template.create(morph, u'[[hero|загл]] ударил [{тень|hero|вн}]')
+        for obj in [template, dictionary, Vocabulary()] + dictionary.data.values():
+            self.assertFalse(hasattr(obj, '__dict__'))
+
+    def test_interned(self):
+        data = json.loads(json.dumps([Template.create(morph, u'[[hero|вн,мн]]').serialize(),
+                                      Template.create(morph, u'[[hero|вн,мн]] и [[enemy]]').serialize()]))
+        template_1, template_2 = [Template.deserialize(template_data) for template_data in data]
+
+        self.assertEqual(template_1.externals, ((u'hero', (), u'e_0', (u'вн', u'мн'), u'hero'),))
+        self.assertTrue(template_1.externals[0][0] is template_2.externals[0][0])
+        self.assertTrue(template_1.externals[0][3] is template_2.externals[0][3])
+
+        word_1 = WordBase.deserialize(json.loads(json.dumps(create_test_dictionary().get_word(u'тень').serialize())))
+        word_2 = WordBase.deserialize(json.loads(json.dumps(create_test_dictionary().get_word(u'крыса').serialize())))
+        self.assertTrue(word_1.properties is word_2.properties)
+        self.assertTrue(word_1.forms[1] is word_1.forms[2])
+
+    def test_pickle(self):
+        dictionary = create_test_dictionary()
+        template = Template.create(morph, u'[[hero|загл]] ударил [{тень|hero|вн}]')
+        externals = {'hero': u'обезьянка'}
+
+        for protocol in (0, 2):
+            loaded_template = pickle.loads(pickle.dumps(template, protocol))
+            self.assertEqual(loaded_template.substitute(dictionary, externals), template.substitute(dictionary, externals))
+
+            word = dictionary.get_word(u'глупый')
+            self.assertEqual(pickle.loads(pickle.dumps(word, protocol)), word)
+
+    def test_identity(self):
+        dictionary = create_test_dictionary()
+        word = dictionary.get_word(u'тень')
+
+        identity = word.identity
+        self.assertTrue(word.identity is identity)
+        self.assertEqual(pickle.loads(pickle.dumps(word, 2)).identity, identity)
+
+        dictionary.compact()
+        self.assertTrue(word.identity is identity)
+        self.assertEqual(WordBase.deserialize(word.serialize()).identity, identity)
+
+
+class CompactDictionaryTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.plain = create_test_dictionary()
+        self.dictionary.compact()
+
+    def test_forms_not_changed(self):
+        for key, word in self.plain.data.items():
+            compacted = self.dictionary.get_word(key)
+            self.assertTrue(isinstance(compacted.forms, Paradigm))
+            self.assertEqual(compacted, word)
+            self.assertEqual(compacted.serialize(), word.serialize())
+            for args in Args.all():
+                self.assertEqual(compacted.get_form(args), word.get_form(args))
+
+    def test_shared_endings(self):
+        self.assertEqual(self.dictionary.get_word(u'глупый').forms.stem, u'глуп')
+        self.assertTrue(self.dictionary.get_word(u'глупый').forms.endings is self.dictionary.get_word(u'целый').forms.endings)
+        self.assertEqual(self.dictionary.paradigms.tables_number, 5)
+
+    def test_added_word(self):
+        self.dictionary.add_word(Adjective(normalized=u'смелый', forms=[form.replace(u'глуп', u'смел') for form in self.plain.get_word(u'глупый').forms]))
+        self.assertTrue(self.dictionary.get_word(u'смелый').forms.endings is self.dictionary.get_word(u'глупый').forms.endings)
+        self.assertEqual(self.dictionary.get_word(u'смелый').get_form(Args(u'мн', u'тв')), u'смелыми')
+
+    def test_save_load(self):
+        storage = tempfile.NamedTemporaryFile(delete=False).name
+        self.dictionary.save(storage)
+
+        dictionary = Dictionary()
+        dictionary.load(storage)
+        self.assertEqual(dictionary.data, self.plain.data)
+
+
 class VocabularyTest(TestCase):
 
     def setUp(self):
@@ -680,6 +1604,113 @@ class VocabularyTest(TestCase):
 
 
 
+class PackedDictionaryTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.dictionary.add_word(Verb(normalized=u'бежал'))
+        self.storage = tempfile.NamedTemporaryFile(delete=False).name
+        self.dictionary.save_binary(self.storage)
+        self.template = Template.create(morph, u'[[hero|загл]] [{ударил|hero|прш}] [{глупый||вн,жр}] [[enemy|вн]]')
+
+    def check_dictionary(self, dictionary):
+        for key, word in self.dictionary.data.items():
+            packed_word = dictionary.get_word(key)
+            self.assertEqual(packed_word, word)
+            self.assertEqual(packed_word.serialize(), word.serialize())
+            self.assertEqual(packed_word.identity, word.identity)
+            for args in Args.all():
+                self.assertEqual(packed_word.get_form(args), word.get_form(args))
+
+        self.assertEqual(self.template.substitute(dictionary, {'hero': u'тень', 'enemy': (u'крыса', u'мн')}), u'Тень ударила глупую крыс')
+
+    def test_load(self):
+        for in_memory in (False, True):
+            dictionary = Dictionary()
+            dictionary.load_packed(self.storage, in_memory=in_memory)
+            self.check_dictionary(dictionary)
+
+            self.assertEqual(dictionary.data.materialized_number, 0)
+            self.assertFalse(dictionary.get_word(u'тень') is dictionary.get_word(u'тень'))
+            self.assertEqual(dictionary.get_word(u'тень').forms[-1], u'тенях')
+            self.assertEqual(dictionary.get_word(u'тень').forms[1:3], (u'тени', u'тени'))
+            self.assertEqual(dictionary.get_undefined_words(), [u'бежал'])
+
+    def test_forked_processes(self):
+        dictionary = Dictionary()
+        dictionary.load_packed(self.storage)
+
+        def render(connection):
+            connection.send(self.template.substitute(dictionary, {'hero': u'обезьянка', 'enemy': u'тень'}))
+            connection.close()
+
+        parent_connection, child_connection = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=render, args=(child_connection,))
+        process.start()
+        self.assertEqual(parent_connection.recv(), u'Обезьянка ударила глупую тень')
+        process.join()
+
+
+class ShardedVocabularyTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        vocabulary = Vocabulary()
+        vocabulary.register_type('battle_start', shard='battle')
+        vocabulary.register_type('battle_hit', shard='battle')
+        vocabulary.register_type('quest_start', shard='quest')
+        vocabulary.register_type('other')
+        vocabulary.add_phrase('battle_start', Template.create(morph, u'[[hero|им]] начал бой'))
+        vocabulary.add_phrase('battle_hit', Template.create(morph, u'[[hero|им]] ударил'))
+        vocabulary.add_phrase('quest_start', Template.create(morph, u'[[hero|им]] начал задание'))
+        vocabulary.add_phrase('other', Template.create(morph, u'[[hero|им]]'))
+        vocabulary.save_shards(self.directory)
+
+    def test_lazy_loading(self):
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory)
+
+        self.assertEqual(vocabulary.data, {})
+        self.assertTrue('quest_start' in vocabulary)
+        self.assertFalse('quest_finish' in vocabulary)
+
+        self.assertEqual(vocabulary.get_random_phrase('battle_hit').template, u'%(e_0)s ударил')
+        self.assertEqual(sorted(vocabulary.data.keys()), ['battle_hit', 'battle_start'])
+        self.assertEqual(vocabulary.loaded_shards, set(['battle']))
+
+        self.assertEqual(vocabulary.get_random_phrase('unknown', default=1), 1)
+
+    def test_preload(self):
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory, preload=['quest_start', 'other'])
+        self.assertEqual(vocabulary.loaded_shards, set(['quest', Vocabulary.DEFAULT_SHARD]))
+
+    def test_register_existed_type(self):
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory)
+        self.assertRaises(TextgenException, vocabulary.register_type, 'battle_hit')
+
+    def test_save(self):
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory)
+
+        storage = os.path.join(self.directory, 'vocabulary.json')
+        vocabulary.save(storage)
+
+        vocabulary = Vocabulary()
+        vocabulary.load(storage)
+        self.assertEqual(sorted(vocabulary.data.keys()), ['battle_hit', 'battle_start', 'other', 'quest_start'])
+
+    def test_freeze(self):
+        vocabulary = Vocabulary()
+        vocabulary.load_shards(self.directory)
+        vocabulary.freeze()
+
+        self.assertEqual(vocabulary.loaded_shards, set(['battle', 'quest', Vocabulary.DEFAULT_SHARD]))
+        self.assertRaises(TextgenException, vocabulary.load_shard, 'battle')
+
+
 class TemplateTest(TestCase):
 
     def setUp(self):
@@ -778,6 +1809,444 @@ class TemplateTest(TestCase):
         self.assertEqual(result, u'Первое предложение. Подставила слово в начало, а затем вставим имя от Обезьянки. Тень пришла.')
 
 
+class TemplatePlanTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+
+    def test_substitute(self):
+        template = Template.create(morph, u'[{глупый|hero|рд}] [[hero|рд]] и [[number||]] [[mob|number|им]]')
+        self.assertEqual(template.substitute(self.dictionary, {'hero': u'обезьянка', 'mob': u'крыса', 'number': 5}),
+                         u'глупой обезьянки и 5 крыс')
+        self.assertEqual(template.substitute(self.dictionary, {'hero': (u'обезьянка', u'мн'), 'mob': u'крыса', 'number': 2}),
+                         u'глупых обезьянок и 2 крысы')
+
+    def test_dependences_order(self):
+        template = Template.create(morph, u'[{глупый|hero|рд}] [[hero|number|рд]] [[number||]]')
+        self.assertEqual(template._external_ids, ('number', 'hero'))
+        self.assertEqual([slot[1] for slot in template._slots], [0, 1, None])
+
+    def test_percent_sign(self):
+        template = Template.create(morph, u'[[hero|им]] 100%')
+        self.assertEqual(template.substitute(self.dictionary, {'hero': u'тень'}), u'тень 100%')
+
+    def test_cyclic_dependences(self):
+        self.assertRaises(TextgenException, Template.create, morph, u'[[hero|mob|им]] [[mob|hero|им]]')
+        self.assertRaises(TextgenException, Template.create, morph, u'[[hero|hero|им]]')
+
+    def test_unknown_dependences(self):
+        self.assertRaises(TextgenException, Template.create, morph, u'[{глупый||hero|рд}] [[hero|рд]]')
+        self.assertRaises(TextgenException, Template.create, morph, u'[{глупый|mob|рд}] [[hero|рд]]', available_externals=['hero'])
+
+    def test_load_cyclic_dependences(self):
+        # templates saved before dependences were checked on creation
+        data = {'template': u'%(e_0)s и %(e_1)s, %(e_2)s',
+                'externals': [[u'hero', [u'mob'], u'e_0', [u'им'], u'hero'],
+                              [u'mob', [u'hero'], u'e_1', [u'рд'], u'mob'],
+                              [u'shadow', [u'shadow'], u'e_2', [u'тв'], u'shadow']],
+                'internals': []}
+        template = Template.deserialize(json.loads(json.dumps(data)))
+        self.assertEqual(template.substitute(self.dictionary, {'hero': u'обезьянка', 'mob': u'крыса', 'shadow': u'тень'}),
+                         u'обезьянка и крысы, тенью')
+
+    def test_missed_external(self):
+        template = Template.create(morph, u'[{глупый|hero|рд}] [[mob|рд]]')
+        self.assertRaises(TextgenException, template.substitute, self.dictionary, {'mob': u'крыса'})
+        self.assertRaises(TextgenException, template.substitute_many, self.dictionary, [{'hero': u'крыса'}])
+
+    def test_serialization(self):
+        template = Template.create(morph, u'[{глупый|hero|рд}] [[hero|рд]]')
+        data = json.loads(json.dumps(template.serialize()))
+        restored = Template.deserialize(data)
+        self.assertEqual(restored.substitute(self.dictionary, {'hero': u'крыса'}), u'глупой крысы')
+
+
+class FakeMorph(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.words = set()
+
+    def get_graminfo(self, word):
+        self.calls += 1
+        self.words.add(word)
+        return [{'class': u'С', 'info': u'жр,ед,им', 'norm': word, 'method': u'lemma(%s)' % word}]
+
+    def inflect_ru(self, word, gram_form, gram_class=None):
+        self.calls += 1
+        return u'%s:%s' % (word, gram_form)
+
+
+class MorphCacheTest(TestCase):
+
+    def setUp(self):
+        self.dicts_directory = tempfile.mkdtemp()
+        with open(os.path.join(self.dicts_directory, 'rules.sqlite'), 'w') as f:
+            f.write('rules')
+        self.storage = os.path.join(tempfile.mkdtemp(), 'morph_cache.sqlite')
+
+    def create_cache(self, morph):
+        return MorphCache(morph, self.storage, dicts_directory=self.dicts_directory)
+
+    def test_persistence(self):
+        morph = FakeMorph()
+        cache = self.create_cache(morph)
+        self.assertEqual(cache.inflect_ru(u'КРЫСА', u'рд,ед', u'С'), u'КРЫСА:рд,ед')
+        self.assertEqual(cache.get_graminfo(u'КРЫСА')[0]['class'], u'С')
+        self.assertEqual(cache.inflect_ru(u'КРЫСА', u'рд,ед', u'С'), u'КРЫСА:рд,ед')
+        self.assertEqual((morph.calls, cache.hits, cache.misses), (2, 1, 2))
+        cache.close()
+
+        morph = FakeMorph()
+        cache = self.create_cache(morph)
+        self.assertEqual(cache.inflect_ru(u'КРЫСА', u'рд,ед', u'С'), u'КРЫСА:рд,ед')
+        self.assertEqual(cache.get_graminfo(u'КРЫСА'), [{'class': u'С', 'info': u'жр,ед,им', 'norm': u'КРЫСА'}])
+        self.assertEqual(morph.calls, 0)
+        cache.close()
+
+    def test_dicts_changed(self):
+        cache = self.create_cache(FakeMorph())
+        cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        cache.close()
+
+        with open(os.path.join(self.dicts_directory, 'lemmas.sqlite'), 'w') as f:
+            f.write('lemmas')
+
+        morph = FakeMorph()
+        cache = self.create_cache(morph)
+        cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        self.assertEqual(morph.calls, 1)
+        cache.close()
+
+    def test_read_only(self):
+        cache = self.create_cache(FakeMorph())
+        cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        cache.close()
+
+        with open(self.storage) as f:
+            storage_data = f.read()
+
+        morph = FakeMorph()
+        worker_cache = MorphCache(morph, self.storage, dicts_directory=self.dicts_directory, read_only=True)
+        worker_cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        worker_cache.inflect_ru(u'КРЫСА', u'тв,ед')
+        self.assertEqual(morph.calls, 1)
+        worker_cache.close()
+
+        with open(self.storage) as f:
+            self.assertEqual(f.read(), storage_data)
+
+        answers = worker_cache.pop_new_answers()
+        self.assertEqual(answers.values(), [u'КРЫСА:тв,ед'])
+
+        cache = self.create_cache(FakeMorph())
+        cache.add_answers(answers)
+        cache.close()
+
+        morph = FakeMorph()
+        cache = self.create_cache(morph)
+        cache.inflect_ru(u'КРЫСА', u'тв,ед')
+        self.assertEqual(morph.calls, 0)
+        cache.close()
+
+    def test_read_only_without_storage(self):
+        morph = FakeMorph()
+        cache = MorphCache(morph, self.storage, dicts_directory=self.dicts_directory, read_only=True)
+        cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        cache.inflect_ru(u'КРЫСА', u'рд,ед')
+        self.assertEqual((morph.calls, cache.hits, cache.misses), (1, 1, 1))
+        cache.close()
+
+    def test_answers_in_memory_are_limited(self):
+        cache = self.create_cache(FakeMorph())
+        cache._answers.size = 2
+        for case in (u'им', u'рд', u'дт'):
+            cache.inflect_ru(u'КРЫСА', u'%s,ед' % case)
+        self.assertEqual(len(cache._answers), 2)
+        cache.close()
+
+        morph = FakeMorph()
+        cache = self.create_cache(morph)
+        cache.inflect_ru(u'КРЫСА', u'им,ед')
+        self.assertEqual(morph.calls, 0)
+        cache.close()
+
+    def test_gram_info(self):
+        cache = self.create_cache(FakeMorph())
+        class_, properties = get_gram_info(cache, u'КРЫСА')
+        self.assertEqual(class_, u'С')
+        self.assertEqual((properties.gender, properties.number, properties.case), (u'жр', u'ед', u'им'))
+        cache.close()
+
+
+class ImportTestBase(TestCase):
+
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.storage_dir = tempfile.mkdtemp()
+
+        self.get_morph = pymorphy.get_morph
+        pymorphy.get_morph = lambda *argv, **kwargs: FakeMorph()
+
+    def tearDown(self):
+        pymorphy.get_morph = self.get_morph
+
+    def create_module(self, prefix, types):
+        with open(os.path.join(self.source_dir, '%s.json' % prefix), 'w') as f:
+            f.write(json.dumps({'prefix': prefix,
+                                'variables_verbose': {'hero': u'герой', 'mob': u'моб'},
+                                'variables': {'hero': u'крыса'},
+                                'types': types},
+                               ensure_ascii=False).encode('utf-8'))
+
+    def import_texts(self, name, jobs=1, morph=None, incremental=False, morph_cache=None):
+        voc_storage = os.path.join(self.storage_dir, '%s_voc.json' % name)
+        dict_storage = os.path.join(self.storage_dir, '%s_dict.json' % name)
+        import_texts(morph or FakeMorph(),
+                     source_dir=self.source_dir,
+                     tech_vocabulary_path=os.path.join(self.storage_dir, 'tech.json'),
+                     voc_storage=voc_storage,
+                     dict_storage=dict_storage,
+                     jobs=jobs,
+                     incremental=incremental,
+                     morph_cache=morph_cache)
+        with open(voc_storage) as voc_f:
+            with open(dict_storage) as dict_f:
+                return voc_f.read(), dict_f.read()
+
+
+class ParallelImportTest(ImportTestBase):
+
+    def test_same_result(self):
+        for i in xrange(4):
+            self.create_module('module_%d' % i,
+                               {'start': {'phrases': [[u'[[hero|им]] и [{тень_%d|hero|рд}]' % i, u'крыса:им,ед и тень_%d:рд,ед' % i]]},
+                                'finish': {'variables': {'mob': u'обезьянка'},
+                                           'phrases': [[u'[[mob|вн]] и [[hero|мн]]', u'обезьянка:вн,ед и крыса:им,мн']]}})
+
+        serial = self.import_texts('serial', jobs=1)
+        parallel = self.import_texts('parallel', jobs=3)
+
+        self.assertEqual(serial, parallel)
+        self.assertTrue(u'тень_3' in serial[1].decode('utf-8'))
+        self.assertTrue('module_2_finish' in serial[0])
+
+    def test_morph_cache(self):
+        for i in xrange(3):
+            self.create_module('module_%d' % i, {'start': {'phrases': [[u'[[hero|им]] и [{тень_%d|hero|рд}]' % i, u'крыса:им,ед и тень_%d:рд,ед' % i]]}})
+
+        morph_cache = os.path.join(self.storage_dir, 'morph_cache.sqlite')
+
+        serial = self.import_texts('serial', jobs=1)
+        parallel = self.import_texts('parallel', jobs=3, morph_cache=morph_cache)
+        self.assertEqual(serial, parallel)
+
+        # answers of all workers are saved by parent process
+        morph = FakeMorph()
+        self.assertEqual(self.import_texts('cached', jobs=1, morph=morph, morph_cache=morph_cache), serial)
+        self.assertEqual(morph.calls, 0)
+
+    def test_duplicate_types(self):
+        self.create_module('a', {'b_c': {'phrases': [[u'[[hero|им]]', u'крыса:им,ед']]}})
+        self.create_module('a_b', {'c': {'phrases': [[u'[[hero|им]]', u'крыса:им,ед']]}})
+        self.assertRaises(TextgenException, self.import_texts, 'duplicates', jobs=2)
+
+
+class IncrementalImportTest(ImportTestBase):
+
+    def setUp(self):
+        super(IncrementalImportTest, self).setUp()
+        for i in xrange(3):
+            self.create_module('module_%d' % i, {'start': {'phrases': [[u'[[hero|им]] и [{тень_%d|hero|рд}]' % i,
+                                                                        u'крыса:им,ед и тень_%d:рд,ед' % i]]}})
+        self.import_texts('build', incremental=True)
+
+    def load_vocabulary(self):
+        vocabulary = Vocabulary()
+        vocabulary.load(os.path.join(self.storage_dir, 'build_voc.json'))
+        return vocabulary
+
+    def test_nothing_changed(self):
+        morph = FakeMorph()
+        self.import_texts('build', morph=morph, incremental=True)
+        self.assertEqual(morph.calls, 0)
+        self.assertEqual(sorted(self.load_vocabulary().data.keys()), ['module_0_start', 'module_1_start', 'module_2_start'])
+
+    def test_changed_and_deleted_modules(self):
+        self.create_module('module_1', {'finish': {'phrases': [[u'[[hero|рд]] [{тень_new|hero|}]', u'крыса:рд,ед тень_new:им,ед']]}})
+        os.remove(os.path.join(self.source_dir, 'module_2.json'))
+
+        morph = FakeMorph()
+        self.import_texts('build', morph=morph, incremental=True)
+
+        # words from dictionary are not analyzed again
+        self.assertEqual(morph.words, set([u'ТЕНЬ_NEW']))
+
+        vocabulary = self.load_vocabulary()
+        self.assertEqual(sorted(vocabulary.data.keys()), ['module_0_start', 'module_1_finish'])
+        self.assertEqual(vocabulary.data['module_1_finish'][0].template, u'%(e_0)s %(i_0)s')
+
+    def test_tech_vocabulary_changed(self):
+        vocabulary = self.load_vocabulary()
+        for templates in vocabulary.data.values():
+            templates[0] = Template.create(morph, u'outdated')
+        vocabulary.save(os.path.join(self.storage_dir, 'build_voc.json'))
+
+        with open(os.path.join(self.storage_dir, 'tech.json'), 'w') as f:
+            f.write(json.dumps({u'тень_1': u'С,мр'}, ensure_ascii=False).encode('utf-8'))
+
+        self.import_texts('build', incremental=True)
+
+        # word is analyzed again with new entry
+        dictionary = Dictionary()
+        dictionary.load(os.path.join(self.storage_dir, 'build_dict.json'))
+        self.assertEqual(dictionary.get_word(u'тень_1').properties, (u'мр',))
+        self.assertEqual(dictionary.get_word(u'тень_0').properties, (u'жр',))
+
+        # only module_1 uses changed word
+        vocabulary = self.load_vocabulary()
+        self.assertEqual(vocabulary.data['module_0_start'][0].template, u'outdated')
+        self.assertEqual(vocabulary.data['module_1_start'][0].template, u'%(e_0)s и %(i_0)s')
+        self.assertEqual(vocabulary.data['module_2_start'][0].template, u'outdated')
+
+        with open(os.path.join(self.storage_dir, 'build_voc.json.manifest')) as f:
+            manifest = json.loads(f.read())
+
+        self.assertEqual(manifest['tech_vocabulary'].keys(), [u'тень_1'])
+        self.assertEqual(sorted(manifest['modules'].keys()), ['module_0', 'module_1', 'module_2'])
+
+    def test_tech_vocabulary_changed_as_clean_build(self):
+        self.create_module('module_3', {'start': {'phrases': [[u'[[hero|им]] и [{Тень_1|hero|рд}]', u'крыса:им,ед и тень_1:рд,ед'],
+                                                              [u'[[hero|им]] и [{злая тень_1|hero|рд}]', u'крыса:им,ед и злая:рд,ед тень_1:рд,ед']]}})
+        self.import_texts('build', incremental=True)
+
+        for entry in (u'С,мр', None):
+            with open(os.path.join(self.storage_dir, 'tech.json'), 'w') as f:
+                f.write(json.dumps({u'тень_1': entry} if entry else {}, ensure_ascii=False).encode('utf-8'))
+
+            incremental_dictionary = json.loads(self.import_texts('build', incremental=True)[1])
+            clean_dictionary = json.loads(self.import_texts('clean_%s' % bool(entry))[1])
+
+            self.assertEqual(incremental_dictionary, clean_dictionary)
+
+            properties = [u'мр'] if entry else [u'жр']
+            for key in (u'тень_1', u'Тень_1', u'злая тень_1'):
+                self.assertEqual(incremental_dictionary[key]['properties'], properties)
+
+
+class WordsBuilderTest(TestCase):
+
+    def test_analyze_once(self):
+        morph = FakeMorph()
+        dictionary = create_test_dictionary()
+        builder = WordsBuilder(morph, dictionary, {})
+
+        self.assertTrue(builder.get_word(u'обезьянка') is dictionary.get_word(u'обезьянка'))
+        word = builder.get_word(u'кот')
+        self.assertTrue(builder.get_word(u'кот') is word)
+        self.assertTrue(dictionary.get_word(u'кот') is word)
+
+        self.assertEqual((builder.analyzed, builder.skipped), (1, 2))
+        self.assertEqual(morph.words, set([u'КОТ']))
+
+
+class LRUCacheTest(TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(size=2)
+        cache.set(1, u'a')
+        cache.set(2, u'b')
+        self.assertEqual(cache.get(1), u'a')
+        cache.set(3, u'c')
+        self.assertFalse(2 in cache)
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual((cache.get(1), cache.get(3)), (u'a', u'c'))
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (3, 1, 2))
+
+    def test_remove_if(self):
+        cache = LRUCache(size=10)
+        for i in xrange(5):
+            cache.set(i, i)
+        cache.remove_if(lambda key: key % 2)
+        self.assertEqual(sorted(cache._data.keys()), [0, 2, 4])
+
+
+class RenderCacheTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+        self.cache = LRUCache(size=10)
+        self.dictionary.render_cache = self.cache
+        self.template = Template.create(morph, u'[{глупый|hero|рд}] [[hero|рд]] и [[number||]] [[mob|number|им]]')
+
+    def test_hits(self):
+        externals = {'hero': u'обезьянка', 'mob': u'крыса', 'number': 5}
+        result = self.template.substitute(self.dictionary, externals)
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, unused=u'тень')), result)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, number=2)), u'глупой обезьянки и 2 крысы')
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, number=2.0)), u'глупой обезьянки и 2.0 крысы')
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, hero=(u'обезьянка', u'мн'))), u'глупых обезьянок и 5 крыс')
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, hero=Fake(u'Обезьянка'))), u'глупого Обезьянка и 5 крыс')
+        self.assertEqual(self.template.substitute(self.dictionary, dict(externals, hero=Fake(u'обезьянка'))), u'глупого обезьянка и 5 крыс')
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 6))
+
+    def test_dictionary_changed(self):
+        template = Template.create(morph, u'[[hero|рд]]')
+        self.assertEqual(template.substitute(self.dictionary, {'hero': u'кот'}), u'<word not found: кот>')
+        self.dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот', u'кота'] + [u'кот'] * 10, properties=(u'мр',)))
+        self.assertEqual(template.substitute(self.dictionary, {'hero': u'кот'}), u'кота')
+
+    def test_vocabulary_reloaded(self):
+        vocabulary = Vocabulary()
+        vocabulary.render_cache = self.cache
+        self.template.substitute(self.dictionary, {'hero': u'обезьянка', 'mob': u'крыса', 'number': 5})
+        self.assertEqual(len(self.cache), 1)
+        vocabulary.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+class ResolvedExternalsTest(TestCase):
+
+    def setUp(self):
+        self.dictionary = create_test_dictionary()
+
+    def test_resolve_external(self):
+        word, args = self.dictionary.resolve_external((u'обезьянка', u'мн,рд'))
+        self.assertEqual(word.normalized, u'обезьянка')
+        self.assertEqual((args.gender, args.number, args.case), (u'жр', u'мн', u'рд'))
+        self.assertTrue(self.dictionary.resolve_external((u'обезьянка', u'мн,рд'))[0] is word)
+        self.assertTrue(self.dictionary.resolve_external((u'обезьянка', [u'мн']))[1] is Args(u'жр', u'мн'))
+        self.assertEqual(self.dictionary.resolve_external(7)[0].normalized, 7)
+
+    def test_cache_invalidation(self):
+        self.assertEqual(self.dictionary.resolve_external(u'кот')[0].__class__, Fake)
+        self.dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот'] * 12, properties=(u'мр',)))
+        self.assertEqual(self.dictionary.resolve_external(u'кот')[0].__class__, Noun)
+
+    def test_reuse(self):
+        externals = self.dictionary.resolve_externals({'hero': u'обезьянка', 'number': 2})
+
+        template_1 = Template.create(morph, u'[{глупый|hero|рд}] [[hero|рд]]')
+        template_2 = Template.create(morph, u'[[number||]] [[hero|number|им]]')
+
+        self.assertEqual(template_1.substitute(self.dictionary, externals), u'глупой обезьянки')
+        self.assertEqual(template_2.substitute(self.dictionary, externals), u'2 обезьянки')
+
+        self.dictionary.render_cache = LRUCache(size=10)
+        self.assertEqual(template_2.substitute(self.dictionary, externals), u'2 обезьянки')
+        self.assertEqual(template_2.substitute(self.dictionary, {'hero': u'обезьянка', 'number': 2}), u'2 обезьянки')
+        self.assertEqual(self.dictionary.render_cache.hits, 1)
+
+    def test_dictionary_changed(self):
+        template = Template.create(morph, u'[[hero|рд]]')
+        externals = self.dictionary.resolve_externals({'hero': u'кот'})
+        self.assertEqual(template.substitute(self.dictionary, externals), u'<word not found: кот>')
+        self.dictionary.add_word(Noun(normalized=u'кот', forms=[u'кот', u'кота'] + [u'кот'] * 10, properties=(u'мр',)))
+        self.assertEqual(template.substitute(self.dictionary, externals), u'кота')
+
+
 class LoadDataTest(TestCase):
 
     def setUp(self):
@@ -0,0 +1,185 @@
+# coding: utf-8
+'''
+vectorized agreement with numbers, requires numpy
+
+numbers and grammatical states are passed as numpy arrays, results are numpy arrays of unicode objects
+'''
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from textgen.exceptions import TextgenException
+from textgen.logic import Args
+from textgen.words import Numeral
+
+
+# number of every plural class (see WordBase.get_plural_class), used to render class variants
+PLURAL_CLASSES_NUMBERS = (1, 2, 5)
+
+
+def require_numpy():
+    if numpy is None:
+        raise TextgenException(u'numpy is required for vectorized rendering')
+
+
+def get_plural_classes(numbers):
+    '''
+    vectorized WordBase.get_plural_class
+    '''
+    require_numpy()
+
+    numbers = numpy.mod(numpy.asarray(numbers), 100)
+    units = numpy.mod(numbers, 10)
+
+    classes = numpy.full(numbers.shape, 2, dtype=numpy.int8)
+    classes[(units >= 2) & (units <= 4) & ~((numbers >= 12) & (numbers <= 14))] = 1
+    classes[(units == 1) & (numbers != 11)] = 0
+
+    return classes
+
+
+def get_states(cases=None, numbers=None, genders=None, base=None):
+    '''
+    pack arrays of indexes of properties (in Args.CASES, Args.NUMBERS, Args.GENDERS) into array of Args states
+    '''
+    require_numpy()
+
+    state = (base or Args()).state
+
+    arrays = [array for array in (cases, numbers, genders) if array is not None]
+    states = numpy.full(numpy.asarray(arrays[0]).shape if arrays else (), state, dtype=numpy.int32)
+
+    for array, mask, shift in ((cases, Args.CASE, 0), (numbers, Args.NUMBER, 3), (genders, Args.GENDER, 4)):
+        if array is not None:
+            states = (states & ~mask) | (numpy.asarray(array, dtype=numpy.int32) << shift)
+
+    return states
+
+
+class FormsTable(object):
+    '''
+    forms of word for every Args state in numpy array
+    '''
+
+    def __init__(self, word):
+        require_numpy()
+
+        self.word = word
+        self.forms = numpy.empty(Args.STATES_NUMBER, dtype=object)
+
+        for args in Args.all():
+            self.forms[args.state] = word.get_form(args)
+
+    def get_forms(self, states):
+        return self.forms[states]
+
+
+def _map_unique(values, function):
+    '''
+    apply python function to every unique value of array
+    '''
+    values = numpy.asarray(values)
+    uniques, inverse = numpy.unique(values, return_inverse=True)
+    # inverse of numpy.unique is always flat
+    return numpy.array([function(value) for value in uniques.tolist()], dtype=numpy.int32)[inverse.reshape(values.shape)]
+
+
+def get_agreement_states(word, size, arguments=None, dependences_states=None, numbers=None, args=()):
+    '''
+    vectorized Template._create_substitution: states of word forms
+    - arguments - own Args of word
+    - dependences_states - array of Args states of (not numeral) dependence
+    - numbers - array of numbers, which word agrees with
+    - args - arguments from template
+    '''
+    require_numpy()
+
+    arguments = arguments or Args()
+
+    if dependences_states is None:
+        states = numpy.full(size, arguments.update(*args).state, dtype=numpy.int32)
+    else:
+        states = _map_unique(dependences_states,
+                             lambda state: word.update_args(arguments, None, Args.from_state(state)).update(*args).state)
+
+    if numbers is not None:
+        classes = get_plural_classes(numbers)
+
+        uniques, inverse = numpy.unique(states, return_inverse=True)
+
+        table = numpy.array([[word.update_args(Args.from_state(state), Numeral(number), None).state for number in PLURAL_CLASSES_NUMBERS]
+                             for state in uniques.tolist()], dtype=numpy.int32).reshape((len(uniques), len(PLURAL_CLASSES_NUMBERS)))
+
+        states = table[inverse.reshape(states.shape), classes]
+
+    return states
+
+
+def pluralize_forms(word, numbers, args=(), forms_table=None):
+    '''
+    forms of word, agreed with every number from array ("5 монет")
+    '''
+    numbers = numpy.asarray(numbers)
+    forms_table = forms_table or FormsTable(word)
+    return forms_table.get_forms(get_agreement_states(word, numbers.shape, numbers=numbers, args=args))
+
+
+def _get_segments(template, dictionary, externals, number_id):
+    '''
+    render template with all slots except number_id, returns list of literal segments between number slots
+    '''
+    processed_externals = template._preprocess_externals(dictionary, externals)
+
+    if template._internal_dependences:
+        parts, slots = template._get_variant(dictionary, processed_externals)
+    else:
+        parts, slots = template._parts, template._slots
+
+    parts = list(parts)
+
+    for position, external_index, internal_word, dependences, args in slots:
+        if external_index is None:
+            word, arguments = dictionary.get_word(internal_word), Args()
+        elif template._external_ids[external_index] == number_id:
+            continue
+        else:
+            word, arguments = processed_externals[external_index]
+        parts[position] = template._create_substitution(word, arguments, dependences, processed_externals, args)
+
+    segments = [u'']
+    for part in parts:
+        if part is None:
+            segments.append(u'')
+        else:
+            segments[-1] += part
+
+    return segments
+
+
+def render_numerals(template, dictionary, numbers, number_id, externals=None):
+    '''
+    render template for every number from array, other externals are the same for all numbers
+
+    template is rendered once for every plural class, then strings of numbers are inserted between rendered segments
+    '''
+    require_numpy()
+
+    numbers = numpy.asarray(numbers)
+    externals = dict(externals or {})
+
+    classes = get_plural_classes(numbers)
+
+    segments = []
+    for number in PLURAL_CLASSES_NUMBERS:
+        externals[number_id] = number
+        segments.append(_get_segments(template, dictionary, externals, number_id))
+
+    numbers_strings = numpy.array([u'%s' % number for number in numbers.ravel().tolist()], dtype=object).reshape(numbers.shape)
+
+    result = numpy.array([class_segments[0] for class_segments in segments], dtype=object)[classes]
+
+    for i in xrange(1, len(segments[0])):
+        result = result + numbers_strings + numpy.array([class_segments[i] for class_segments in segments], dtype=object)[classes]
+
+    return result
@@ -1,7 +1,7 @@
 # coding: utf-8
 
 from textgen.exceptions import TextgenException, NormalFormNeeded, NoGrammarFound
-from textgen.logic import efication, get_gram_info, PROPERTIES
+from textgen.logic import efication, get_gram_info, PROPERTIES, Args, intern_tuple
 
 class WORD_TYPE:
     NOUN = 1
@@ -28,25 +28,51 @@ WORD_CONSTRUCTORS = {}
 
 class WordBase(object):
 
+    __slots__ = ('normalized', 'forms', 'properties', '_identity')
+
     TYPE = None
+    FORMS_INDEXES = ()
 
     def __init__(self, normalized, forms=[], properties=()):
+        # equal forms of word share single string
+        unique_forms = {}
         self.normalized = normalized
-        self.forms = tuple(forms)
-        self.properties = tuple(properties)
+        self.forms = tuple(unique_forms.setdefault(form, form) for form in forms)
+        self.properties = intern_tuple(properties)
+        self._identity = None
+
+    def __getstate__(self):
+        return (self.normalized, self.forms, self.properties)
+
+    def __setstate__(self, state):
+        self.normalized, self.forms, self.properties = state
+        self._identity = None
 
     @staticmethod
-    def _pluralize_args(number, args):
+    def get_plural_class(number):
+        '''
+        0 - one (1, 21, ...), 1 - few (2, 3, 4, 22, ...), 2 - many
+        '''
         number %= 100
 
         if number % 10 == 1 and number != 11:
-            args.update(u'ед')
+            return 0
         elif 2 <= number % 10 <= 4 and not (12 <= number <= 14):
-            args.update(u'мн')
+            return 1
+        return 2
+
+    @classmethod
+    def _pluralize_args(cls, number, args):
+        plural_class = cls.get_plural_class(number)
+
+        if plural_class == 0:
+            args = args.update(u'ед')
+        elif plural_class == 1:
+            args = args.update(u'мн')
         else:
-            args.update(u'мн')
+            args = args.update(u'мн')
             if args.case in (u'им', u'вн'):
-                args.update(u'рд')
+                args = args.update(u'рд')
 
         return args
 
@@ -59,17 +85,49 @@ class WordBase(object):
         return word
 
     def _get_form(self, args):
+        if not self.forms:
+            return self.normalized
+        return self.forms[self.FORMS_INDEXES[args.state]]
+
+    @classmethod
+    def _form_index(cls, args):
         raise NotImplementedError
 
+    @classmethod
+    def build_forms_indexes(cls):
+        '''
+        precompute index of form for every grammatical state, so _get_form does single lookup
+        '''
+        indexes = [None] * Args.STATES_NUMBER
+        for args in Args.all():
+            indexes[args.state] = cls._form_index(args)
+        cls.FORMS_INDEXES = tuple(indexes)
+
     @property
     def has_forms(self): return self.forms # boolean
 
+    def compact(self, paradigms):
+        '''
+        replace forms tuple with paradigm (stem + shared endings table)
+        '''
+        if len(self.forms) > 1:
+            self.forms = paradigms.get_paradigm(self.forms)
+
+    @property
+    def identity(self):
+        # word is not changed after creation (compact keeps the same forms), so identity is built once
+        identity = self._identity
+        if identity is None:
+            identity = (self.__class__, self.normalized, tuple(self.forms), tuple(self.properties))
+            self._identity = identity
+        return identity
+
     @classmethod
     def pluralize_args(cls, number, args):
         raise NotImplementedError
 
     def pluralize(self, number, args):
-        return self.get_form(self.pluralize_args(number, args.get_copy()))
+        return self.get_form(self.pluralize_args(number, args))
 
     def update_args(self, arguments, dependence_class, dependence_args):
         raise NotImplementedError
@@ -109,7 +167,7 @@ class WordBase(object):
     def serialize(self):
         return {'normalized': self.normalized,
                 'type': self.TYPE,
-                'forms': self.forms,
+                'forms': tuple(self.forms),
                 'properties': self.properties}
 
     @staticmethod
@@ -127,6 +185,8 @@ class WordBase(object):
 
 class Fake(WordBase):
 
+    __slots__ = ()
+
     TYPE = WORD_TYPE.FAKE
 
     def __init__(self, word):
@@ -141,11 +201,13 @@ class Fake(WordBase):
         return args
 
     def update_args(self, arguments, dependence, dependence_args):
-        pass
+        return arguments
 
 
 class Noun(WordBase):
 
+    __slots__ = ()
+
     TYPE = WORD_TYPE.NOUN
     FORMS_NUMBER = len(PROPERTIES.NUMBERS) * len(PROPERTIES.CASES)
 
@@ -162,10 +224,9 @@ class Noun(WordBase):
     def is_valid(self):
         return len(self.forms) == self.FORMS_NUMBER
 
-    def _get_form(self, args):
-        if not self.forms:
-            return self.normalized
-        return self.forms[PROPERTIES.NUMBERS.index(args.number) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)]
+    @classmethod
+    def _form_index(cls, args):
+        return PROPERTIES.NUMBERS.index(args.number) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)
 
     @classmethod
     def pluralize_args(cls, number, args):
@@ -173,10 +234,9 @@ class Noun(WordBase):
 
     def update_args(self, arguments, dependence, dependence_args):
         if isinstance(dependence, Numeral):
-            self.pluralize_args(dependence.normalized, arguments)
-            return
+            return self.pluralize_args(dependence.normalized, arguments)
 
-        arguments.number = dependence_args.number
+        return arguments.inherit(dependence_args, Args.NUMBER)
 
 
     @classmethod
@@ -201,31 +261,34 @@ class Noun(WordBase):
 
 class Numeral(WordBase):
 
+    __slots__ = ()
+
     TYPE = WORD_TYPE.NUMERAL
 
     def __init__(self, number):
         super(Numeral, self).__init__(normalized=number)
 
     def _get_form(self, args):
-        return self.normalized
+        return u'%s' % self.normalized
 
     def update_args(self, arguments, dependence, dependence_args):
-        pass
+        return arguments
 
 
 class Adjective(WordBase):
 
-    TYPE = WORD_TYPE.ADJECTIVE
+    __slots__ = ()
 
-    def _get_form(self, args):
-        if not self.forms:
-            return self.normalized
+    TYPE = WORD_TYPE.ADJECTIVE
 
-        if args.number == u'ед':
-            return self.forms[PROPERTIES.GENDERS.index(args.gender) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)]
+    @classmethod
+    def _form_index(cls, args):
+        # gender u'мн' means word existed only in multiple number
+        if args.number == u'ед' and args.gender != u'мн':
+            return PROPERTIES.GENDERS.index(args.gender) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)
         else:
             delta = len(PROPERTIES.CASES) * len(PROPERTIES.GENDERS)
-            return self.forms[delta + PROPERTIES.CASES.index(args.case)]
+            return delta + PROPERTIES.CASES.index(args.case)
 
     @classmethod
     def pluralize_args(cls, number, args):
@@ -235,12 +298,9 @@ class Adjective(WordBase):
     def update_args(self, arguments, dependence, dependence_args):
 
         if isinstance(dependence, Numeral):
-            self.pluralize_args(dependence.normalized, arguments)
-            return
+            return self.pluralize_args(dependence.normalized, arguments)
 
-        arguments.number = dependence_args.number
-        arguments.gender = dependence_args.gender
-        arguments.case = dependence_args.case
+        return arguments.inherit(dependence_args, Args.NUMBER | Args.GENDER | Args.CASE)
 
 
     @classmethod
@@ -270,6 +330,8 @@ class Adjective(WordBase):
 
 class Pronoun(Adjective):
 
+    __slots__ = ()
+
     TYPE = WORD_TYPE.PRONOUN
 
     @classmethod
@@ -300,24 +362,23 @@ class Pronoun(Adjective):
 
 class Verb(WordBase):
 
-    TYPE = WORD_TYPE.VERB
+    __slots__ = ()
 
-    def _get_form(self, args):
-
-        if not self.forms:
-            return self.normalized
+    TYPE = WORD_TYPE.VERB
 
+    @classmethod
+    def _form_index(cls, args):
         if args.time == u'прш':
-            if args.number == u'мн':
-                return self.forms[3]
+            if args.number == u'мн' or args.gender == u'мн':
+                return 3
             else:
-                return self.forms[PROPERTIES.GENDERS.index(args.gender)]
+                return PROPERTIES.GENDERS.index(args.gender)
         elif args.time == u'нст':
             delta = len(PROPERTIES.GENDERS) + 1
-            return self.forms[delta + len(PROPERTIES.NUMBERS) * PROPERTIES.PERSONS.index(args.person) + PROPERTIES.NUMBERS.index(args.number)]
+            return delta + len(PROPERTIES.NUMBERS) * PROPERTIES.PERSONS.index(args.person) + PROPERTIES.NUMBERS.index(args.number)
         elif args.time == u'буд':
             delta = len(PROPERTIES.GENDERS) + 1 + len(PROPERTIES.NUMBERS) * len(PROPERTIES.PERSONS)
-            return self.forms[delta + len(PROPERTIES.NUMBERS) * PROPERTIES.PERSONS.index(args.person) + PROPERTIES.NUMBERS.index(args.number)]
+            return delta + len(PROPERTIES.NUMBERS) * PROPERTIES.PERSONS.index(args.person) + PROPERTIES.NUMBERS.index(args.number)
 
     @classmethod
     def pluralize_args(cls, number, args):
@@ -325,11 +386,9 @@ class Verb(WordBase):
 
     def update_args(self, arguments, dependence, dependence_args):
         if isinstance(dependence, Numeral):
-            self.pluralize_args(dependence.normalized, arguments)
-            return
+            return self.pluralize_args(dependence.normalized, arguments)
 
-        arguments.number = dependence_args.number
-        arguments.gender = dependence_args.gender
+        return arguments.inherit(dependence_args, Args.NUMBER | Args.GENDER)
 
 
 
@@ -368,23 +427,22 @@ class Verb(WordBase):
 
 class Participle(WordBase):
 
-    TYPE = WORD_TYPE.PARTICIPLE
+    __slots__ = ()
 
-    def _get_form(self, args):
-
-        if not self.forms:
-            return self.normalized
+    TYPE = WORD_TYPE.PARTICIPLE
 
+    @classmethod
+    def _form_index(cls, args):
         delta = 0
 
         if args.time != u'прш':
             delta = len(PROPERTIES.CASES) * len(PROPERTIES.GENDERS) + len(PROPERTIES.CASES)
 
-        if args.number == u'ед':
-            return self.forms[delta + PROPERTIES.GENDERS.index(args.gender) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)]
+        if args.number == u'ед' and args.gender != u'мн':
+            return delta + PROPERTIES.GENDERS.index(args.gender) * len(PROPERTIES.CASES) + PROPERTIES.CASES.index(args.case)
         else:
             delta += len(PROPERTIES.CASES) * len(PROPERTIES.GENDERS)
-            return self.forms[delta + PROPERTIES.CASES.index(args.case)]
+            return delta + PROPERTIES.CASES.index(args.case)
 
     @classmethod
     def pluralize_args(cls, number, args):
@@ -392,12 +450,9 @@ class Participle(WordBase):
 
     def update_args(self, arguments, dependence, dependence_args):
         if isinstance(dependence, Numeral):
-            self.pluralize_args(dependence.normalized, arguments)
-            return
+            return self.pluralize_args(dependence.normalized, arguments)
 
-        arguments.number = dependence_args.number
-        arguments.case = dependence_args.case
-        arguments.gender = dependence_args.gender
+        return arguments.inherit(dependence_args, Args.NUMBER | Args.CASE | Args.GENDER)
 
 
 
@@ -428,23 +483,22 @@ class Participle(WordBase):
 
 class ShortParticiple(WordBase):
 
-    TYPE = WORD_TYPE.SHORT_PARTICIPLE
-
-    def _get_form(self, args):
+    __slots__ = ()
 
-        if not self.forms:
-            return self.normalized
+    TYPE = WORD_TYPE.SHORT_PARTICIPLE
 
+    @classmethod
+    def _form_index(cls, args):
         delta = 0
 
         if args.time != u'прш':
             delta = len(PROPERTIES.GENDERS) + 1
 
-        if args.number == u'ед':
-            return self.forms[delta + PROPERTIES.GENDERS.index(args.gender)]
+        if args.number == u'ед' and args.gender != u'мн':
+            return delta + PROPERTIES.GENDERS.index(args.gender)
         else:
             delta += len(PROPERTIES.GENDERS)
-            return self.forms[delta]
+            return delta
 
     @classmethod
     def pluralize_args(cls, number, args):
@@ -453,12 +507,9 @@ class ShortParticiple(WordBase):
     def update_args(self, arguments, dependence, dependence_args):
 
         if isinstance(dependence, Numeral):
-            self.pluralize_args(dependence.normalized, arguments)
-            return
+            return self.pluralize_args(dependence.normalized, arguments)
 
-        arguments.number = dependence_args.number
-        arguments.case = dependence_args.case
-        arguments.gender = dependence_args.gender
+        return arguments.inherit(dependence_args, Args.NUMBER | Args.CASE | Args.GENDER)
 
 
     @classmethod
@@ -486,6 +537,8 @@ class ShortParticiple(WordBase):
 
 class NounGroup(Noun):
 
+    __slots__ = ()
+
     TYPE = WORD_TYPE.NOUN_GROUP
 
     @classmethod
@@ -545,3 +598,7 @@ class NounGroup(Noun):
 WORD_CONSTRUCTORS = dict([(class_.TYPE, class_)
                           for class_name, class_ in globals().items()
                           if isinstance(class_, type) and issubclass(class_, WordBase) and class_ != WordBase])
+
+for word_class in WORD_CONSTRUCTORS.values():
+    if '_form_index' in word_class.__dict__:
+        word_class.build_forms_indexes()